@@ -0,0 +1,296 @@
+from starlette.responses import JSONResponse
+from typing import Optional, Tuple
+import enum
+import math
+import os
+import re
+import time
+from dotenv import load_dotenv
+
+from app.auth_cache import TTLCache
+from app.dependencies import decode_token_subject
+from app.metrics import pool_wait_observers, registry
+
+load_dotenv()
+
+ADMISSION_CONTROL_ENABLED = os.getenv("ADMISSION_CONTROL_ENABLED", "true").lower() == "true"
+# Requests being handled at once before normal traffic is shed; low priority is shed earlier
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "200"))
+ADMISSION_LOW_PRIORITY_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_LOW_PRIORITY_MAX_IN_FLIGHT", "100"))
+# Recent average wait for a pooled connection before normal or low priority traffic is shed
+ADMISSION_POOL_WAIT_MS = float(os.getenv("ADMISSION_POOL_WAIT_MS", "250"))
+ADMISSION_LOW_PRIORITY_POOL_WAIT_MS = float(os.getenv("ADMISSION_LOW_PRIORITY_POOL_WAIT_MS", "50"))
+# How quickly the pool wait average forgets a spike once checkouts are fast or idle again
+ADMISSION_POOL_WAIT_HALF_LIFE_SECONDS = float(os.getenv("ADMISSION_POOL_WAIT_HALF_LIFE_SECONDS", "1"))
+# Per-user token buckets: requests per second and burst; 0 turns a limit off
+ADMISSION_USER_RATE = float(os.getenv("ADMISSION_USER_RATE", "20"))
+ADMISSION_USER_BURST = float(os.getenv("ADMISSION_USER_BURST", "40"))
+ADMISSION_POLL_RATE = float(os.getenv("ADMISSION_POLL_RATE", "1"))
+ADMISSION_POLL_BURST = float(os.getenv("ADMISSION_POLL_BURST", "3"))
+# Accept, cancel and ride updates draw from a bucket of their own, so other traffic cannot use it up
+ADMISSION_CRITICAL_RATE = float(os.getenv("ADMISSION_CRITICAL_RATE", "5"))
+ADMISSION_CRITICAL_BURST = float(os.getenv("ADMISSION_CRITICAL_BURST", "20"))
+ADMISSION_RETRY_AFTER_SECONDS = int(os.getenv("ADMISSION_RETRY_AFTER_SECONDS", "1"))
+ADMISSION_MAX_USERS = int(os.getenv("ADMISSION_MAX_USERS", "100000"))
+
+# Weight of each new checkout in the pool wait average
+POOL_WAIT_SAMPLE_WEIGHT = 0.2
+
+
+class Priority(str, enum.Enum):
+    CRITICAL = "critical"
+    NORMAL = "normal"
+    LOW = "low"
+    POLL = "poll"
+
+
+# Checked in order against "METHOD path"; anything else is normal priority
+PRIORITY_RULES = [
+    # Moving a ride along frees riders and drivers, so it is never shed
+    (re.compile(r"^POST /api/rides/[^/]+/(accept|cancel)$"), Priority.CRITICAL),
+    (re.compile(r"^PUT /api/rides/[^/]+$"), Priority.CRITICAL),
+    (re.compile(r"^GET /api/rides/available$"), Priority.POLL),
+    # Refreshes the client can repeat or serve from its cache
+    (re.compile(r"^GET /api/rides(/[^/]+)?$"), Priority.LOW),
+    (re.compile(r"^GET /api/users/(?!me$)[^/]+$"), Priority.LOW),
+]
+# Always admitted and not counted, so the service stays observable under load
+EXEMPT_PATHS = ("/health", "/metrics")
+
+
+def classify(method: str, path: str) -> Optional[Priority]:
+    """Priority of a request, or None if admission control leaves it alone"""
+    if path in EXEMPT_PATHS or path.startswith("/api/admin/"):
+        return None
+    request_line = f"{method} {path}"
+    for pattern, priority in PRIORITY_RULES:
+        if pattern.match(request_line):
+            return priority
+    return Priority.NORMAL
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Take a token; returns 0 on success, else seconds until one is available"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class DecayingAverage:
+    """Average of recent samples that also decays towards zero while no samples arrive"""
+
+    def __init__(self, half_life_seconds: float):
+        self.half_life_seconds = half_life_seconds
+        self.value = 0.0
+        self.updated = time.monotonic()
+
+    def current(self, now: Optional[float] = None) -> float:
+        now = time.monotonic() if now is None else now
+        return self.value * 0.5 ** ((now - self.updated) / self.half_life_seconds)
+
+    def observe(self, sample: float):
+        now = time.monotonic()
+        self.value = self.current(now) * (1 - POOL_WAIT_SAMPLE_WEIGHT) + sample * POOL_WAIT_SAMPLE_WEIGHT
+        self.updated = now
+
+
+class AdmissionController:
+    """
+    Decides before a request touches the database whether it runs: per-user
+    token buckets first (429), then load shedding by priority when too many
+    requests are in flight or pool checkouts have been slow (503). Critical
+    requests are rate limited on their own bucket but never shed. State is
+    per worker process.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int = ADMISSION_MAX_IN_FLIGHT,
+        low_priority_max_in_flight: int = ADMISSION_LOW_PRIORITY_MAX_IN_FLIGHT,
+        pool_wait_ms: float = ADMISSION_POOL_WAIT_MS,
+        low_priority_pool_wait_ms: float = ADMISSION_LOW_PRIORITY_POOL_WAIT_MS,
+        user_rate: float = ADMISSION_USER_RATE,
+        user_burst: float = ADMISSION_USER_BURST,
+        poll_rate: float = ADMISSION_POLL_RATE,
+        poll_burst: float = ADMISSION_POLL_BURST,
+        critical_rate: float = ADMISSION_CRITICAL_RATE,
+        critical_burst: float = ADMISSION_CRITICAL_BURST
+    ):
+        self.max_in_flight = max_in_flight
+        self.low_priority_max_in_flight = low_priority_max_in_flight
+        self.pool_wait_seconds = pool_wait_ms / 1000
+        self.low_priority_pool_wait_seconds = low_priority_pool_wait_ms / 1000
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.poll_rate = poll_rate
+        self.poll_burst = poll_burst
+        self.critical_rate = critical_rate
+        self.critical_burst = critical_burst
+        self.in_flight = 0
+        self.pool_wait = DecayingAverage(ADMISSION_POOL_WAIT_HALF_LIFE_SECONDS)
+        # (user_id, bucket name) to TokenBucket; an idle bucket would be full again anyway
+        refill_seconds = [
+            burst / rate
+            for rate, burst in ((user_rate, user_burst), (poll_rate, poll_burst), (critical_rate, critical_burst))
+            if rate > 0
+        ]
+        self.buckets = TTLCache(ADMISSION_MAX_USERS, max([60.0, *refill_seconds]))
+
+    def _bucket(self, user_id: str, name: str, rate: float, burst: float) -> TokenBucket:
+        key = (user_id, name)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate, burst)
+        # Re-set on every use so an active bucket does not expire and refill
+        self.buckets.set(key, bucket)
+        return bucket
+
+    def rate_limit(self, user_id: str, priority: Priority) -> float:
+        """Seconds the user has to wait, or 0 if the request is within their limits"""
+        if priority == Priority.CRITICAL:
+            if self.critical_rate > 0:
+                return self._bucket(user_id, "critical", self.critical_rate, self.critical_burst).take()
+            return 0.0
+        if priority == Priority.POLL and self.poll_rate > 0:
+            wait = self._bucket(user_id, "poll", self.poll_rate, self.poll_burst).take()
+            if wait:
+                return wait
+        if self.user_rate > 0:
+            return self._bucket(user_id, "user", self.user_rate, self.user_burst).take()
+        return 0.0
+
+    def overloaded(self, priority: Priority) -> Optional[str]:
+        """Why a request of this priority should be shed right now, or None"""
+        if priority == Priority.CRITICAL:
+            return None
+        low = priority in (Priority.LOW, Priority.POLL)
+        max_in_flight = self.low_priority_max_in_flight if low else self.max_in_flight
+        if self.in_flight >= max_in_flight:
+            return "in_flight"
+        threshold = self.low_priority_pool_wait_seconds if low else self.pool_wait_seconds
+        if self.pool_wait.current() >= threshold:
+            return "pool_wait"
+        return None
+
+    def admit(self, priority: Priority, user_id: Optional[str]) -> Optional[Tuple[int, str, float]]:
+        """None to run the request, else (status code, reason, retry after seconds)"""
+        # Anonymous requests (login, registration) are guarded by the password hashing slots
+        if user_id is not None:
+            wait = self.rate_limit(user_id, priority)
+            if wait:
+                return 429, "rate_limited", wait
+        reason = self.overloaded(priority)
+        if reason is not None:
+            return 503, reason, ADMISSION_RETRY_AFTER_SECONDS
+        return None
+
+
+admission = AdmissionController()
+pool_wait_observers.append(admission.pool_wait.observe)
+
+admission_rejected = registry.counter(
+    "rideasy_admission_rejected_total", "Requests rejected before running, by priority and reason",
+    ("priority", "reason")
+)
+registry.gauge_callback(
+    "rideasy_admission_in_flight", "HTTP requests being handled, excluding exempt paths",
+    lambda: admission.in_flight
+)
+registry.gauge_callback(
+    "rideasy_admission_pool_wait_seconds", "Recent average wait for a pooled database connection",
+    lambda: admission.pool_wait.current()
+)
+registry.gauge_callback(
+    "rideasy_admission_max_in_flight", "In-flight requests above which normal traffic is shed",
+    lambda: admission.max_in_flight
+)
+registry.gauge_callback(
+    "rideasy_admission_low_priority_max_in_flight", "In-flight requests above which low priority traffic is shed",
+    lambda: admission.low_priority_max_in_flight
+)
+registry.gauge_callback(
+    "rideasy_admission_pool_wait_threshold_seconds", "Pool wait average above which normal traffic is shed",
+    lambda: admission.pool_wait_seconds
+)
+registry.gauge_callback(
+    "rideasy_admission_low_priority_pool_wait_threshold_seconds",
+    "Pool wait average above which low priority traffic is shed",
+    lambda: admission.low_priority_pool_wait_seconds
+)
+registry.gauge_callback(
+    "rideasy_admission_user_rate", "Requests per second allowed per user", lambda: admission.user_rate
+)
+registry.gauge_callback(
+    "rideasy_admission_critical_rate", "Accepts, cancels and ride updates per second allowed per user",
+    lambda: admission.critical_rate
+)
+registry.gauge_callback(
+    "rideasy_admission_poll_rate", "Polls of /api/rides/available per second allowed per user",
+    lambda: admission.poll_rate
+)
+
+
+def _bearer_token(scope: dict) -> Optional[str]:
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            return token if scheme.lower() == "bearer" and token else None
+    return None
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware applying the admission controller to HTTP requests.
+    Rejections are answered here, before routing, so they never wait for or
+    hold a database connection.
+    """
+
+    def __init__(self, app, controller: AdmissionController = admission):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not ADMISSION_CONTROL_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        priority = classify(scope["method"], scope["path"])
+        if priority is None:
+            await self.app(scope, receive, send)
+            return
+
+        token = _bearer_token(scope)
+        # Served from the token cache after a user's first request
+        user_id = decode_token_subject(token) if token else None
+        if token:
+            # Handed to get_current_user through request.state so the token is decoded once
+            scope.setdefault("state", {})["token_subject"] = (token, user_id)
+        rejection = self.controller.admit(priority, user_id)
+        if rejection is not None:
+            status_code, reason, retry_after = rejection
+            admission_rejected.inc(priority.value, reason)
+            detail = "Too many requests" if status_code == 429 else "Server is busy, retry shortly"
+            response = JSONResponse(
+                {"detail": detail}, status_code=status_code,
+                headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+            )
+            await response(scope, receive, send)
+            return
+
+        self.controller.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.in_flight -= 1
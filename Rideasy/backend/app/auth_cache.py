@@ -0,0 +1,155 @@
+from sqlalchemy.orm import make_transient_to_detached
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Set, Tuple
+import asyncio
+import logging
+import os
+import time
+import uuid
+from dotenv import load_dotenv
+
+from app.models import User
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+AUTH_CACHE_ENABLED = os.getenv("AUTH_CACHE_ENABLED", "true").lower() == "true"
+# Upper bound on how stale a cached user can be if an invalidation from another worker is lost
+AUTH_CACHE_TTL_SECONDS = float(os.getenv("AUTH_CACHE_TTL_SECONDS", "30"))
+AUTH_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_CACHE_MAX_ENTRIES", "10000"))
+# How often each worker tells the others which users changed on it
+AUTH_CACHE_SYNC_INTERVAL_SECONDS = float(os.getenv("AUTH_CACHE_SYNC_INTERVAL_SECONDS", "0.2"))
+
+AUTH_CACHE_SYNC_CHANNEL = "users"
+# Keeps a message well under Postgres' 8000 byte NOTIFY limit
+USERS_PER_MESSAGE = 150
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries also expire after a fixed TTL"""
+
+    def __init__(self, max_entries: int = AUTH_CACHE_MAX_ENTRIES, ttl_seconds: float = AUTH_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # Map key to (expires_at, value), least recently used first
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any):
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+# Token string to (user_id, exp) so repeat requests skip the JWT decode
+token_cache = TTLCache()
+# User id to a detached User snapshot so repeat requests skip the users lookup
+user_cache = TTLCache()
+
+
+def snapshot_user(user: User) -> User:
+    """Detached copy of a loaded user that no session owns"""
+    snapshot = User(**{column.key: getattr(user, column.key) for column in User.__table__.columns})
+    make_transient_to_detached(snapshot)
+    return snapshot
+
+
+class UserCacheSync:
+    """
+    Drops users changed on this worker from every other worker's user_cache
+    over the pub/sub bus. Invalidations are batched and published every
+    interval, so another worker serves a stale snapshot for at most that
+    long (plus NOTIFY latency) instead of AUTH_CACHE_TTL_SECONDS.
+    """
+
+    def __init__(self, cache: TTLCache = user_cache, interval_seconds: float = AUTH_CACHE_SYNC_INTERVAL_SECONDS):
+        self.cache = cache
+        self.interval_seconds = interval_seconds
+        # Tags this worker's messages, which the bus delivers back to it too
+        self.origin = uuid.uuid4().hex
+        # Users invalidated here since the last publish
+        self.pending: Set[str] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        # Imported here to avoid a circular import with the websocket router
+        from app.routers.websocket import manager
+
+        await manager.subscribe_channel(AUTH_CACHE_SYNC_CHANNEL, self.apply)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def apply(self, message: dict):
+        if message.get("origin") == self.origin:
+            return
+        for user_id in message["users"]:
+            self.cache.invalidate(user_id)
+
+    async def flush(self):
+        """Publish the users invalidated here since the last flush"""
+        from app.routers.websocket import manager
+
+        if not self.pending:
+            return
+        user_ids, self.pending = list(self.pending), set()
+        for start in range(0, len(user_ids), USERS_PER_MESSAGE):
+            await manager.publish(AUTH_CACHE_SYNC_CHANNEL, {
+                "origin": self.origin,
+                "users": user_ids[start:start + USERS_PER_MESSAGE]
+            })
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval_seconds)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("User cache sync failed")
+
+
+user_cache_sync = UserCacheSync()
+
+
+def invalidate_user(user_id: str):
+    """Drop a user's cached snapshot after their row changed, here and on every other worker"""
+    user_cache.invalidate(user_id)
+    if AUTH_CACHE_ENABLED:
+        user_cache_sync.pending.add(user_id)
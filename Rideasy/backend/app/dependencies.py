@@ -1,12 +1,15 @@
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, Header, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.ext.asyncio import AsyncSession
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
 from typing import Optional
 import os
+import secrets
+import time
 from dotenv import load_dotenv
 
+from app.auth_cache import AUTH_CACHE_ENABLED, token_cache, user_cache, snapshot_user
 from app.database import get_db
 from app.models import User
 from app.schemas import UserResponse
@@ -16,6 +19,10 @@ load_dotenv()
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30 * 24 * 60  # 30 days
+# Shared secret for /api/admin endpoints; they do not exist while it is unset
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+# Bearer token Prometheus must send to /metrics; while unset the endpoint is open
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/auth/login")
 
@@ -31,7 +38,46 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
+def decode_token_subject(token: str) -> Optional[str]:
+    """Return the user id of a valid, unexpired token, or None"""
+    if AUTH_CACHE_ENABLED:
+        cached = token_cache.get(token)
+        if cached is not None:
+            user_id, expires_at = cached
+            if expires_at is None or expires_at > time.time():
+                return user_id
+            token_cache.invalidate(token)
+            return None
+    
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    user_id = payload.get("sub")
+    if user_id is None:
+        return None
+    
+    if AUTH_CACHE_ENABLED:
+        token_cache.set(token, (user_id, payload.get("exp")))
+    return user_id
+
+
+async def get_user_by_id(user_id: str, db: AsyncSession) -> Optional[User]:
+    """Load a user into the session, from the snapshot cache when possible"""
+    if AUTH_CACHE_ENABLED:
+        snapshot = user_cache.get(user_id)
+        if snapshot is not None:
+            # Attach a copy to this session without a SELECT so handlers can still modify it
+            return await db.merge(snapshot, load=False)
+    
+    user = await db.get(User, user_id)
+    if user is not None and AUTH_CACHE_ENABLED:
+        user_cache.set(user_id, snapshot_user(user))
+    return user
+
+
 async def get_current_user(
+    request: Request,
     token: str = Depends(oauth2_scheme),
     db: AsyncSession = Depends(get_db)
 ) -> User:
@@ -40,15 +86,16 @@ async def get_current_user(
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            raise credentials_exception
-    except JWTError:
+    # The admission middleware has usually decoded this token already
+    decoded = getattr(request.state, "token_subject", None)
+    if decoded is not None and decoded[0] == token:
+        user_id = decoded[1]
+    else:
+        user_id = decode_token_subject(token)
+    if user_id is None:
         raise credentials_exception
     
-    user = await db.get(User, user_id)
+    user = await get_user_by_id(user_id, db)
     if user is None:
         raise credentials_exception
     return user
@@ -59,3 +106,22 @@ async def get_current_active_user(
 ) -> User:
     return current_user
 
+
+async def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    if x_admin_token is None or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Invalid admin token"
+        )
+
+
+async def require_metrics_token(authorization: Optional[str] = Header(None)):
+    if not METRICS_TOKEN:
+        return
+    if authorization is None or not secrets.compare_digest(authorization, f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Invalid metrics token"
+        )
@@ -0,0 +1,143 @@
+from sqlalchemy import select
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Set, Tuple
+import asyncio
+import logging
+import os
+from dotenv import load_dotenv
+
+from app.database import AsyncSessionLocal
+from app.driver_index import driver_index
+from app.metrics import background_task, registry
+from app.models import Ride, RideStatus
+from app.schemas import RideResponse
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# When enabled, new rides are offered to nearby drivers over the WebSocket
+# instead of being assigned by the matching engine or in create_ride
+RIDE_OFFERS_ENABLED = os.getenv("RIDE_OFFERS_ENABLED", "false").lower() == "true"
+# Drivers offered a ride at once; every further ring adds the next nearest as many
+RIDE_OFFER_RING_SIZE = int(os.getenv("RIDE_OFFER_RING_SIZE", "3"))
+RIDE_OFFER_TIMEOUT_SECONDS = float(os.getenv("RIDE_OFFER_TIMEOUT_SECONDS", "10"))
+# After this many rings the ride is left searching for drivers polling /available
+RIDE_OFFER_MAX_RINGS = int(os.getenv("RIDE_OFFER_MAX_RINGS", "4"))
+RIDE_OFFER_MAX_PICKUP_KM = float(os.getenv("RIDE_OFFER_MAX_PICKUP_KM", "15"))
+
+ride_offers_sent = registry.counter(
+    "rideasy_ride_offers_sent_total", "Ride offers pushed to drivers, by ring", ("ring",)
+)
+ride_offer_outcomes = registry.counter(
+    "rideasy_ride_offer_cascades_total", "Finished ride offer cascades, by how they ended", ("outcome",)
+)
+
+
+class RideDispatcher:
+    """
+    Offers new rides to the nearest free drivers over the WebSocket, ring by
+    ring: the nearest ring_size drivers first, then the next nearest as well
+    each time an offer times out. Drivers take an offer with
+    POST /api/rides/{id}/accept, so the first one wins and the rest get 409,
+    and the offers still out are withdrawn.
+    """
+
+    def __init__(
+        self,
+        ring_size: int = RIDE_OFFER_RING_SIZE,
+        timeout_seconds: float = RIDE_OFFER_TIMEOUT_SECONDS,
+        max_rings: int = RIDE_OFFER_MAX_RINGS,
+        max_pickup_km: float = RIDE_OFFER_MAX_PICKUP_KM
+    ):
+        self.ring_size = ring_size
+        self.timeout_seconds = timeout_seconds
+        self.max_rings = max_rings
+        self.max_pickup_km = max_pickup_km
+        # Map ride_id to the cascade offering it and the event that ends it early
+        self._cascades: Dict[str, Tuple[asyncio.Task, asyncio.Event]] = {}
+
+    def dispatch(self, ride: RideResponse):
+        """Start offering a new ride in the background"""
+        closed = asyncio.Event()
+        task = background_task(self._cascade(ride, closed))
+        self._cascades[ride.id] = (task, closed)
+        task.add_done_callback(lambda _: self._cascades.pop(ride.id, None))
+
+    def close(self, ride_id: str):
+        """
+        Stop offering a ride accepted or cancelled on this worker. A cascade on
+        another worker notices at its next timeout instead.
+        """
+        cascade = self._cascades.get(ride_id)
+        if cascade is not None:
+            cascade[1].set()
+
+    async def stop(self):
+        tasks = [task for task, _ in self._cascades.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _cascade(self, ride: RideResponse, closed: asyncio.Event):
+        # Imported here to avoid a circular import with the websocket router
+        from app.routers.websocket import manager
+
+        offered: Set[str] = set()
+        ride_data = ride.model_dump(mode="json")
+        driver_id: Optional[str] = None
+        outcome = "expired"
+        try:
+            for ring in range(self.max_rings):
+                # Closest first; drivers offered in an earlier ring keep their offer
+                candidates = driver_index.nearest(
+                    ride.pickup_location.latitude,
+                    ride.pickup_location.longitude,
+                    k=len(offered) + self.ring_size,
+                    max_radius_km=self.max_pickup_km
+                )
+                expires_at = datetime.utcnow() + timedelta(seconds=self.timeout_seconds)
+                for candidate_id, distance in candidates:
+                    if candidate_id in offered:
+                        continue
+                    offered.add(candidate_id)
+                    ride_offers_sent.inc(str(ring))
+                    await manager.send_user_message(candidate_id, {
+                        "type": "ride_offer",
+                        "ring": ring,
+                        "pickup_distance_km": round(distance, 2),
+                        "expires_at": expires_at.isoformat(),
+                        "data": ride_data
+                    })
+
+                try:
+                    await asyncio.wait_for(closed.wait(), self.timeout_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                # The database decides, since the accept may have gone to another worker
+                state = await self._ride_state(ride.id)
+                if state is None or state[0] != RideStatus.SEARCHING:
+                    driver_id = state[1] if state is not None else None
+                    outcome = "accepted" if state is not None and state[0] == RideStatus.MATCHED else "closed"
+                    break
+        except asyncio.CancelledError:
+            outcome = "stopped"
+            raise
+        except Exception:
+            outcome = "failed"
+            logger.exception("Offer cascade for ride %s failed", ride.id)
+        finally:
+            ride_offer_outcomes.inc(outcome)
+            if outcome != "stopped":
+                for other_id in offered - {driver_id}:
+                    await manager.send_user_message(other_id, {"type": "ride_offer_withdrawn", "ride_id": ride.id})
+
+    @staticmethod
+    async def _ride_state(ride_id: str) -> Optional[Tuple[RideStatus, Optional[str]]]:
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(select(Ride.status, Ride.driver_id).where(Ride.id == ride_id))
+            row = result.first()
+        return None if row is None else (row.status, row.driver_id)
+
+
+ride_dispatcher = RideDispatcher()
@@ -0,0 +1,207 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, and_
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+import heapq
+import math
+import os
+from dotenv import load_dotenv
+
+from app.geo import haversine_km, KM_PER_DEGREE_LAT
+from app.models import User, Ride, RideStatus
+
+load_dotenv()
+
+# Grid cell size in degrees (0.01 deg is roughly 1.1 km of latitude)
+DRIVER_INDEX_CELL_DEG = float(os.getenv("DRIVER_INDEX_CELL_DEG", "0.01"))
+# Drivers further than this from the pickup are never returned
+DRIVER_INDEX_MAX_RADIUS_KM = float(os.getenv("DRIVER_INDEX_MAX_RADIUS_KM", "15"))
+
+ACTIVE_DRIVER_STATUSES = [RideStatus.MATCHED, RideStatus.DRIVER_ARRIVING, RideStatus.IN_PROGRESS]
+
+Cell = Tuple[int, int]
+
+
+class DriverIndex:
+    """
+    In-memory uniform grid of online drivers keyed by their last known position.
+    Drivers with an active ride are kept in the grid but flagged busy so they
+    are skipped by nearest() until they are freed again.
+    """
+
+    def __init__(self, cell_deg: float = DRIVER_INDEX_CELL_DEG):
+        self.cell_deg = cell_deg
+        # Map driver_id to (latitude, longitude)
+        self.positions: Dict[str, Tuple[float, float]] = {}
+        # Map grid cell to set of driver_ids located in it
+        self.cells: Dict[Cell, Set[str]] = {}
+        self.busy: Set[str] = set()
+        # Called with (driver_id, field, value) for every local change, see app/driver_sync.py
+        self.observers: List[Callable[[str, str, Any], None]] = []
+
+    def _changed(self, driver_id: str, field: str, value):
+        for observer in self.observers:
+            observer(driver_id, field, value)
+
+    def _cell(self, latitude: float, longitude: float) -> Cell:
+        return (math.floor(latitude / self.cell_deg), math.floor(longitude / self.cell_deg))
+
+    def update(self, driver_id: str, latitude: float, longitude: float):
+        """Insert or move an online driver"""
+        self._move(driver_id, latitude, longitude)
+        self._changed(driver_id, "position", (latitude, longitude))
+
+    def _move(self, driver_id: str, latitude: float, longitude: float):
+        new_cell = self._cell(latitude, longitude)
+        old_position = self.positions.get(driver_id)
+        if old_position is not None:
+            old_cell = self._cell(*old_position)
+            if old_cell != new_cell:
+                self._discard_from_cell(old_cell, driver_id)
+        self.positions[driver_id] = (latitude, longitude)
+        self.cells.setdefault(new_cell, set()).add(driver_id)
+
+    def remove(self, driver_id: str):
+        """Drop a driver that went offline (busy state survives until the ride ends)"""
+        self._remove(driver_id)
+        self._changed(driver_id, "position", None)
+
+    def _remove(self, driver_id: str):
+        position = self.positions.pop(driver_id, None)
+        if position is not None:
+            self._discard_from_cell(self._cell(*position), driver_id)
+
+    def _discard_from_cell(self, cell: Cell, driver_id: str):
+        members = self.cells.get(cell)
+        if members is not None:
+            members.discard(driver_id)
+            if not members:
+                del self.cells[cell]
+
+    def mark_busy(self, driver_id: str):
+        self.busy.add(driver_id)
+        self._changed(driver_id, "busy", True)
+
+    def mark_free(self, driver_id: str):
+        self.busy.discard(driver_id)
+        self._changed(driver_id, "busy", False)
+
+    def apply_changes(self, driver_id: str, changes: Dict[str, Any]):
+        """Apply fields changed on another worker, without reporting them to observers"""
+        if "position" in changes:
+            if changes["position"] is None:
+                self._remove(driver_id)
+            else:
+                self._move(driver_id, *changes["position"])
+        if "busy" in changes:
+            if changes["busy"]:
+                self.busy.add(driver_id)
+            else:
+                self.busy.discard(driver_id)
+
+    def is_online(self, driver_id: str) -> bool:
+        return driver_id in self.positions
+
+    def is_free(self, driver_id: str) -> bool:
+        return driver_id in self.positions and driver_id not in self.busy
+
+    def free_drivers(self) -> List[Tuple[str, float, float]]:
+        """Snapshot of all free drivers as (driver_id, latitude, longitude)"""
+        return [
+            (driver_id, latitude, longitude)
+            for driver_id, (latitude, longitude) in self.positions.items()
+            if driver_id not in self.busy
+        ]
+
+    def nearest(
+        self,
+        latitude: float,
+        longitude: float,
+        k: int = 1,
+        max_radius_km: Optional[float] = None
+    ) -> List[Tuple[str, float]]:
+        """
+        Return up to k free drivers as (driver_id, distance_km), closest first.
+        Searches outward ring by ring and stops once no unvisited cell can
+        hold a driver closer than the current k-th candidate.
+        """
+        if max_radius_km is None:
+            max_radius_km = DRIVER_INDEX_MAX_RADIUS_KM
+        if k <= 0 or not self.positions:
+            return []
+
+        center_row, center_col = self._cell(latitude, longitude)
+        lat_cell_km = self.cell_deg * KM_PER_DEGREE_LAT
+        # Longitude cells shrink towards the poles; bound the search with the
+        # narrowest cell we could meet inside the radius
+        max_lat = min(abs(latitude) + max_radius_km / KM_PER_DEGREE_LAT, 89.0)
+        lon_cell_km = lat_cell_km * math.cos(math.radians(max_lat))
+        max_rings = int(math.ceil(max_radius_km / min(lat_cell_km, lon_cell_km))) + 1
+
+        # Max-heap of the best k candidates as (-distance, driver_id)
+        best: List[Tuple[float, str]] = []
+        for ring in range(max_rings + 1):
+            for cell in self._ring_cells(center_row, center_col, ring):
+                for driver_id in self.cells.get(cell, ()):
+                    if driver_id in self.busy:
+                        continue
+                    driver_lat, driver_lon = self.positions[driver_id]
+                    distance = haversine_km(latitude, longitude, driver_lat, driver_lon)
+                    if distance > max_radius_km:
+                        continue
+                    if len(best) < k:
+                        heapq.heappush(best, (-distance, driver_id))
+                    elif distance < -best[0][0]:
+                        heapq.heapreplace(best, (-distance, driver_id))
+
+            # Every driver outside this ring is at least `ring` full cells away
+            if len(best) == k and -best[0][0] <= ring * min(lat_cell_km, lon_cell_km):
+                break
+
+        return [(driver_id, -neg_distance) for neg_distance, driver_id in sorted(best, reverse=True)]
+
+    @staticmethod
+    def _ring_cells(center_row: int, center_col: int, ring: int):
+        if ring == 0:
+            yield (center_row, center_col)
+            return
+        for col in range(center_col - ring, center_col + ring + 1):
+            yield (center_row - ring, col)
+            yield (center_row + ring, col)
+        for row in range(center_row - ring + 1, center_row + ring):
+            yield (row, center_col - ring)
+            yield (row, center_col + ring)
+
+    async def rebuild(self, db: AsyncSession):
+        """Reload all online drivers and their busy state from the database"""
+        result = await db.execute(
+            select(User.id, User.current_latitude, User.current_longitude).where(
+                and_(
+                    User.user_mode == "driver",
+                    User.is_online == True,
+                    User.current_latitude.isnot(None),
+                    User.current_longitude.isnot(None)
+                )
+            )
+        )
+        drivers = result.all()
+
+        result = await db.execute(
+            select(Ride.driver_id).where(
+                and_(
+                    Ride.driver_id.isnot(None),
+                    Ride.status.in_(ACTIVE_DRIVER_STATUSES)
+                )
+            )
+        )
+        busy_driver_ids = set(result.scalars().all())
+
+        self.positions.clear()
+        self.cells.clear()
+        self.busy.clear()
+        # Not reported: other workers' positions are fresher than the stored ones
+        for driver_id, latitude, longitude in drivers:
+            self._move(driver_id, latitude, longitude)
+        self.busy.update(busy_driver_ids)
+
+
+driver_index = DriverIndex()
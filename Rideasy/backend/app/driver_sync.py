@@ -0,0 +1,93 @@
+from typing import Any, Dict, Optional
+import asyncio
+import logging
+import os
+import uuid
+from dotenv import load_dotenv
+
+from app.driver_index import DriverIndex, driver_index
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# How often each worker publishes the driver index changes made on it
+DRIVER_SYNC_INTERVAL_SECONDS = float(os.getenv("DRIVER_SYNC_INTERVAL_SECONDS", "0.5"))
+
+DRIVER_SYNC_CHANNEL = "drivers"
+# Keeps a message well under Postgres' 8000 byte NOTIFY limit
+DRIVERS_PER_MESSAGE = 50
+
+
+class DriverIndexSync:
+    """
+    Keeps the driver index of every worker in step over the pub/sub bus.
+    Positions, going offline and busy/free changes made on this worker are
+    coalesced per driver and field, and published every interval; other
+    workers apply them to their own index. Matching, match_driver and ride
+    offers on any worker therefore see drivers that went online, moved or
+    took a ride on another, at most one interval (plus NOTIFY latency) late.
+    """
+
+    def __init__(self, index: DriverIndex = driver_index, interval_seconds: float = DRIVER_SYNC_INTERVAL_SECONDS):
+        self.index = index
+        self.interval_seconds = interval_seconds
+        # Tags this worker's messages, which the bus delivers back to it too
+        self.origin = uuid.uuid4().hex
+        # Map driver_id to the fields changed here since the last publish
+        self.pending: Dict[str, Dict[str, Any]] = {}
+        self._task: Optional[asyncio.Task] = None
+        index.observers.append(self.record)
+
+    def record(self, driver_id: str, field: str, value):
+        self.pending.setdefault(driver_id, {})[field] = value
+
+    async def start(self):
+        # Imported here to avoid a circular import with the websocket router
+        from app.routers.websocket import manager
+
+        await manager.subscribe_channel(DRIVER_SYNC_CHANNEL, self.apply)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def apply(self, message: dict):
+        if message.get("origin") == self.origin:
+            return
+        for driver_id, changes in message["drivers"].items():
+            self.index.apply_changes(driver_id, changes)
+
+    async def flush(self):
+        """Publish the changes made here since the last flush"""
+        from app.routers.websocket import manager
+
+        if not self.pending:
+            return
+        changes, self.pending = list(self.pending.items()), {}
+        for start in range(0, len(changes), DRIVERS_PER_MESSAGE):
+            await manager.publish(DRIVER_SYNC_CHANNEL, {
+                "origin": self.origin,
+                "drivers": dict(changes[start:start + DRIVERS_PER_MESSAGE])
+            })
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval_seconds)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Driver index sync failed")
+
+
+driver_index_sync = DriverIndexSync()
@@ -0,0 +1,258 @@
+from sqlalchemy import select, and_, func
+from sqlalchemy.orm import aliased
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+import asyncio
+import logging
+import math
+import numpy as np
+import os
+from dotenv import load_dotenv
+
+from app.database import AsyncSessionLocal
+from app.geo import haversine_km, haversine_km_array, haversine_km_sql
+from app.models import Ride, RideArchive, Location, RideStatus
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Speed table cell size in degrees (0.05 deg is roughly 5.5 km of latitude)
+ETA_CELL_DEG = float(os.getenv("ETA_CELL_DEG", "0.05"))
+# Cells or hours with fewer completed rides fall back to the coarser table
+ETA_MIN_SAMPLES = int(os.getenv("ETA_MIN_SAMPLES", "5"))
+# Completed rides older than this are not learned from
+ETA_HISTORY_DAYS = int(os.getenv("ETA_HISTORY_DAYS", "28"))
+ETA_RELOAD_SECONDS = float(os.getenv("ETA_RELOAD_SECONDS", "3600"))
+# Used until enough rides have completed, in km/h of straight-line distance
+ETA_DEFAULT_SPEED_KMH = float(os.getenv("ETA_DEFAULT_SPEED_KMH", "30"))
+# When the driver's position is unknown
+ETA_UNKNOWN_POSITION_MINUTES = float(os.getenv("ETA_UNKNOWN_POSITION_MINUTES", "5"))
+
+# Trips outside these bounds are bad data (GPS jumps, rides left open)
+MIN_TRIP_KM = 0.2
+MIN_SPEED_KMH = 2.0
+MAX_SPEED_KMH = 130.0
+
+HOURS = 24
+# Packs a (row, col) cell into one int64 so lookups can be vectorized
+CELL_KEY_STRIDE = 1 << 32
+
+
+class EtaEstimator:
+    """
+    Travel time from straight-line distance and a speed learned per geo cell
+    and UTC hour of day from completed rides (started_at -> completed_at).
+    Speeds are km of straight-line distance per hour, so road detours are
+    already accounted for. Cells without enough data use the city-wide speed
+    for that hour, which in turn falls back to ETA_DEFAULT_SPEED_KMH.
+    """
+
+    def __init__(self, cell_deg: float = ETA_CELL_DEG):
+        self.cell_deg = cell_deg
+        # Speed per hour over all cells
+        self.hour_speeds = np.full(HOURS, ETA_DEFAULT_SPEED_KMH, dtype=np.float32)
+        # Sorted cell keys and the matching rows of per-hour speeds
+        self.cell_keys = np.empty(0, dtype=np.int64)
+        self.cell_speeds = np.empty((0, HOURS), dtype=np.float32)
+        # Map cell key to its row in cell_speeds for scalar lookups
+        self.cell_rows: Dict[int, int] = {}
+        self.loaded_at: Optional[datetime] = None
+        self.sample_count = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def _cell_key(self, latitude: float, longitude: float) -> int:
+        return math.floor(latitude / self.cell_deg) * CELL_KEY_STRIDE + math.floor(longitude / self.cell_deg)
+
+    def _cell_keys(self, latitudes: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+        rows = np.floor(latitudes / self.cell_deg).astype(np.int64)
+        cols = np.floor(longitudes / self.cell_deg).astype(np.int64)
+        return rows * CELL_KEY_STRIDE + cols
+
+    def speed_kmh(self, latitude: float, longitude: float, hour: int) -> float:
+        """Expected speed for trips starting in this cell at this UTC hour"""
+        row = self.cell_rows.get(self._cell_key(latitude, longitude))
+        if row is None:
+            return float(self.hour_speeds[hour])
+        return float(self.cell_speeds[row, hour])
+
+    def speeds_kmh_array(self, latitudes, longitudes, hour: int) -> np.ndarray:
+        """speed_kmh for many start points at once"""
+        keys = self._cell_keys(np.asarray(latitudes, dtype=np.float64), np.asarray(longitudes, dtype=np.float64))
+        rows = np.searchsorted(self.cell_keys, keys)
+        rows = np.minimum(rows, max(len(self.cell_keys) - 1, 0))
+        speeds = np.full(keys.shape, self.hour_speeds[hour], dtype=np.float64)
+        if len(self.cell_keys):
+            found = self.cell_keys[rows] == keys
+            speeds[found] = self.cell_speeds[rows[found], hour]
+        return speeds
+
+    def minutes_for_distance(self, distance_km: float, latitude: float, longitude: float, when: Optional[datetime] = None) -> float:
+        """Minutes to cover distance_km starting at (latitude, longitude)"""
+        hour = (when or datetime.utcnow()).hour
+        return distance_km / self.speed_kmh(latitude, longitude, hour) * 60
+
+    def estimate_minutes(self, from_lat: float, from_lon: float, to_lat: float, to_lon: float, when: Optional[datetime] = None) -> float:
+        distance = haversine_km(from_lat, from_lon, to_lat, to_lon)
+        return self.minutes_for_distance(distance, from_lat, from_lon, when)
+
+    def estimate_minutes_array(self, from_lats, from_lons, to_lats, to_lons, when: Optional[datetime] = None) -> np.ndarray:
+        """estimate_minutes for many trips at once"""
+        hour = (when or datetime.utcnow()).hour
+        distances = haversine_km_array(from_lats, from_lons, to_lats, to_lons)
+        return distances / self.speeds_kmh_array(from_lats, from_lons, hour) * 60
+
+    def estimate_arrival(self, driver_position: Optional[Tuple[float, float]], pickup_lat: float, pickup_lon: float) -> datetime:
+        """When a driver at driver_position would reach the pickup"""
+        now = datetime.utcnow()
+        if driver_position is None:
+            return now + timedelta(minutes=ETA_UNKNOWN_POSITION_MINUTES)
+        minutes = self.estimate_minutes(driver_position[0], driver_position[1], pickup_lat, pickup_lon, now)
+        return now + timedelta(minutes=minutes)
+
+    def learn(self, pickup_lats, pickup_lons, dest_lats, dest_lons, start_hours, durations_hours):
+        """Rebuild the speed tables from completed trips"""
+        pickup_lats = np.asarray(pickup_lats, dtype=np.float64)
+        pickup_lons = np.asarray(pickup_lons, dtype=np.float64)
+        start_hours = np.asarray(start_hours, dtype=np.int64)
+        durations = np.asarray(durations_hours, dtype=np.float64)
+        distances = haversine_km_array(pickup_lats, pickup_lons, dest_lats, dest_lons)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            speeds = distances / durations
+        valid = (distances >= MIN_TRIP_KM) & (durations > 0) & (speeds >= MIN_SPEED_KMH) & (speeds <= MAX_SPEED_KMH)
+        self.learn_totals(
+            np.floor(pickup_lats[valid] / self.cell_deg),
+            np.floor(pickup_lons[valid] / self.cell_deg),
+            start_hours[valid], distances[valid], durations[valid], np.ones(int(valid.sum()))
+        )
+
+    def learn_totals(self, cell_rows, cell_cols, hours, distances, durations, counts):
+        """
+        Rebuild the speed tables from valid trips already summed per pickup cell
+        and hour: total km, total hours and trip count. Slots may repeat.
+        """
+        cell_rows = np.asarray(cell_rows, dtype=np.float64).astype(np.int64)
+        cell_cols = np.asarray(cell_cols, dtype=np.float64).astype(np.int64)
+        hours = np.asarray(hours, dtype=np.float64).astype(np.int64)
+        distances = np.asarray(distances, dtype=np.float64)
+        durations = np.asarray(durations, dtype=np.float64)
+        counts = np.asarray(counts, dtype=np.float64)
+
+        # Distance-weighted mean speed: total km over total hours
+        hour_distance = np.bincount(hours, weights=distances, minlength=HOURS)
+        hour_duration = np.bincount(hours, weights=durations, minlength=HOURS)
+        hour_count = np.bincount(hours, weights=counts, minlength=HOURS)
+        hour_speeds = np.full(HOURS, ETA_DEFAULT_SPEED_KMH, dtype=np.float32)
+        enough = hour_count >= ETA_MIN_SAMPLES
+        hour_speeds[enough] = hour_distance[enough] / hour_duration[enough]
+
+        cell_keys, cell_index = np.unique(cell_rows * CELL_KEY_STRIDE + cell_cols, return_inverse=True)
+        slots = cell_index * HOURS + hours
+        size = len(cell_keys) * HOURS
+        slot_distance = np.bincount(slots, weights=distances, minlength=size).reshape(-1, HOURS)
+        slot_duration = np.bincount(slots, weights=durations, minlength=size).reshape(-1, HOURS)
+        slot_count = np.bincount(slots, weights=counts, minlength=size).reshape(-1, HOURS)
+        cell_speeds = np.tile(hour_speeds, (len(cell_keys), 1))
+        enough = slot_count >= ETA_MIN_SAMPLES
+        cell_speeds[enough] = slot_distance[enough] / slot_duration[enough]
+
+        # Only cells that differ from the hourly fallback somewhere need a row
+        keep = enough.any(axis=1)
+        self.hour_speeds = hour_speeds
+        self.cell_keys = cell_keys[keep]
+        self.cell_speeds = cell_speeds[keep].astype(np.float32)
+        self.cell_rows = {int(key): row for row, key in enumerate(self.cell_keys)}
+        self.sample_count = int(counts.sum())
+        self.loaded_at = datetime.utcnow()
+
+    def _totals_query(self, model, dialect: str):
+        """Valid completed trips of model summed per pickup cell and start hour, in SQL"""
+        pickup = aliased(Location)
+        destination = aliased(Location)
+        since = datetime.utcnow() - timedelta(days=ETA_HISTORY_DAYS)
+        if dialect == "sqlite":
+            duration = (func.julianday(model.completed_at) - func.julianday(model.started_at)) * 24
+        else:
+            duration = func.extract("epoch", model.completed_at - model.started_at) / 3600
+        trips = (
+            select(
+                func.floor(pickup.latitude / self.cell_deg).label("cell_row"),
+                func.floor(pickup.longitude / self.cell_deg).label("cell_col"),
+                func.extract("hour", model.started_at).label("hour"),
+                haversine_km_sql(
+                    pickup.latitude, pickup.longitude, destination.latitude, destination.longitude
+                ).label("distance"),
+                duration.label("duration")
+            )
+            .join(pickup, model.pickup_location_id == pickup.id)
+            .join(destination, model.destination_location_id == destination.id)
+            .where(
+                and_(
+                    model.status == RideStatus.COMPLETED,
+                    model.started_at.isnot(None),
+                    model.completed_at >= since
+                )
+            )
+            .subquery()
+        )
+        return (
+            select(
+                trips.c.cell_row, trips.c.cell_col, trips.c.hour,
+                func.sum(trips.c.distance), func.sum(trips.c.duration), func.count()
+            )
+            .where(
+                and_(
+                    trips.c.distance >= MIN_TRIP_KM,
+                    trips.c.duration > 0,
+                    trips.c.distance >= trips.c.duration * MIN_SPEED_KMH,
+                    trips.c.distance <= trips.c.duration * MAX_SPEED_KMH
+                )
+            )
+            .group_by(trips.c.cell_row, trips.c.cell_col, trips.c.hour)
+        )
+
+    async def reload(self):
+        """Relearn the speed tables from recently completed rides"""
+        totals = []
+        async with AsyncSessionLocal() as db:
+            dialect = db.get_bind().dialect.name
+            # Most history has already been moved to the archive; the database
+            # sums trips per cell and hour, so only those totals are loaded
+            for model in (Ride, RideArchive):
+                result = await db.execute(self._totals_query(model, dialect))
+                totals.extend(result.all())
+
+        if not totals:
+            self.learn_totals([], [], [], [], [], [])
+            return
+        self.learn_totals(*zip(*((
+            float(cell_row), float(cell_col), float(hour), float(distance), float(duration), count
+        ) for cell_row, cell_col, hour, distance, duration, count in totals)))
+        logger.info("Learned ETA speeds from %d trips in %d cells", self.sample_count, len(self.cell_keys))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(ETA_RELOAD_SECONDS)
+            try:
+                await self.reload()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("ETA speed table reload failed")
+
+
+eta_estimator = EtaEstimator()
@@ -0,0 +1,80 @@
+from sqlalchemy import func
+from typing import Tuple
+import math
+import numpy as np
+
+EARTH_RADIUS_KM = 6371
+KM_PER_DEGREE_LAT = 111.195  # EARTH_RADIUS_KM * pi / 180
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great-circle distance between two points in km"""
+    lat1, lon1 = math.radians(lat1), math.radians(lon1)
+    lat2, lon2 = math.radians(lat2), math.radians(lon2)
+
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+
+    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
+    c = 2 * math.asin(math.sqrt(a))
+    return EARTH_RADIUS_KM * c
+
+
+def bounding_box(latitude: float, longitude: float, radius_km: float) -> Tuple[float, float, float, float]:
+    """
+    (min_lat, max_lat, min_lon, max_lon) of a box containing every point within
+    radius_km. Does not wrap around the antimeridian.
+    """
+    lat_delta = radius_km / KM_PER_DEGREE_LAT
+    # Longitude degrees shrink with latitude; clamp so the poles stay finite
+    cos_lat = max(math.cos(math.radians(min(abs(latitude) + lat_delta, 89.0))), 0.01)
+    lon_delta = radius_km / (KM_PER_DEGREE_LAT * cos_lat)
+    return (latitude - lat_delta, latitude + lat_delta, longitude - lon_delta, longitude + lon_delta)
+
+
+def haversine_km_matrix(lats1, lons1, lats2, lons2) -> np.ndarray:
+    """
+    Pairwise great-circle distances in km between two point sets.
+    Same formula as haversine_km, vectorized to shape (len(lats1), len(lats2)).
+    """
+    lat1 = np.radians(np.asarray(lats1, dtype=np.float64))[:, np.newaxis]
+    lon1 = np.radians(np.asarray(lons1, dtype=np.float64))[:, np.newaxis]
+    lat2 = np.radians(np.asarray(lats2, dtype=np.float64))[np.newaxis, :]
+    lon2 = np.radians(np.asarray(lons2, dtype=np.float64))[np.newaxis, :]
+
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+
+    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
+    c = 2 * np.arcsin(np.sqrt(a))
+    return EARTH_RADIUS_KM * c
+
+
+def haversine_km_array(lats1, lons1, lats2, lons2) -> np.ndarray:
+    """
+    Element-wise great-circle distances in km between matching entries of
+    two equally long point arrays. Same formula as haversine_km.
+    """
+    lat1 = np.radians(np.asarray(lats1, dtype=np.float64))
+    lon1 = np.radians(np.asarray(lons1, dtype=np.float64))
+    lat2 = np.radians(np.asarray(lats2, dtype=np.float64))
+    lon2 = np.radians(np.asarray(lons2, dtype=np.float64))
+
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+
+    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
+    c = 2 * np.arcsin(np.sqrt(a))
+    return EARTH_RADIUS_KM * c
+
+
+def haversine_km_sql(lat1, lon1, lat2, lon2):
+    """
+    SQL expression for the great-circle distance in km between coordinate
+    columns. Same formula as haversine_km, for aggregating in the database.
+    """
+    to_radians = math.pi / 180
+    half_dlat = func.sin((lat2 - lat1) * (to_radians / 2))
+    half_dlon = func.sin((lon2 - lon1) * (to_radians / 2))
+    a = half_dlat * half_dlat + func.cos(lat1 * to_radians) * func.cos(lat2 * to_radians) * half_dlon * half_dlon
+    return 2 * EARTH_RADIUS_KM * func.asin(func.sqrt(a))
@@ -0,0 +1,34 @@
+from fastapi import Request, Response, status
+import hashlib
+
+# Single resources may be kept by the client but are revalidated with their ETag on every use
+REVALIDATE = "private, no-cache"
+
+
+def make_etag(*parts) -> str:
+    """Strong entity tag from the values a representation is derived from"""
+    digest = hashlib.blake2b("|".join(str(part) for part in parts).encode(), digest_size=8).hexdigest()
+    return f'"{digest}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Whether If-None-Match names etag, compared weakly as RFC 9110 asks for GET"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = {tag.strip() for tag in header.split(",")}
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+def cache_headers(etag: str) -> dict:
+    # Responses differ per user, so caches must key them on the token too
+    return {"ETag": etag, "Cache-Control": REVALIDATE, "Vary": "Authorization"}
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers(etag))
+
+
+def max_age(seconds: int) -> str:
+    """Cache-Control for responses without a validator, reused for a few seconds at most"""
+    return f"private, max-age={seconds}" if seconds > 0 else "no-store"
@@ -0,0 +1,90 @@
+from sqlalchemy import update
+from typing import Dict, Optional, Tuple
+import asyncio
+import logging
+import os
+from dotenv import load_dotenv
+
+from app.auth_cache import invalidate_user
+from app.database import AsyncSessionLocal
+from app.models import User
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# How often buffered driver positions are written to users.current_latitude/longitude
+LOCATION_FLUSH_SECONDS = float(os.getenv("LOCATION_FLUSH_SECONDS", "5"))
+
+
+class LocationWriter:
+    """
+    Write-behind buffer for driver positions streamed over the WebSocket.
+    Only the latest position per user is kept and all pending positions are
+    persisted in one bulk UPDATE per flush.
+    """
+
+    def __init__(self, flush_seconds: float = LOCATION_FLUSH_SECONDS):
+        self.flush_seconds = flush_seconds
+        # Map user_id to latest (latitude, longitude) not yet written
+        self.pending: Dict[str, Tuple[float, float]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self, user_id: str, latitude: float, longitude: float):
+        self.pending[user_id] = (latitude, longitude)
+
+    def discard(self, user_id: str):
+        """Forget a buffered position superseded by a direct database write"""
+        self.pending.pop(user_id, None)
+
+    async def flush(self) -> int:
+        """Persist all buffered positions and return how many users were written"""
+        if not self.pending:
+            return 0
+        batch, self.pending = self.pending, {}
+
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(
+                    update(User),
+                    [
+                        {"id": user_id, "current_latitude": latitude, "current_longitude": longitude}
+                        for user_id, (latitude, longitude) in batch.items()
+                    ]
+                )
+                await db.commit()
+            for user_id in batch:
+                invalidate_user(user_id)
+        except Exception:
+            # Put the batch back unless a newer position arrived meanwhile
+            for user_id, position in batch.items():
+                self.pending.setdefault(user_id, position)
+            raise
+        return len(batch)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Driver location flush failed")
+
+
+location_writer = LocationWriter()
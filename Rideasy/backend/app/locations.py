@@ -0,0 +1,238 @@
+from sqlalchemy import inspect, select, text, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime
+from typing import Dict, List, Sequence, Tuple
+import asyncio
+import os
+from dotenv import load_dotenv
+
+from app.auth_cache import TTLCache
+from app.models import Location
+
+load_dotenv()
+
+# Coordinates are rounded to this many decimals (5 is about 1.1 m) before
+# interning, so the same place requested twice maps to one row
+LOCATION_COORDINATE_DECIMALS = int(os.getenv("LOCATION_COORDINATE_DECIMALS", "5"))
+LOCATION_CACHE_MAX_ENTRIES = int(os.getenv("LOCATION_CACHE_MAX_ENTRIES", "10000"))
+LOCATION_CACHE_TTL_SECONDS = float(os.getenv("LOCATION_CACHE_TTL_SECONDS", "3600"))
+# Rows read and planned rewrites written per round trip while compacting
+COMPACTION_BATCH_SIZE = 1000
+
+LocationKey = Tuple[str, float, float]
+
+
+def location_key(name: str, latitude: float, longitude: float) -> LocationKey:
+    """Canonical (name, latitude, longitude) a location is interned under"""
+    return (
+        name.strip(),
+        round(latitude, LOCATION_COORDINATE_DECIMALS),
+        round(longitude, LOCATION_COORDINATE_DECIMALS),
+    )
+
+
+class LocationInterner:
+    """
+    Maps requested places to one canonical locations row each. Known rows
+    come from an in-process LRU; the rest are created with a single
+    INSERT ... ON CONFLICT DO NOTHING RETURNING for the whole batch, and
+    those that already existed are read with one SELECT.
+    """
+
+    def __init__(self):
+        # Location key to the canonical row as a dict of its columns
+        self.cache = TTLCache(LOCATION_CACHE_MAX_ENTRIES, LOCATION_CACHE_TTL_SECONDS)
+
+    async def resolve(self, db: AsyncSession, places: Sequence) -> Tuple[List[dict], Dict[LocationKey, dict]]:
+        """
+        Canonical rows for objects with name, latitude and longitude, in order.
+        Also returns the rows looked up in the database; pass them to remember()
+        once the transaction has committed, since a rollback can undo an insert.
+        """
+        keys = [location_key(place.name, place.latitude, place.longitude) for place in places]
+        found: Dict[LocationKey, dict] = {}
+        missing: List[LocationKey] = []
+        for key in keys:
+            if key in found or key in missing:
+                continue
+            row = self.cache.get(key)
+            if row is None:
+                missing.append(key)
+            else:
+                found[key] = row
+
+        fetched: Dict[LocationKey, dict] = {}
+        if missing:
+            fetched = await self._upsert(db, missing)
+            found.update(fetched)
+        return [found[key] for key in keys], fetched
+
+    def remember(self, rows: Dict[LocationKey, dict]):
+        for key, row in rows.items():
+            self.cache.set(key, row)
+
+    async def _upsert(self, db: AsyncSession, keys: List[LocationKey]) -> Dict[LocationKey, dict]:
+        dialect_insert = postgresql.insert if db.bind.dialect.name == "postgresql" else sqlite.insert
+        columns = (Location.id, Location.name, Location.latitude, Location.longitude, Location.created_at)
+        # Sorted, so concurrent rides inserting the same new places wait on them in
+        # the same order instead of deadlocking
+        keys = sorted(keys)
+        statement = dialect_insert(Location).values([
+            {"name": name, "latitude": latitude, "longitude": longitude}
+            for name, latitude, longitude in keys
+        ])
+        # DO NOTHING leaves existing rows unlocked and unwritten; they are read below
+        statement = statement.on_conflict_do_nothing(
+            index_elements=[Location.name, Location.latitude, Location.longitude]
+        ).returning(*columns)
+
+        result = await db.execute(statement)
+        rows = {(row.name, row.latitude, row.longitude): dict(row._mapping) for row in result}
+        existing = [key for key in keys if key not in rows]
+        if existing:
+            result = await db.execute(
+                select(*columns).where(tuple_(Location.name, Location.latitude, Location.longitude).in_(existing))
+            )
+            for row in result:
+                rows[(row.name, row.latitude, row.longitude)] = dict(row._mapping)
+        return rows
+
+
+location_interner = LocationInterner()
+
+
+def compact_locations(connection: Connection) -> Tuple[int, int]:
+    """
+    Merge locations rows that intern to the same key into the oldest one,
+    point rides (and archived rides) at the survivor and store every key the
+    way location_key() computes it, so compaction and the interner always
+    agree. Rides whose locations change get their version bumped so cached
+    copies are revalidated. Returns (rows merged, rides rewritten). Runs
+    inside the caller's transaction.
+    """
+    connection.execute(text(
+        "CREATE TEMPORARY TABLE location_merges (id VARCHAR PRIMARY KEY, canonical_id VARCHAR NOT NULL)"
+    ))
+    connection.execute(text(
+        "CREATE TEMPORARY TABLE location_fixes "
+        "(id VARCHAR PRIMARY KEY, name VARCHAR NOT NULL, latitude FLOAT NOT NULL, longitude FLOAT NOT NULL)"
+    ))
+    try:
+        merged = _plan_location_compaction(connection)
+
+        tables = ["rides"]
+        if inspect(connection).has_table("rides_archive"):
+            tables.append("rides_archive")
+        rewritten = 0
+        for table in tables:
+            # Run ahead of a deploy the schema may predate 0004 and 0005
+            if "version" in {column["name"] for column in inspect(connection).get_columns(table)}:
+                connection.execute(text(f"""
+                    UPDATE {table} SET version = version + 1
+                    WHERE pickup_location_id IN (SELECT id FROM location_merges UNION SELECT id FROM location_fixes)
+                       OR destination_location_id IN (SELECT id FROM location_merges UNION SELECT id FROM location_fixes)
+                """))
+            for column in ("pickup_location_id", "destination_location_id"):
+                rewritten += connection.execute(text(f"""
+                    UPDATE {table} SET {column} = (
+                        SELECT canonical_id FROM location_merges WHERE location_merges.id = {table}.{column}
+                    )
+                    WHERE {column} IN (SELECT id FROM location_merges)
+                """)).rowcount
+        connection.execute(text("DELETE FROM locations WHERE id IN (SELECT id FROM location_merges)"))
+
+        connection.execute(text("""
+            UPDATE locations SET
+                name = (SELECT name FROM location_fixes WHERE location_fixes.id = locations.id),
+                latitude = (SELECT latitude FROM location_fixes WHERE location_fixes.id = locations.id),
+                longitude = (SELECT longitude FROM location_fixes WHERE location_fixes.id = locations.id)
+            WHERE id IN (SELECT id FROM location_fixes)
+        """))
+    finally:
+        connection.execute(text("DROP TABLE location_merges"))
+        connection.execute(text("DROP TABLE location_fixes"))
+    return merged, rewritten
+
+
+def _plan_location_compaction(connection: Connection) -> int:
+    """
+    Fill location_merges (duplicate to canonical id) and location_fixes (the
+    key a canonical row should be stored under). Rows are read in latitude
+    order, a page at a time; rounding is monotonic, so every key lies within
+    one run of equal rounded latitudes and only that run is held in memory.
+    Returns the number of duplicates.
+    """
+    merges: List[dict] = []
+    fixes: List[dict] = []
+    merged = 0
+
+    def plan(group: list):
+        nonlocal merged
+        by_key: Dict[LocationKey, list] = {}
+        for row in group:
+            by_key.setdefault(location_key(row.name, row.latitude, row.longitude), []).append(row)
+        for key, rows in by_key.items():
+            canonical = min(rows, key=lambda row: (row.created_at or datetime.min, row.id))
+            merges.extend({"id": row.id, "canonical_id": canonical.id} for row in rows if row is not canonical)
+            merged += len(rows) - 1
+            if (canonical.name, canonical.latitude, canonical.longitude) != key:
+                fixes.append({"id": canonical.id, "name": key[0], "latitude": key[1], "longitude": key[2]})
+
+    def flush():
+        if merges:
+            connection.execute(
+                text("INSERT INTO location_merges (id, canonical_id) VALUES (:id, :canonical_id)"), merges
+            )
+            merges.clear()
+        if fixes:
+            connection.execute(
+                text("INSERT INTO location_fixes (id, name, latitude, longitude) VALUES (:id, :name, :latitude, :longitude)"),
+                fixes
+            )
+            fixes.clear()
+
+    group: list = []
+    group_latitude = None
+    after = None
+    while True:
+        # Keyset pages rather than a server-side cursor, which would stay open
+        # until the caller commits and block DDL later in the same transaction
+        query = (
+            select(Location.id, Location.name, Location.latitude, Location.longitude, Location.created_at)
+            .order_by(Location.latitude, Location.id)
+            .limit(COMPACTION_BATCH_SIZE)
+        )
+        if after is not None:
+            query = query.where(tuple_(Location.latitude, Location.id) > after)
+        page = connection.execute(query).all()
+        if not page:
+            break
+        for row in page:
+            latitude = round(row.latitude, LOCATION_COORDINATE_DECIMALS)
+            if group and latitude != group_latitude:
+                plan(group)
+                group = []
+            group.append(row)
+            group_latitude = latitude
+        after = tuple_(page[-1].latitude, page[-1].id)
+        if len(merges) + len(fixes) >= COMPACTION_BATCH_SIZE:
+            flush()
+    if group:
+        plan(group)
+    flush()
+    return merged
+
+
+async def main():
+    from app.database import engine
+
+    async with engine.begin() as conn:
+        merged, rewritten = await conn.run_sync(compact_locations)
+    await engine.dispose()
+    print(f"Merged {merged} duplicate locations, rewrote {rewritten} ride references")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,196 @@
+from sqlalchemy import select, update, and_
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime, timedelta
+from typing import List, Optional, Sequence, Tuple
+from scipy.optimize import linear_sum_assignment
+import asyncio
+import logging
+import numpy as np
+import os
+from dotenv import load_dotenv
+
+from app.database import AsyncSessionLocal
+from app.driver_index import driver_index
+from app.eta import eta_estimator
+from app.geo import haversine_km_matrix
+from app.models import Ride, Location, RideStatus
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# When enabled, create_ride leaves rides SEARCHING and the engine assigns them.
+# Off by default: every worker runs its own engine, repeating the solve
+BATCH_MATCHING_ENABLED = os.getenv("BATCH_MATCHING_ENABLED", "false").lower() == "true"
+MATCHING_TICK_SECONDS = float(os.getenv("MATCHING_TICK_SECONDS", "1.5"))
+# Pairs further apart than this are never assigned
+MATCHING_MAX_PICKUP_KM = float(os.getenv("MATCHING_MAX_PICKUP_KM", "15"))
+# Oldest rides first; the rest wait for the next tick so tick latency stays bounded
+MATCHING_MAX_BATCH = int(os.getenv("MATCHING_MAX_BATCH", "2000"))
+
+# RideResponse fields an assignment changes, sent to the rider as a delta
+ASSIGNMENT_FIELDS = {
+    "driver_id", "driver_name", "driver_rating", "status", "estimated_arrival", "updated_at", "version"
+}
+
+
+def solve_assignment(
+    ride_points: Sequence[Tuple[float, float]],
+    driver_points: Sequence[Tuple[float, float]],
+    max_pickup_km: float = MATCHING_MAX_PICKUP_KM,
+    driver_speeds_kmh: Optional[Sequence[float]] = None
+) -> List[Tuple[int, int, float]]:
+    """
+    Min-cost bipartite assignment of rides to drivers on pickup distance, or
+    on pickup time when each driver's expected speed is given.
+    Returns (ride_index, driver_index, distance_km) for every assigned pair.
+    """
+    if len(ride_points) == 0 or len(driver_points) == 0:
+        return []
+
+    rides = np.asarray(ride_points, dtype=np.float64)
+    drivers = np.asarray(driver_points, dtype=np.float64)
+    distances = haversine_km_matrix(rides[:, 0], rides[:, 1], drivers[:, 0], drivers[:, 1])
+
+    # Out-of-range pairs get a cost no in-range assignment can beat, and are
+    # dropped afterwards, so they never displace a feasible pair
+    infeasible = distances > max_pickup_km
+    if driver_speeds_kmh is None:
+        cost, max_cost = distances, max_pickup_km
+    else:
+        speeds = np.asarray(driver_speeds_kmh, dtype=np.float64)
+        cost, max_cost = distances / speeds[np.newaxis, :], max_pickup_km / speeds.min()
+    cost = np.where(infeasible, max_cost * (min(rides.shape[0], drivers.shape[0]) + 1), cost)
+
+    ride_rows, driver_cols = linear_sum_assignment(cost)
+    feasible = ~infeasible[ride_rows, driver_cols]
+    return [
+        (int(row), int(col), float(distances[row, col]))
+        for row, col in zip(ride_rows[feasible], driver_cols[feasible])
+    ]
+
+
+class MatchingEngine:
+    """Periodically assigns all SEARCHING rides to free drivers in one batch"""
+
+    def __init__(self, tick_seconds: float = MATCHING_TICK_SECONDS):
+        self.tick_seconds = tick_seconds
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_tick()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Matching tick failed")
+            await asyncio.sleep(self.tick_seconds)
+
+    async def run_tick(self) -> int:
+        """Run one assignment round and return the number of rides matched"""
+        # Imported here to avoid a circular import with the rides router
+        from app.routers.rides import is_active_ride_conflict, rides_to_responses
+        from app.routers.websocket import manager
+
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(Ride.id, Location.latitude, Location.longitude)
+                .join(Location, Ride.pickup_location_id == Location.id)
+                .where(Ride.status == RideStatus.SEARCHING)
+                .order_by(Ride.created_at)
+                .limit(MATCHING_MAX_BATCH)
+            )
+            searching = result.all()
+            free_drivers = driver_index.free_drivers()
+            if not searching or not free_drivers:
+                return 0
+
+            # Assign on expected pickup time rather than raw distance
+            now = datetime.utcnow()
+            driver_speeds = eta_estimator.speeds_kmh_array(
+                [latitude for _, latitude, _ in free_drivers],
+                [longitude for _, _, longitude in free_drivers],
+                now.hour
+            )
+            loop = asyncio.get_running_loop()
+            pairs = await loop.run_in_executor(
+                None,
+                solve_assignment,
+                [(latitude, longitude) for _, latitude, longitude in searching],
+                [(latitude, longitude) for _, latitude, longitude in free_drivers],
+                MATCHING_MAX_PICKUP_KM,
+                driver_speeds
+            )
+
+            matched: List[Tuple[str, str]] = []
+            for ride_idx, driver_idx, distance in pairs:
+                ride_id = searching[ride_idx][0]
+                driver_id = free_drivers[driver_idx][0]
+                estimated_arrival = now + timedelta(minutes=distance / driver_speeds[driver_idx] * 60)
+                # The driver may have accepted a ride while we were solving
+                if not driver_index.is_free(driver_id):
+                    continue
+                driver_index.mark_busy(driver_id)
+
+                # Conditional update so a concurrent accept or cancel wins. Each
+                # pair commits on its own: holding every claimed row until the
+                # end of the batch would deadlock with accepts locking the same
+                # rides and drivers in another order. The driver is freed again
+                # on every path but a successful claim, failures included
+                stays_busy = False
+                try:
+                    result = await db.execute(
+                        update(Ride)
+                        .where(and_(Ride.id == ride_id, Ride.status == RideStatus.SEARCHING))
+                        .values(
+                            driver_id=driver_id,
+                            status=RideStatus.MATCHED,
+                            estimated_arrival=estimated_arrival,
+                            version=Ride.version + 1
+                        )
+                        .execution_options(synchronize_session=False)
+                    )
+                    await db.commit()
+                    stays_busy = result.rowcount == 1
+                except IntegrityError as e:
+                    # The index was stale and the driver already holds an active ride
+                    stays_busy = is_active_ride_conflict(e)
+                    await db.rollback()
+                    continue
+                finally:
+                    if not stays_busy:
+                        driver_index.mark_free(driver_id)
+                if stays_busy:
+                    matched.append((ride_id, driver_id))
+
+            if not matched:
+                return 0
+
+            # Notify riders of the assignment and drivers of the whole ride
+            ride_responses = await rides_to_responses(
+                select(Ride).where(Ride.id.in_([ride_id for ride_id, _ in matched])),
+                db
+            )
+            for ride_response in ride_responses:
+                await manager.send_ride_update(ride_response.rider_id, ride_response, ASSIGNMENT_FIELDS)
+                await manager.send_ride_update(ride_response.driver_id, ride_response)
+
+        logger.info("Matching tick assigned %d of %d rides", len(matched), len(searching))
+        return len(matched)
+
+
+matching_engine = MatchingEngine()
@@ -0,0 +1,316 @@
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool
+from bisect import bisect_left
+from collections import defaultdict
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+import asyncio
+import os
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+# Requests outside any route (404s) and work outside any request share one label
+# each, so label cardinality stays bounded by the number of routes
+UNMATCHED_ROUTE = "unmatched"
+BACKGROUND_ROUTE = "background"
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Labels, float] = defaultdict(float)
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        self.values[labels] += amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Sequence[float], labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        # Map labels to [per-bucket counts (last is +Inf), sum]
+        self.series: Dict[Labels, list] = {}
+
+    def observe(self, value: float, *labels: str):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labelnames + ("le",)
+        for labels, (counts, total) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(names, labels + (le,))} {cumulative}")
+            base = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{base} {_format_value(total)}")
+            lines.append(f"{self.name}_count{base} {cumulative}")
+        return lines
+
+
+class CallbackMetric:
+    """Gauge or counter whose value is read from elsewhere at scrape time"""
+
+    def __init__(self, name: str, kind: str, help: str, callback: Callable[[], float]):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.callback = callback
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.kind}",
+            f"{self.name} {_format_value(self.callback())}",
+        ]
+
+
+class Registry:
+    """Metrics of this process, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self.metrics: Dict[str, object] = {}
+
+    def _register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float], labelnames: Sequence[str] = ()) -> Histogram:
+        return self._register(Histogram(name, help, buckets, labelnames))
+
+    def gauge_callback(self, name: str, help: str, callback: Callable[[], float]):
+        self._register(CallbackMetric(name, "gauge", help, callback))
+
+    def counter_callback(self, name: str, help: str, callback: Callable[[], float]):
+        self._register(CallbackMetric(name, "counter", help, callback))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.counter(
+    "rideasy_http_requests_total", "HTTP requests by route template and status code",
+    ("method", "route", "status")
+)
+http_request_duration = registry.histogram(
+    "rideasy_http_request_duration_seconds", "HTTP request latency", LATENCY_BUCKETS, ("method", "route")
+)
+db_statements_per_request = registry.histogram(
+    "rideasy_db_statements_per_request", "SQL statements executed per HTTP request", STATEMENT_BUCKETS,
+    ("method", "route")
+)
+db_statements = registry.counter(
+    "rideasy_db_statements_total", "SQL statements executed", ("route",)
+)
+db_seconds = registry.counter(
+    "rideasy_db_seconds_total", "Time spent executing SQL statements", ("route",)
+)
+db_pool_wait_seconds = registry.counter(
+    "rideasy_db_pool_wait_seconds_total", "Time spent waiting for a pooled database connection", ("route",)
+)
+db_pool_wait = registry.histogram(
+    "rideasy_db_pool_wait_seconds", "Wait for a pooled database connection", LATENCY_BUCKETS
+)
+
+
+@dataclass
+class RequestMetrics:
+    """Database work attributed to the HTTP request being handled"""
+    scope: dict
+    statements: int = 0
+    db_seconds: float = 0.0
+    pool_wait_seconds: float = 0.0
+
+
+current_request: ContextVar[Optional[RequestMetrics]] = ContextVar("current_request", default=None)
+
+
+def background_task(coroutine: Awaitable) -> asyncio.Task:
+    """
+    Run coroutine as a task whose database work counts as background. A task
+    copies the context it is created in, so one started while handling a
+    request would otherwise keep adding to that request's metrics after the
+    middleware has recorded them, and its work would never be counted.
+    """
+    async def run():
+        current_request.set(None)
+        return await coroutine
+
+    return asyncio.get_running_loop().create_task(run())
+
+# Endpoint function to the path template it is mounted at
+_route_paths: Dict[Callable, str] = {}
+# Called with every pool checkout wait, for components that react to pool saturation
+pool_wait_observers: List[Callable[[float], None]] = []
+
+
+def route_template(scope: dict) -> str:
+    """Path template of the route handling a request, once the router has matched it"""
+    # The router fills in the endpoint on the scope it was given
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return UNMATCHED_ROUTE
+    path = _route_paths.get(endpoint)
+    if path is None:
+        for route in scope["app"].routes:
+            if getattr(route, "endpoint", None) is endpoint:
+                path = route.path
+                break
+        else:
+            path = UNMATCHED_ROUTE
+        _route_paths[endpoint] = path
+    return path
+
+
+def _record_pool_wait(elapsed: float):
+    db_pool_wait.observe(elapsed)
+    for observer in pool_wait_observers:
+        observer(elapsed)
+    request = current_request.get()
+    if request is None:
+        db_pool_wait_seconds.inc(BACKGROUND_ROUTE, amount=elapsed)
+    else:
+        request.pool_wait_seconds += elapsed
+
+
+class _TimedCheckout:
+    """Pool mixin that times how long getting a connection takes"""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            _record_pool_wait(time.perf_counter() - started)
+
+
+class TimedQueuePool(_TimedCheckout, AsyncAdaptedQueuePool):
+    pass
+
+
+class TimedNullPool(_TimedCheckout, NullPool):
+    pass
+
+
+def instrument_engine(engine: Engine):
+    """Count statements and time spent in them, per request or as background work"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        request = current_request.get()
+        if request is None:
+            db_statements.inc(BACKGROUND_ROUTE)
+            db_seconds.inc(BACKGROUND_ROUTE, amount=elapsed)
+        else:
+            request.statements += 1
+            request.db_seconds += elapsed
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        # A failed statement never reaches after_cursor_execute
+        if exception_context.connection is not None:
+            started = exception_context.connection.info.get("query_started")
+            if started:
+                started.pop()
+
+    pool = engine.pool
+    if hasattr(pool, "checkedout"):
+        registry.gauge_callback(
+            "rideasy_db_pool_checked_out", "Database connections currently checked out", pool.checkedout
+        )
+        registry.gauge_callback(
+            "rideasy_db_pool_idle", "Open database connections idle in the pool", pool.checkedin
+        )
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording latency, SQL statements, DB time and pool wait
+    per route template. Plain ASGI rather than BaseHTTPMiddleware so
+    streamed responses are timed to their last byte.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        request = RequestMetrics(scope)
+        token = current_request.set(request)
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            current_request.reset(token)
+            route = route_template(scope)
+            method = scope["method"]
+            http_requests.inc(method, route, str(status_code))
+            http_request_duration.observe(elapsed, method, route)
+            db_statements_per_request.observe(request.statements, method, route)
+            db_statements.inc(route, amount=request.statements)
+            db_seconds.inc(route, amount=request.db_seconds)
+            db_pool_wait_seconds.inc(route, amount=request.pool_wait_seconds)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Float, DateTime, ForeignKey, Enum as SQLEnum, Boolean
+from sqlalchemy import Column, String, Float, Integer, DateTime, ForeignKey, Enum as SQLEnum, Boolean, Index, and_
 from sqlalchemy.orm import relationship
 from datetime import datetime
 import uuid
@@ -21,6 +21,20 @@ class RideStatus(str, enum.Enum):
     CANCELLED = "cancelled"
 
 
+# A rider or driver can be part of at most one ride in these states
+ACTIVE_RIDE_STATUSES = (
+    RideStatus.SEARCHING,
+    RideStatus.MATCHED,
+    RideStatus.DRIVER_ARRIVING,
+    RideStatus.IN_PROGRESS,
+)
+# Rides in these states never change again and can be archived
+TERMINAL_RIDE_STATUSES = (
+    RideStatus.COMPLETED,
+    RideStatus.CANCELLED,
+)
+
+
 class User(Base):
     __tablename__ = "users"
 
@@ -38,6 +52,17 @@ class User(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    __table_args__ = (
+        # Online drivers, scanned when the driver index is rebuilt. Kept off the
+        # position columns so streamed location writes stay HOT updates
+        Index(
+            "ix_users_online_drivers",
+            "id",
+            postgresql_where=and_(is_online == True, user_mode == UserMode.DRIVER),
+            sqlite_where=and_(is_online == True, user_mode == UserMode.DRIVER),
+        ),
+    )
+
     # Relationships
     rides_as_rider = relationship("Ride", foreign_keys="Ride.rider_id", back_populates="rider")
     rides_as_driver = relationship("Ride", foreign_keys="Ride.driver_id", back_populates="driver")
@@ -52,6 +77,13 @@ class Location(Base):
     longitude = Column(Float, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        # Bounding-box prefilter for nearby pickups
+        Index("ix_locations_latitude_longitude", "latitude", "longitude"),
+        # Interning key, coordinates are rounded before insert (see app/locations.py)
+        Index("uq_locations_name_latitude_longitude", "name", "latitude", "longitude", unique=True),
+    )
+
 
 class Ride(Base):
     __tablename__ = "rides"
@@ -68,6 +100,33 @@ class Ride(Base):
     completed_at = Column(DateTime, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Incremented by every change, so clients can order updates and drop stale ones
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+
+    __table_args__ = (
+        Index("ix_rides_rider_id_status", "rider_id", "status"),
+        Index("ix_rides_driver_id_status", "driver_id", "status"),
+        # Ride history is read newest first per rider or driver, keyset on (created_at, id)
+        Index("ix_rides_rider_id_created_at_id", "rider_id", "created_at", "id"),
+        Index("ix_rides_driver_id_created_at_id", "driver_id", "created_at", "id"),
+        # Matching engine scans SEARCHING rides oldest first
+        Index("ix_rides_status_created_at", "status", "created_at"),
+        # One active ride per rider and per driver; NULL driver_ids never conflict
+        Index(
+            "uq_rides_active_rider",
+            "rider_id",
+            unique=True,
+            postgresql_where=status.in_(ACTIVE_RIDE_STATUSES),
+            sqlite_where=status.in_(ACTIVE_RIDE_STATUSES),
+        ),
+        Index(
+            "uq_rides_active_driver",
+            "driver_id",
+            unique=True,
+            postgresql_where=status.in_(ACTIVE_RIDE_STATUSES),
+            sqlite_where=status.in_(ACTIVE_RIDE_STATUSES),
+        ),
+    )
 
     # Relationships
     rider = relationship("User", foreign_keys=[rider_id], back_populates="rides_as_rider")
@@ -75,3 +134,37 @@ class Ride(Base):
     pickup_location = relationship("Location", foreign_keys=[pickup_location_id])
     destination_location = relationship("Location", foreign_keys=[destination_location_id])
 
+
+class RideArchive(Base):
+    """
+    Completed and cancelled rides moved out of rides by the archiver (see
+    app/ride_archiver.py), so the rides table only holds the hot set.
+    Same columns as Ride.
+    """
+    __tablename__ = "rides_archive"
+
+    id = Column(String, primary_key=True)
+    rider_id = Column(String, ForeignKey("users.id"), nullable=False)
+    driver_id = Column(String, ForeignKey("users.id"), nullable=True)
+    pickup_location_id = Column(String, ForeignKey("locations.id"), nullable=False)
+    destination_location_id = Column(String, ForeignKey("locations.id"), nullable=False)
+    status = Column(SQLEnum(RideStatus))
+    fare = Column(Float, nullable=True)
+    estimated_arrival = Column(DateTime, nullable=True)
+    started_at = Column(DateTime, nullable=True)
+    completed_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime)
+    updated_at = Column(DateTime)
+    version = Column(Integer, nullable=False, server_default="1")
+
+    __table_args__ = (
+        # Ride history is read newest first per rider or driver, keyset on (created_at, id)
+        Index("ix_rides_archive_rider_id_created_at_id", "rider_id", "created_at", "id"),
+        Index("ix_rides_archive_driver_id_created_at_id", "driver_id", "created_at", "id"),
+    )
+
+    # Relationships, named as on Ride so both serialize the same way
+    rider = relationship("User", foreign_keys=[rider_id])
+    driver = relationship("User", foreign_keys=[driver_id])
+    pickup_location = relationship("Location", foreign_keys=[pickup_location_id])
+    destination_location = relationship("Location", foreign_keys=[destination_location_id])
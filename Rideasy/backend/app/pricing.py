@@ -0,0 +1,28 @@
+from datetime import datetime
+from typing import Tuple
+import numpy as np
+
+from app.eta import eta_estimator
+from app.geo import haversine_km, haversine_km_array
+
+# Base fare + per km rate, shared by single fares and batch quotes
+BASE_FARE = 2.50
+PER_KM_RATE = 1.50
+
+
+def calculate_fare(pickup_lat: float, pickup_lon: float, dest_lat: float, dest_lon: float) -> float:
+    distance = haversine_km(pickup_lat, pickup_lon, dest_lat, dest_lon)
+    fare = BASE_FARE + (distance * PER_KM_RATE)
+    return round(fare, 2)
+
+
+def calculate_quotes(pickup_lats, pickup_lons, dest_lats, dest_lons) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Distance in km, fare and trip duration in minutes for many
+    pickup/destination pairs at once. Fares match calculate_fare.
+    """
+    distances = haversine_km_array(pickup_lats, pickup_lons, dest_lats, dest_lons)
+    fares = np.round(BASE_FARE + distances * PER_KM_RATE, 2)
+    hour = datetime.utcnow().hour
+    durations = distances / eta_estimator.speeds_kmh_array(pickup_lats, pickup_lons, hour) * 60
+    return distances, fares, durations
@@ -0,0 +1,165 @@
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+from typing import Callable, Optional, Set
+import asyncio
+import logging
+import orjson
+import os
+from dotenv import load_dotenv
+
+from app.database import engine
+from app.metrics import background_task
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# "memory" for a single process, "postgres" to fan out across workers and hosts
+PUBSUB_BACKEND = os.getenv("PUBSUB_BACKEND", "memory")
+# Namespaces LISTEN/NOTIFY channels when several apps share a database
+PUBSUB_CHANNEL_PREFIX = os.getenv("PUBSUB_CHANNEL_PREFIX", "rideasy_")
+PUBSUB_RECONNECT_SECONDS = float(os.getenv("PUBSUB_RECONNECT_SECONDS", "2"))
+
+MessageHandler = Callable[[str, dict], None]
+
+
+class PubSub:
+    """
+    Channel-based message bus. Every process subscribes only to the channels
+    its local sockets need and receives each published message once per
+    subscribed process through the handler.
+    """
+
+    def __init__(self):
+        self.handler: Optional[MessageHandler] = None
+        self.channels: Set[str] = set()
+
+    def set_handler(self, handler: MessageHandler):
+        self.handler = handler
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def subscribe(self, channel: str):
+        self.channels.add(channel)
+
+    async def unsubscribe(self, channel: str):
+        self.channels.discard(channel)
+
+    async def publish(self, channel: str, message: dict):
+        raise NotImplementedError
+
+
+class InProcessPubSub(PubSub):
+    """Delivers straight to the local handler; only correct with a single worker"""
+
+    async def publish(self, channel: str, message: dict):
+        if channel in self.channels and self.handler is not None:
+            self.handler(channel, message)
+
+
+class PostgresPubSub(PubSub):
+    """
+    LISTEN/NOTIFY on the shared asyncpg engine. One pooled connection is held
+    for LISTEN; publishing borrows a pooled connection per NOTIFY. Payloads
+    must stay under Postgres' 8000 byte NOTIFY limit.
+    """
+
+    def __init__(self, engine: AsyncEngine, prefix: str = PUBSUB_CHANNEL_PREFIX):
+        super().__init__()
+        self.engine = engine
+        self.prefix = prefix
+        self._connection: Optional[AsyncConnection] = None
+        # Raw asyncpg connection the LISTENs are registered on
+        self._listener = None
+        self._reconnect_task: Optional[asyncio.Task] = None
+        self._stopping = False
+        # Bind once so remove_listener sees the same callback
+        self._callback = self._on_notify
+
+    async def start(self):
+        self._stopping = False
+        self._connection = await self.engine.connect()
+        raw_connection = await self._connection.get_raw_connection()
+        self._listener = raw_connection.driver_connection
+        self._listener.add_termination_listener(self._on_terminated)
+        for channel in self.channels:
+            await self._listener.add_listener(self.prefix + channel, self._callback)
+
+    async def stop(self):
+        self._stopping = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+        await self._release()
+
+    async def _release(self):
+        self._listener = None
+        if self._connection is not None:
+            try:
+                await self._connection.close()
+            except Exception:
+                pass
+            self._connection = None
+
+    async def subscribe(self, channel: str):
+        if channel in self.channels:
+            return
+        self.channels.add(channel)
+        if self._listener is not None:
+            await self._listener.add_listener(self.prefix + channel, self._callback)
+
+    async def unsubscribe(self, channel: str):
+        if channel not in self.channels:
+            return
+        self.channels.discard(channel)
+        if self._listener is not None:
+            await self._listener.remove_listener(self.prefix + channel, self._callback)
+
+    async def publish(self, channel: str, message: dict):
+        async with self.engine.connect() as conn:
+            await conn.execute(
+                text("SELECT pg_notify(:channel, :payload)"),
+                {"channel": self.prefix + channel, "payload": orjson.dumps(message).decode()}
+            )
+            await conn.commit()
+
+    def _on_notify(self, connection, pid: int, pg_channel: str, payload: str):
+        if self.handler is None:
+            return
+        try:
+            self.handler(pg_channel[len(self.prefix):], orjson.loads(payload))
+        except Exception:
+            logger.exception("Failed to handle notification on %s", pg_channel)
+
+    def _on_terminated(self, connection):
+        if self._stopping or self._reconnect_task is not None:
+            return
+        logger.warning("LISTEN connection lost, reconnecting")
+        self._reconnect_task = background_task(self._reconnect())
+
+    async def _reconnect(self):
+        try:
+            await self._release()
+            while not self._stopping:
+                try:
+                    await self.start()
+                    logger.info("LISTEN connection restored")
+                    return
+                except Exception:
+                    logger.exception("LISTEN reconnect failed")
+                    await self._release()
+                    await asyncio.sleep(PUBSUB_RECONNECT_SECONDS)
+        finally:
+            self._reconnect_task = None
+
+
+def create_pubsub(backend: str = PUBSUB_BACKEND) -> PubSub:
+    if backend == "memory":
+        return InProcessPubSub()
+    if backend == "postgres":
+        return PostgresPubSub(engine)
+    raise ValueError(f"Unknown PUBSUB_BACKEND: {backend}")
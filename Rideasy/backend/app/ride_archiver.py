@@ -0,0 +1,98 @@
+from sqlalchemy import select, insert, delete, and_
+from datetime import datetime, timedelta
+from typing import Optional
+import asyncio
+import logging
+import os
+from dotenv import load_dotenv
+
+from app.database import AsyncSessionLocal
+from app.models import Ride, RideArchive, TERMINAL_RIDE_STATUSES
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+RIDES_ARCHIVE_ENABLED = os.getenv("RIDES_ARCHIVE_ENABLED", "true").lower() == "true"
+# Completed and cancelled rides created longer ago than this are archived
+RIDES_ARCHIVE_AFTER_HOURS = float(os.getenv("RIDES_ARCHIVE_AFTER_HOURS", "24"))
+RIDES_ARCHIVE_INTERVAL_SECONDS = float(os.getenv("RIDES_ARCHIVE_INTERVAL_SECONDS", "300"))
+# Rides moved per transaction, so locks and WAL bursts stay small
+RIDES_ARCHIVE_BATCH_SIZE = int(os.getenv("RIDES_ARCHIVE_BATCH_SIZE", "1000"))
+
+RIDE_COLUMNS = [column.key for column in Ride.__table__.columns]
+
+
+class RideArchiver:
+    """Periodically moves terminal rides from rides to rides_archive in batches"""
+
+    def __init__(self, interval_seconds: float = RIDES_ARCHIVE_INTERVAL_SECONDS):
+        self.interval_seconds = interval_seconds
+        self._task: Optional[asyncio.Task] = None
+
+    async def archive_batch(self, cutoff: datetime, batch_size: int = RIDES_ARCHIVE_BATCH_SIZE) -> int:
+        """Move up to batch_size terminal rides created before cutoff and return how many moved"""
+        archivable = and_(Ride.status.in_(TERMINAL_RIDE_STATUSES), Ride.created_at < cutoff)
+        async with AsyncSessionLocal() as db:
+            # Skip rows another worker is archiving right now
+            result = await db.execute(
+                select(Ride.id)
+                .where(archivable)
+                .order_by(Ride.created_at)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            ride_ids = result.scalars().all()
+            if not ride_ids:
+                return 0
+
+            await db.execute(
+                insert(RideArchive).from_select(
+                    RIDE_COLUMNS,
+                    select(*[getattr(Ride, column) for column in RIDE_COLUMNS]).where(Ride.id.in_(ride_ids))
+                )
+            )
+            await db.execute(delete(Ride).where(Ride.id.in_(ride_ids)))
+            await db.commit()
+        return len(ride_ids)
+
+    async def archive(self) -> int:
+        """Archive every eligible ride, one batch per transaction"""
+        cutoff = datetime.utcnow() - timedelta(hours=RIDES_ARCHIVE_AFTER_HOURS)
+        total = 0
+        while True:
+            moved = await self.archive_batch(cutoff)
+            total += moved
+            if moved < RIDES_ARCHIVE_BATCH_SIZE:
+                break
+            # Let request handlers in between batches
+            await asyncio.sleep(0)
+        if total:
+            logger.info("Archived %d rides", total)
+        return total
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.archive()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Ride archiving failed")
+            await asyncio.sleep(self.interval_seconds)
+
+
+ride_archiver = RideArchiver()
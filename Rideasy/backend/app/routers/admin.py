@@ -0,0 +1,19 @@
+from fastapi import APIRouter, Depends, Query, status
+from typing import List
+
+from app.dependencies import require_admin
+from app.schemas import SlowQueryResponse
+from app.slow_queries import SLOW_QUERY_LOG_ENABLED, slow_query_log
+
+router = APIRouter(dependencies=[Depends(require_admin)])
+
+
+@router.get("/slow-queries", response_model=List[SlowQueryResponse])
+async def get_slow_queries(limit: int = Query(50, ge=1, le=1000)):
+    """Slow statements recorded by this worker, newest first"""
+    return slow_query_log.recent(limit) if SLOW_QUERY_LOG_ENABLED else []
+
+
+@router.delete("/slow-queries", status_code=status.HTTP_204_NO_CONTENT)
+async def clear_slow_queries():
+    slow_query_log.clear()
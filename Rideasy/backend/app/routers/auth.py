@@ -1,17 +1,35 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
-from passlib.context import CryptContext
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+from typing import Optional
+import asyncio
 import bcrypt
+import os
+from dotenv import load_dotenv
 
 from app.database import get_db
 from app.models import User
 from app.schemas import UserCreate, UserLogin, Token, UserResponse
 from app.dependencies import create_access_token, get_current_active_user
 
+load_dotenv()
+
 router = APIRouter()
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+# bcrypt cost factor for new hashes; existing hashes keep the cost they were created with
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# Threads hashing concurrently (bcrypt releases the GIL); 0 hashes inline on the event loop
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+# How long a request may wait for a free hashing thread before getting a 503
+PASSWORD_HASH_QUEUE_TIMEOUT_SECONDS = float(os.getenv("PASSWORD_HASH_QUEUE_TIMEOUT_SECONDS", "2"))
+
+_hash_executor = (
+    ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+    if PASSWORD_HASH_WORKERS > 0 else None
+)
+_hash_slots: Optional[asyncio.Semaphore] = None
 
 
 def _prepare_password_for_bcrypt(password: str) -> bytes:
@@ -30,19 +48,9 @@ def _prepare_password_for_bcrypt(password: str) -> bytes:
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """
     Verify a password against a hash.
-    Uses bcrypt directly to avoid passlib validation issues.
+    Uses bcrypt directly; it reads the $2a$/$2b$ hashes passlib produced as well.
     """
     password_bytes = _prepare_password_for_bcrypt(plain_password)
-    
-    # Try passlib first (for existing hashes)
-    try:
-        # Decode bytes back to string for passlib
-        password_str = password_bytes.decode('utf-8', errors='ignore')
-        return pwd_context.verify(password_str, hashed_password)
-    except (ValueError, UnicodeDecodeError):
-        pass
-    
-    # Fallback to direct bcrypt
     try:
         return bcrypt.checkpw(password_bytes, hashed_password.encode('utf-8'))
     except Exception:
@@ -58,11 +66,52 @@ def get_password_hash(password: str) -> str:
     password_bytes = _prepare_password_for_bcrypt(password)
     
     # Use bcrypt directly to avoid passlib's length validation
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
     hashed = bcrypt.hashpw(password_bytes, salt)
     return hashed.decode('utf-8')
 
 
+def _release_if_acquired(acquire: asyncio.Future):
+    if not acquire.cancelled() and acquire.exception() is None:
+        _hash_slots.release()
+
+
+async def run_password_hashing(func, *args):
+    """
+    Run a bcrypt function on the hashing thread pool so it does not block the
+    event loop. At most PASSWORD_HASH_WORKERS calls run at once; callers that
+    cannot get a slot within the queue timeout get a 503.
+    """
+    global _hash_slots
+    if _hash_executor is None:
+        return func(*args)
+    if _hash_slots is None:
+        _hash_slots = asyncio.Semaphore(PASSWORD_HASH_WORKERS)
+    
+    acquire = asyncio.ensure_future(_hash_slots.acquire())
+    acquired = False
+    try:
+        done, _ = await asyncio.wait({acquire}, timeout=PASSWORD_HASH_QUEUE_TIMEOUT_SECONDS)
+        acquired = bool(done)
+    finally:
+        if not acquired:
+            # The acquire may win the race against the timeout or the request being
+            # cancelled; hand such a slot straight back instead of leaking it
+            acquire.cancel()
+            acquire.add_done_callback(_release_if_acquired)
+    if not acquired:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Authentication is busy, please retry",
+            headers={"Retry-After": "1"},
+        )
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_hash_executor, func, *args)
+    finally:
+        _hash_slots.release()
+
+
 @router.post("/register", response_model=Token, status_code=status.HTTP_201_CREATED)
 async def register(user_data: UserCreate, db: AsyncSession = Depends(get_db)):
     # Check if user already exists
@@ -83,7 +132,7 @@ async def register(user_data: UserCreate, db: AsyncSession = Depends(get_db)):
         )
     
     # Create new user
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await run_password_hashing(get_password_hash, user_data.password)
     new_user = User(
         email=user_data.email,
         username=user_data.username,
@@ -112,7 +161,7 @@ async def login(credentials: UserLogin, db: AsyncSession = Depends(get_db)):
     result = await db.execute(select(User).where(User.email == credentials.email))
     user = result.scalar_one_or_none()
     
-    if not user or not verify_password(credentials.password, user.hashed_password):
+    if not user or not await run_password_hashing(verify_password, credentials.password, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
@@ -1,40 +1,77 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, and_, or_
+from sqlalchemy import select, insert, update, and_, or_, tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased, joinedload
 from datetime import datetime, timedelta
-from typing import List
+from typing import AsyncIterator, List, Optional, Set, Tuple
+import base64
+import json
 import math
+import os
+import uuid
 
-from app.database import get_db
-from app.models import User, Ride, Location, RideStatus
+from app.database import get_db, AsyncSessionLocal
+from app.dispatch import RIDE_OFFERS_ENABLED, ride_dispatcher
+from app.driver_index import driver_index
+from app.eta import eta_estimator
+from app.geo import haversine_km, bounding_box
+from app.http_cache import cache_headers, etag_matches, make_etag, max_age, not_modified
+from app.locations import location_interner
+from app.matching import ASSIGNMENT_FIELDS, BATCH_MATCHING_ENABLED
+from app.pricing import calculate_fare, calculate_quotes
+from app.models import User, Ride, RideArchive, Location, RideStatus, ACTIVE_RIDE_STATUSES
 from app.schemas import (
-    RideCreate, RideResponse, RideUpdate, UserResponse
+    RideCreate, RideResponse, RideUpdate, UserResponse, QuoteRequest, QuoteResponse
 )
 from app.dependencies import get_current_active_user
 from app.routers.websocket import manager
 
 router = APIRouter()
 
-# Simple fare calculation based on distance
-def calculate_fare(pickup_lat: float, pickup_lon: float, dest_lat: float, dest_lon: float) -> float:
-    # Haversine formula for distance calculation
-    R = 6371  # Earth radius in km
-    lat1, lon1 = math.radians(pickup_lat), math.radians(pickup_lon)
-    lat2, lon2 = math.radians(dest_lat), math.radians(dest_lon)
-    
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-    
-    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-    c = 2 * math.asin(math.sqrt(a))
-    distance = R * c
-    
-    # Base fare + per km rate
-    base_fare = 2.50
-    per_km_rate = 1.50
-    fare = base_fare + (distance * per_km_rate)
-    
-    return round(fare, 2)
+# Number of nearest free drivers considered when matching a ride
+MATCH_CANDIDATES = int(os.getenv("MATCH_CANDIDATES", "5"))
+
+# Ride history pagination
+RIDES_PAGE_SIZE = int(os.getenv("RIDES_PAGE_SIZE", "20"))
+RIDES_MAX_PAGE_SIZE = int(os.getenv("RIDES_MAX_PAGE_SIZE", "100"))
+# Rows fetched per server-side cursor round trip in streaming mode
+RIDES_STREAM_BATCH_SIZE = int(os.getenv("RIDES_STREAM_BATCH_SIZE", "500"))
+# Seconds a client may reuse a page of ride history; 0 forbids storing it
+RIDES_CACHE_MAX_AGE_SECONDS = int(os.getenv("RIDES_CACHE_MAX_AGE_SECONDS", "5"))
+
+# Available rides shown to drivers
+AVAILABLE_RIDES_RADIUS_KM = float(os.getenv("AVAILABLE_RIDES_RADIUS_KM", "5"))
+AVAILABLE_RIDES_MAX_RADIUS_KM = float(os.getenv("AVAILABLE_RIDES_MAX_RADIUS_KM", "50"))
+AVAILABLE_RIDES_LIMIT = int(os.getenv("AVAILABLE_RIDES_LIMIT", "20"))
+AVAILABLE_RIDES_MAX_LIMIT = int(os.getenv("AVAILABLE_RIDES_MAX_LIMIT", "100"))
+# Short, so a repeated poll is answered by the client's cache without going stale
+AVAILABLE_RIDES_CACHE_MAX_AGE_SECONDS = int(os.getenv("AVAILABLE_RIDES_CACHE_MAX_AGE_SECONDS", "2"))
+
+def is_active_ride_conflict(error: IntegrityError) -> bool:
+    """Whether an insert or update hit the one-active-ride-per-user unique indexes"""
+    message = str(error.orig)
+    # Postgres names the index; SQLite only names the column
+    return "uq_rides_active_" in message or "rides.rider_id" in message or "rides.driver_id" in message
+
+
+def bump_version(ride: Ride):
+    """Increment the version in the UPDATE itself, so concurrent writers never reuse one"""
+    ride.version = Ride.version + 1
+
+
+def ride_columns(ride: Ride) -> dict:
+    """Column values of a loaded ride, to diff against once a change is committed"""
+    return {column.key: getattr(ride, column.key) for column in Ride.__table__.columns}
+
+
+def changed_ride_fields(before: dict, ride: Ride) -> Set[str]:
+    """RideResponse fields that differ between a ride_columns() snapshot and the refreshed ride"""
+    changed = {key for key, value in before.items() if getattr(ride, key) != value}
+    if "driver_id" in changed:
+        changed |= {"driver_name", "driver_rating"}
+    return changed & set(RideResponse.model_fields)
 
 
 @router.post("", response_model=RideResponse, status_code=status.HTTP_201_CREATED)
@@ -43,73 +80,65 @@ async def create_ride(
     current_user: User = Depends(get_current_active_user),
     db: AsyncSession = Depends(get_db)
 ):
-    # Check if user has an active ride
-    result = await db.execute(
-        select(Ride).where(
-            and_(
-                Ride.rider_id == current_user.id,
-                Ride.status.in_([RideStatus.SEARCHING, RideStatus.MATCHED, RideStatus.DRIVER_ARRIVING, RideStatus.IN_PROGRESS])
-            )
-        )
-    )
-    active_ride = result.scalar_one_or_none()
-    if active_ride:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="You already have an active ride"
-        )
-    
-    # Create pickup location
-    pickup_location = Location(
-        name=ride_data.pickup_location.name,
-        latitude=ride_data.pickup_location.latitude,
-        longitude=ride_data.pickup_location.longitude
+    # Reuse the canonical rows for both places, creating them if needed
+    (pickup_values, destination_values), new_locations = await location_interner.resolve(
+        db,
+        [ride_data.pickup_location, ride_data.destination_location]
     )
-    db.add(pickup_location)
-    await db.flush()
-    
-    # Create destination location
-    destination_location = Location(
-        name=ride_data.destination_location.name,
-        latitude=ride_data.destination_location.latitude,
-        longitude=ride_data.destination_location.longitude
-    )
-    db.add(destination_location)
-    await db.flush()
     
     # Calculate fare
     fare = calculate_fare(
-        pickup_location.latitude,
-        pickup_location.longitude,
-        destination_location.latitude,
-        destination_location.longitude
-    )
-    
-    # Create ride
-    new_ride = Ride(
-        rider_id=current_user.id,
-        pickup_location_id=pickup_location.id,
-        destination_location_id=destination_location.id,
-        status=RideStatus.SEARCHING,
-        fare=fare
+        pickup_values["latitude"],
+        pickup_values["longitude"],
+        destination_values["latitude"],
+        destination_values["longitude"]
     )
     
-    db.add(new_ride)
-    await db.commit()
-    await db.refresh(new_ride)
-    await db.refresh(new_ride.pickup_location)
-    await db.refresh(new_ride.destination_location)
-    
-    # Try to find available driver
-    await match_driver(new_ride.id, db)
+    # All values are generated here, so the response needs nothing read back
+    now = datetime.utcnow()
+    ride_values = {
+        "id": str(uuid.uuid4()),
+        "rider_id": current_user.id,
+        "pickup_location_id": pickup_values["id"],
+        "destination_location_id": destination_values["id"],
+        "status": RideStatus.SEARCHING,
+        "fare": fare,
+        "created_at": now,
+        "updated_at": now,
+        "version": 1
+    }
     
-    # Refresh ride to get updated data
-    await db.refresh(new_ride)
-    await db.refresh(new_ride.rider)
-    if new_ride.driver_id:
-        await db.refresh(new_ride.driver)
+    # The unique index on active rides rejects a second active ride for this rider
+    try:
+        await db.execute(insert(Ride).values(**ride_values))
+        await db.commit()
+    except IntegrityError as e:
+        await db.rollback()
+        if not is_active_ride_conflict(e):
+            raise
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="You already have an active ride"
+        )
+    location_interner.remember(new_locations)
+    
+    ride_response = RideResponse(
+        **ride_values,
+        pickup_location=pickup_values,
+        destination_location=destination_values,
+        rider_name=current_user.full_name or current_user.username,
+        rider_rating=current_user.rating
+    )
     
-    ride_response = await ride_to_response(new_ride, db)
+    # Offer the ride to nearby drivers, or try to find an available driver unless
+    # the batch matching engine owns assignment
+    if RIDE_OFFERS_ENABLED:
+        ride_dispatcher.dispatch(ride_response)
+    elif not BATCH_MATCHING_ENABLED:
+        await match_driver(ride_values["id"], db)
+        ride = await db.get(Ride, ride_values["id"])
+        if ride.driver_id:
+            ride_response = await ride_to_response(ride, db)
     
     # Notify rider via WebSocket
     await manager.send_ride_update(current_user.id, ride_response)
@@ -118,51 +147,72 @@ async def create_ride(
 
 
 async def match_driver(ride_id: str, db: AsyncSession):
-    """Match a ride with an available driver"""
+    """Match a ride with the nearest available driver"""
     ride = await db.get(Ride, ride_id)
     if not ride or ride.status != RideStatus.SEARCHING:
         return
     
-    # Find available drivers near pickup location
-    result = await db.execute(
-        select(User).where(
-            and_(
-                User.user_mode == "driver",
-                User.is_online == True,
-                User.id.notin_(
-                    select(Ride.driver_id).where(
-                        Ride.status.in_([RideStatus.MATCHED, RideStatus.DRIVER_ARRIVING, RideStatus.IN_PROGRESS])
-                    )
-                )
-            )
-        )
+    pickup_location = await db.get(Location, ride.pickup_location_id)
+    
+    # Nearest free drivers from the in-memory index, closest first
+    candidates = driver_index.nearest(
+        pickup_location.latitude,
+        pickup_location.longitude,
+        k=MATCH_CANDIDATES
     )
-    available_drivers = result.scalars().all()
     
-    if not available_drivers:
+    if not candidates:
         return
     
-    # Simple matching: pick first available driver
-    # In production, you'd want to match based on proximity
-    driver = available_drivers[0]
-    
-    ride.driver_id = driver.id
-    ride.status = RideStatus.MATCHED
-    ride.estimated_arrival = datetime.utcnow() + timedelta(minutes=5)
-    
-    await db.commit()
+    driver_id, distance = candidates[0]
+    # Claim the driver before awaiting so concurrent matches skip them. They are
+    # freed again on every path but a commit, so a timeout, a lost connection
+    # or a cancelled request never leaves them busy for good
+    driver_index.mark_busy(driver_id)
+    stays_busy = False
+    try:
+        driver_lat, driver_lon = driver_index.positions[driver_id]
+        bump_version(ride)
+        ride.driver_id = driver_id
+        ride.status = RideStatus.MATCHED
+        ride.estimated_arrival = datetime.utcnow() + timedelta(
+            minutes=eta_estimator.minutes_for_distance(distance, driver_lat, driver_lon)
+        )
+        await db.commit()
+        stays_busy = True
+    except IntegrityError as e:
+        # The index was stale and the driver already has an active ride; they
+        # stay busy and the ride keeps searching
+        stays_busy = is_active_ride_conflict(e)
+        await db.rollback()
+        if not stays_busy:
+            raise
+        return
+    finally:
+        if not stays_busy:
+            driver_index.mark_free(driver_id)
+    await db.refresh(ride)
     
-    # Notify driver via WebSocket
+    # Notify driver via WebSocket; the ride is new to them, so send all of it
     ride_response = await ride_to_response(ride, db)
-    await manager.send_ride_update(driver.id, ride_response)
+    await manager.send_ride_update(driver_id, ride_response)
 
 
-async def ride_to_response(ride: Ride, db: AsyncSession) -> RideResponse:
-    """Convert Ride model to RideResponse schema"""
-    await db.refresh(ride.pickup_location)
-    await db.refresh(ride.destination_location)
-    await db.refresh(ride.rider)
-    
+def ride_load_options(model=Ride) -> tuple:
+    """
+    Eager-load everything serialize_ride touches on Ride or RideArchive; all
+    four are many-to-one, so joinedload fetches a whole page in a single SELECT
+    """
+    return (
+        joinedload(model.pickup_location),
+        joinedload(model.destination_location),
+        joinedload(model.rider),
+        joinedload(model.driver),
+    )
+
+
+def serialize_ride(ride: Ride) -> RideResponse:
+    """Convert a Ride or RideArchive whose locations and users are already loaded to RideResponse"""
     response_data = {
         "id": ride.id,
         "rider_id": ride.rider_id,
@@ -188,6 +238,7 @@ async def ride_to_response(ride: Ride, db: AsyncSession) -> RideResponse:
         "completed_at": ride.completed_at,
         "created_at": ride.created_at,
         "updated_at": ride.updated_at,
+        "version": ride.version,
         "rider_name": ride.rider.full_name or ride.rider.username,
         "driver_name": None,
         "rider_rating": ride.rider.rating,
@@ -195,39 +246,238 @@ async def ride_to_response(ride: Ride, db: AsyncSession) -> RideResponse:
     }
     
     if ride.driver_id:
-        await db.refresh(ride.driver)
         response_data["driver_name"] = ride.driver.full_name or ride.driver.username
         response_data["driver_rating"] = ride.driver.rating
     
     return RideResponse(**response_data)
 
 
-@router.get("", response_model=List[RideResponse])
-async def get_rides(
-    current_user: User = Depends(get_current_active_user),
-    db: AsyncSession = Depends(get_db),
-    status_filter: RideStatus = None
-):
+def location_columns(locations) -> tuple:
+    """Columns of the locations table (or an alias of it) that serialize_ride puts in a response"""
+    return (locations.c.id, locations.c.name, locations.c.latitude, locations.c.longitude, locations.c.created_at)
+
+
+def referenced_columns(table, foreign_key, prefix: str, columns) -> list:
+    """
+    Columns of the row foreign_key points to, labelled prefix_<column>, as
+    correlated subqueries: SQLite's RETURNING cannot name joined tables
+    """
+    return [
+        select(column).where(table.c.id == foreign_key).scalar_subquery().label(f"{prefix}_{column.key}")
+        for column in columns
+    ]
+
+
+def serialize_claimed_ride(claimed, arrival, driver: User) -> RideResponse:
+    """Convert the RETURNING rows of an accept claim to RideResponse without reloading the ride"""
+    row = claimed._mapping
+    response_data = {column.key: row[column.key] for column in Ride.__table__.columns if column.key in RideResponse.model_fields}
+    for prefix in ("pickup", "destination"):
+        response_data[f"{prefix}_location"] = {
+            column.key: row[f"{prefix}_{column.key}"] for column in location_columns(Location.__table__)
+        }
+    response_data.update(
+        estimated_arrival=arrival.estimated_arrival,
+        updated_at=arrival.updated_at,
+        rider_name=row["rider_full_name"] or row["rider_username"],
+        rider_rating=row["rider_rating"],
+        driver_name=driver.full_name or driver.username,
+        driver_rating=driver.rating
+    )
+    return RideResponse(**response_data)
+
+
+def ride_etag(ride_id: str, version: int, rider_updated_at, driver_updated_at) -> str:
+    """
+    Entity tag of a ride's response: its version covers the ride's own columns,
+    the users' updated_at their names and ratings. Locations are only ever
+    rewritten by compact_locations, which bumps the version of every ride it touches.
+    """
+    return make_etag(ride_id, version, rider_updated_at, driver_updated_at)
+
+
+async def ride_validator(model, ride_id: str, db: AsyncSession):
+    """The columns get_ride checks access and builds the ETag from, in one query"""
+    rider = aliased(User)
+    driver = aliased(User)
+    result = await db.execute(
+        select(
+            model.rider_id,
+            model.driver_id,
+            model.version,
+            rider.updated_at.label("rider_updated_at"),
+            driver.updated_at.label("driver_updated_at")
+        )
+        .join(rider, rider.id == model.rider_id)
+        .outerjoin(driver, driver.id == model.driver_id)
+        .where(model.id == ride_id)
+    )
+    return result.first()
+
+
+async def ride_to_response(ride: Ride, db: AsyncSession) -> RideResponse:
+    """Convert a single Ride model to RideResponse schema"""
+    await db.refresh(ride, attribute_names=["pickup_location", "destination_location", "rider", "driver"])
+    return serialize_ride(ride)
+
+
+async def rides_to_responses(query, db: AsyncSession) -> List[RideResponse]:
+    """Run a Ride or RideArchive query with eager loading and serialize every row"""
+    model = query.column_descriptions[0]["entity"]
+    result = await db.execute(query.options(*ride_load_options(model)))
+    return [serialize_ride(ride) for ride in result.scalars().unique().all()]
+
+
+def ride_history_query(model, current_user: User, status_filter: Optional[RideStatus], cursor: Optional[str]):
+    """The current user's rides in one table, newest first"""
     if current_user.user_mode.value == "rider":
-        query = select(Ride).where(Ride.rider_id == current_user.id)
+        query = select(model).where(model.rider_id == current_user.id)
     else:
-        query = select(Ride).where(Ride.driver_id == current_user.id)
+        query = select(model).where(model.driver_id == current_user.id)
     
     if status_filter:
-        query = query.where(Ride.status == status_filter)
+        query = query.where(model.status == status_filter)
+    
+    # Keyset pagination on (created_at, id): with the (user, created_at, id) indexes
+    # every page, however deep, is a seek plus a scan of one page of index entries
+    if cursor:
+        created_at, ride_id = decode_ride_cursor(cursor)
+        query = query.where(tuple_(model.created_at, model.id) < tuple_(created_at, ride_id))
     
-    query = query.order_by(Ride.created_at.desc())
-    result = await db.execute(query)
-    rides = result.scalars().all()
+    return query.order_by(model.created_at.desc(), model.id.desc())
+
+
+def encode_ride_cursor(ride: RideResponse) -> str:
+    """Opaque keyset cursor pointing just past the given ride"""
+    raw = json.dumps([ride.created_at.isoformat(), ride.id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_ride_cursor(cursor: str) -> Tuple[datetime, str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, ride_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), str(ride_id)
+    except (ValueError, TypeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
+
+async def stream_rides(query, db: AsyncSession) -> AsyncIterator[RideResponse]:
+    """Serialize a Ride or RideArchive query row by row from a server-side cursor"""
+    model = query.column_descriptions[0]["entity"]
+    result = await db.stream(
+        query.options(*ride_load_options(model)).execution_options(yield_per=RIDES_STREAM_BATCH_SIZE)
+    )
+    async for ride in result.scalars():
+        yield serialize_ride(ride)
+
+
+async def _next_or_none(stream: AsyncIterator[RideResponse]) -> Optional[RideResponse]:
+    try:
+        return await stream.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+async def stream_ride_responses(*queries) -> AsyncIterator[bytes]:
+    """
+    Write a JSON array of rides from queries that are each ordered newest
+    first, merging them so the array is ordered newest first as well
+    """
+    # The request session may be closed before the body is sent, so the
+    # cursors share a session of their own: one connection per response
+    db = AsyncSessionLocal()
+    streams = [stream_rides(query, db) for query in queries]
+    try:
+        heads = [await _next_or_none(stream) for stream in streams]
+        yield b"["
+        separator = b""
+        while any(head is not None for head in heads):
+            newest = max(
+                (i for i, head in enumerate(heads) if head is not None),
+                key=lambda i: (heads[i].created_at, heads[i].id)
+            )
+            yield separator + heads[newest].model_dump_json().encode("utf-8")
+            separator = b","
+            heads[newest] = await _next_or_none(streams[newest])
+        yield b"]"
+    finally:
+        for stream in streams:
+            await stream.aclose()
+        await db.close()
+
+
+@router.post("/quotes", response_model=List[QuoteResponse])
+async def get_quotes(
+    quote_request: QuoteRequest,
+    current_user: User = Depends(get_current_active_user)
+):
+    """Fare and trip estimates for several pickup/destination pairs, in request order"""
+    pairs = quote_request.pairs
+    distances, fares, durations = calculate_quotes(
+        [pair.pickup_location.latitude for pair in pairs],
+        [pair.pickup_location.longitude for pair in pairs],
+        [pair.destination_location.latitude for pair in pairs],
+        [pair.destination_location.longitude for pair in pairs]
+    )
     
-    return [await ride_to_response(ride, db) for ride in rides]
+    return [
+        QuoteResponse(distance_km=distance, fare=fare, estimated_duration_minutes=duration)
+        for distance, fare, duration in zip(distances.tolist(), fares.tolist(), durations.tolist())
+    ]
+
+
+@router.get("", response_model=List[RideResponse])
+async def get_rides(
+    response: Response,
+    current_user: User = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_db),
+    status_filter: RideStatus = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(RIDES_PAGE_SIZE, ge=1, le=RIDES_MAX_PAGE_SIZE),
+    stream: bool = False
+):
+    """
+    Newest rides first, one page at a time. When more rides exist the
+    X-Next-Cursor header holds the cursor for the next page. With stream=true
+    every remaining ride is streamed instead and limit is ignored.
+    """
+    # Older completed and cancelled rides live in rides_archive; active ones never do
+    queries = [ride_history_query(Ride, current_user, status_filter, cursor)]
+    if status_filter not in ACTIVE_RIDE_STATUSES:
+        queries.append(ride_history_query(RideArchive, current_user, status_filter, cursor))
+    
+    headers = {"Cache-Control": max_age(RIDES_CACHE_MAX_AGE_SECONDS), "Vary": "Authorization"}
+    if stream:
+        # Hand the request's connection back rather than hold it while a slow client reads
+        await db.close()
+        return StreamingResponse(stream_ride_responses(*queries), media_type="application/json", headers=headers)
+    response.headers.update(headers)
+    
+    # A ride archived between the two queries may show up in both
+    rides_by_id = {}
+    for query in queries:
+        for ride in await rides_to_responses(query.limit(limit + 1), db):
+            rides_by_id[ride.id] = ride
+    rides = sorted(rides_by_id.values(), key=lambda ride: (ride.created_at, ride.id), reverse=True)[:limit + 1]
+    if len(rides) > limit:
+        rides = rides[:limit]
+        response.headers["X-Next-Cursor"] = encode_ride_cursor(rides[-1])
+    return rides
 
 
 @router.get("/available", response_model=List[RideResponse])
 async def get_available_rides(
+    response: Response,
     current_user: User = Depends(get_current_active_user),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_db),
+    radius_km: float = Query(AVAILABLE_RIDES_RADIUS_KM, gt=0, le=AVAILABLE_RIDES_MAX_RADIUS_KM),
+    limit: int = Query(AVAILABLE_RIDES_LIMIT, ge=1, le=AVAILABLE_RIDES_MAX_LIMIT)
 ):
+    """Searching rides whose pickup is within radius_km of the driver, closest first"""
     if current_user.user_mode.value != "driver":
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -240,36 +490,106 @@ async def get_available_rides(
             detail="Driver must be online to view available rides"
         )
     
-    # Get rides that are searching for a driver
-    result = await db.execute(
-        select(Ride).where(Ride.status == RideStatus.SEARCHING)
+    # The index has the latest streamed position; the row lags by up to a location flush
+    position = driver_index.positions.get(current_user.id)
+    if position is None and current_user.current_latitude is not None and current_user.current_longitude is not None:
+        position = (current_user.current_latitude, current_user.current_longitude)
+    if position is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Driver location is required to view available rides"
+        )
+    
+    driver_lat, driver_lon = position
+    min_lat, max_lat, min_lon, max_lon = bounding_box(driver_lat, driver_lon, radius_km)
+    
+    # Indexed bounding-box prefilter, ordered by an equirectangular approximation
+    # of the distance so the limit keeps the closest pickups
+    lon_scale = math.cos(math.radians(driver_lat))
+    approx_distance = (
+        (Location.latitude - driver_lat) * (Location.latitude - driver_lat)
+        + (Location.longitude - driver_lon) * (Location.longitude - driver_lon) * (lon_scale * lon_scale)
+    )
+    query = (
+        select(Ride)
+        .join(Location, Ride.pickup_location_id == Location.id)
+        .where(
+            and_(
+                Ride.status == RideStatus.SEARCHING,
+                Location.latitude.between(min_lat, max_lat),
+                Location.longitude.between(min_lon, max_lon)
+            )
+        )
+        .order_by(approx_distance)
+        .limit(limit)
     )
-    rides = result.scalars().all()
+    rides = await rides_to_responses(query, db)
+    
+    # Exact haversine check drops the corners of the box
+    nearby = []
+    for ride in rides:
+        distance = haversine_km(
+            driver_lat,
+            driver_lon,
+            ride.pickup_location.latitude,
+            ride.pickup_location.longitude
+        )
+        if distance <= radius_km:
+            nearby.append((distance, ride))
+    nearby.sort(key=lambda item: item[0])
     
-    return [await ride_to_response(ride, db) for ride in rides]
+    response.headers["Cache-Control"] = max_age(AVAILABLE_RIDES_CACHE_MAX_AGE_SECONDS)
+    response.headers["Vary"] = "Authorization"
+    return [ride for _, ride in nearby]
 
 
 @router.get("/{ride_id}", response_model=RideResponse)
 async def get_ride(
     ride_id: str,
+    request: Request,
+    response: Response,
     current_user: User = Depends(get_current_active_user),
     db: AsyncSession = Depends(get_db)
 ):
-    ride = await db.get(Ride, ride_id)
-    if not ride:
+    """
+    Answers If-None-Match with 304 after a single narrow query; the ride with
+    its locations and users is only loaded when the client's copy is stale
+    """
+    for model in (Ride, RideArchive):
+        validator = await ride_validator(model, ride_id, db)
+        if validator is not None:
+            break
+    else:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Ride not found"
         )
     
     # Check if user has access to this ride
-    if ride.rider_id != current_user.id and ride.driver_id != current_user.id:
+    if validator.rider_id != current_user.id and validator.driver_id != current_user.id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You don't have access to this ride"
         )
     
-    return await ride_to_response(ride, db)
+    etag = ride_etag(ride_id, validator.version, validator.rider_updated_at, validator.driver_updated_at)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    
+    result = await db.execute(select(model).options(*ride_load_options(model)).where(model.id == ride_id))
+    ride = result.scalar_one_or_none()
+    if ride is None:
+        # Archived between the two queries
+        ride = await db.get(RideArchive, ride_id, options=ride_load_options(RideArchive))
+    
+    # Derived from the loaded rows, so it always describes the body sent
+    response.headers.update(cache_headers(ride_etag(
+        ride_id,
+        ride.version,
+        ride.rider.updated_at,
+        ride.driver.updated_at if ride.driver else None
+    )))
+    return serialize_ride(ride)
 
 
 @router.put("/{ride_id}", response_model=RideResponse)
@@ -294,6 +614,8 @@ async def update_ride(
         )
     
     # Update ride
+    before = ride_columns(ride)
+    bump_version(ride)
     if ride_update.status:
         ride.status = ride_update.status
         if ride_update.status == RideStatus.IN_PROGRESS and not ride.started_at:
@@ -307,16 +629,43 @@ async def update_ride(
         ride.fare = ride_update.fare
     if ride_update.estimated_arrival:
         ride.estimated_arrival = ride_update.estimated_arrival
-    
-    await db.commit()
+
+    try:
+        await db.commit()
+    except IntegrityError as e:
+        # Reopening a finished ride while its rider or driver has another active one
+        await db.rollback()
+        if not is_active_ride_conflict(e):
+            raise
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Rider or driver already has an active ride"
+        )
     await db.refresh(ride)
     
+    # Keep the driver index in sync with the ride lifecycle; a driver taken off
+    # the ride, or whose ride is no longer under way, can be matched again
+    on_ride = ride.status in ACTIVE_RIDE_STATUSES and ride.status != RideStatus.SEARCHING
+    previous_driver_id = before["driver_id"]
+    if previous_driver_id and (previous_driver_id != ride.driver_id or not on_ride):
+        driver_index.mark_free(previous_driver_id)
+    if ride.driver_id:
+        if on_ride:
+            driver_index.mark_busy(ride.driver_id)
+        else:
+            driver_index.mark_free(ride.driver_id)
+    if ride.status != RideStatus.SEARCHING:
+        ride_dispatcher.close(ride.id)
+    
     ride_response = await ride_to_response(ride, db)
+    changed = changed_ride_fields(before, ride)
     
-    # Notify both rider and driver via WebSocket
-    await manager.send_ride_update(ride.rider_id, ride_response)
+    # Notify both rider and driver via WebSocket; a newly assigned driver gets the whole ride
+    await manager.send_ride_update(ride.rider_id, ride_response, changed)
     if ride.driver_id:
-        await manager.send_ride_update(ride.driver_id, ride_response)
+        await manager.send_ride_update(
+            ride.driver_id, ride_response, None if "driver_id" in changed else changed
+        )
     
     return ride_response
 
@@ -339,46 +688,68 @@ async def accept_ride(
             detail="Driver must be online to accept rides"
         )
     
-    ride = await db.get(Ride, ride_id)
-    if not ride:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Ride not found"
+    # Claim the ride with one conditional UPDATE that also returns everything the
+    # response needs. Concurrent accepts serialize on the row, and every loser
+    # finds it no longer searching and gets no row back
+    rides = Ride.__table__
+    locations = Location.__table__
+    users = User.__table__
+    try:
+        result = await db.execute(
+            update(rides)
+            .where(and_(rides.c.id == ride_id, rides.c.status == RideStatus.SEARCHING))
+            .values(driver_id=current_user.id, status=RideStatus.MATCHED, version=rides.c.version + 1)
+            .returning(
+                *rides.columns,
+                *referenced_columns(locations, rides.c.pickup_location_id, "pickup", location_columns(locations)),
+                *referenced_columns(locations, rides.c.destination_location_id, "destination", location_columns(locations)),
+                *referenced_columns(users, rides.c.rider_id, "rider", (users.c.full_name, users.c.username, users.c.rating))
+            )
         )
-    
-    if ride.status != RideStatus.SEARCHING:
+        claimed = result.first()
+        if claimed is not None:
+            # Streamed position if the driver is in the index, else the last stored one.
+            # Set in the claim's transaction, so nobody sees the ride matched without an ETA
+            driver_position = driver_index.positions.get(current_user.id)
+            if driver_position is None and current_user.current_latitude is not None and current_user.current_longitude is not None:
+                driver_position = (current_user.current_latitude, current_user.current_longitude)
+            result = await db.execute(
+                update(rides)
+                .where(rides.c.id == ride_id)
+                .values(estimated_arrival=eta_estimator.estimate_arrival(
+                    driver_position, claimed.pickup_latitude, claimed.pickup_longitude
+                ))
+                .returning(rides.c.estimated_arrival, rides.c.updated_at)
+            )
+            arrival = result.one()
+        await db.commit()
+    except IntegrityError as e:
+        # The unique index on active rides rejects a second active ride for this driver
+        await db.rollback()
+        if not is_active_ride_conflict(e):
+            raise
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Ride is not available for acceptance"
+            detail="You already have an active ride"
         )
-    
-    # Check if driver already has an active ride
-    result = await db.execute(
-        select(Ride).where(
-            and_(
-                Ride.driver_id == current_user.id,
-                Ride.status.in_([RideStatus.MATCHED, RideStatus.DRIVER_ARRIVING, RideStatus.IN_PROGRESS])
+    if claimed is None:
+        # Only a missed claim pays for telling an unknown ride from a taken one
+        if await db.get(Ride, ride_id) is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Ride not found"
             )
-        )
-    )
-    active_ride = result.scalar_one_or_none()
-    if active_ride:
         raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="You already have an active ride"
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Ride is not available for acceptance"
         )
+    driver_index.mark_busy(current_user.id)
+    ride_dispatcher.close(ride_id)
     
-    ride.driver_id = current_user.id
-    ride.status = RideStatus.MATCHED
-    ride.estimated_arrival = datetime.utcnow() + timedelta(minutes=5)
-    
-    await db.commit()
-    await db.refresh(ride)
-    
-    ride_response = await ride_to_response(ride, db)
+    ride_response = serialize_claimed_ride(claimed, arrival, current_user)
     
-    # Notify both rider and driver via WebSocket
-    await manager.send_ride_update(ride.rider_id, ride_response)
+    # Notify both via WebSocket: the rider gets what changed, the driver the whole ride
+    await manager.send_ride_update(ride_response.rider_id, ride_response, ASSIGNMENT_FIELDS)
     await manager.send_ride_update(current_user.id, ride_response)
     
     return ride_response
@@ -410,17 +781,23 @@ async def cancel_ride(
             detail="Cannot cancel a completed or already cancelled ride"
         )
     
+    before = ride_columns(ride)
+    bump_version(ride)
     ride.status = RideStatus.CANCELLED
     
     await db.commit()
     await db.refresh(ride)
+    if ride.driver_id:
+        driver_index.mark_free(ride.driver_id)
+    ride_dispatcher.close(ride_id)
     
     ride_response = await ride_to_response(ride, db)
+    changed = changed_ride_fields(before, ride)
     
     # Notify both rider and driver via WebSocket
-    await manager.send_ride_update(ride.rider_id, ride_response)
+    await manager.send_ride_update(ride.rider_id, ride_response, changed)
     if ride.driver_id:
-        await manager.send_ride_update(ride.driver_id, ride_response)
+        await manager.send_ride_update(ride.driver_id, ride_response, changed)
     
     return ride_response
 
@@ -1,8 +1,12 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 
+from app.auth_cache import invalidate_user
 from app.database import get_db
+from app.driver_index import driver_index
+from app.http_cache import cache_headers, etag_matches, make_etag, not_modified
+from app.location_writer import location_writer
 from app.models import User
 from app.schemas import UserResponse, DriverAvailabilityUpdate
 from app.dependencies import get_current_active_user
@@ -10,8 +14,21 @@ from app.dependencies import get_current_active_user
 router = APIRouter()
 
 
+def user_etag(user: User) -> str:
+    return make_etag(user.id, user.updated_at)
+
+
 @router.get("/me", response_model=UserResponse)
-async def get_my_profile(current_user: User = Depends(get_current_active_user)):
+async def get_my_profile(
+    request: Request,
+    response: Response,
+    current_user: User = Depends(get_current_active_user)
+):
+    # The user is usually served from the auth cache, so a 304 needs no query at all
+    etag = user_etag(current_user)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    response.headers.update(cache_headers(etag))
     return UserResponse.model_validate(current_user)
 
 
@@ -26,6 +43,7 @@ async def update_my_profile(
             setattr(current_user, field, value)
     
     await db.commit()
+    invalidate_user(current_user.id)
     await db.refresh(current_user)
     return UserResponse.model_validate(current_user)
 
@@ -47,19 +65,48 @@ async def update_driver_availability(
         current_user.current_latitude = availability.latitude
     if availability.longitude is not None:
         current_user.current_longitude = availability.longitude
+    if availability.latitude is not None or availability.longitude is not None:
+        # This write is newer than any position streamed over the WebSocket
+        location_writer.discard(current_user.id)
     
     await db.commit()
+    invalidate_user(current_user.id)
     await db.refresh(current_user)
+    
+    # Keep the in-memory driver index in sync for matching
+    if (
+        current_user.is_online
+        and current_user.current_latitude is not None
+        and current_user.current_longitude is not None
+    ):
+        driver_index.update(
+            current_user.id,
+            current_user.current_latitude,
+            current_user.current_longitude
+        )
+    else:
+        driver_index.remove(current_user.id)
+    
     return UserResponse.model_validate(current_user)
 
 
 @router.get("/{user_id}", response_model=UserResponse)
-async def get_user(user_id: str, db: AsyncSession = Depends(get_db)):
+async def get_user(
+    user_id: str,
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_db)
+):
+    # One primary-key lookup either way; a match only skips building and sending the body
     user = await db.get(User, user_id)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found"
         )
+    etag = user_etag(user)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    response.headers.update(cache_headers(etag))
     return UserResponse.model_validate(user)
 
@@ -1,136 +1,557 @@
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, status
-from typing import Dict, Set
-import json
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
+from collections import deque
+import asyncio
+import enum
+import logging
+import msgpack
+import orjson
+import os
+import random
 from sqlalchemy.ext.asyncio import AsyncSession
+from dotenv import load_dotenv
 
+from app.database import AsyncSessionLocal
+from app.dependencies import decode_token_subject, get_user_by_id
+from app.driver_index import driver_index
+from app.location_writer import location_writer
+from app.metrics import background_task, registry
 from app.models import User
+from app.pubsub import PubSub, create_pubsub
 from app.schemas import RideResponse
 
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
 router = APIRouter()
 
 
+class OverflowPolicy(str, enum.Enum):
+    DROP_OLDEST = "drop_oldest"
+    COALESCE = "coalesce"
+    DISCONNECT = "disconnect"
+
+
+# Outbound messages buffered per socket before the overflow policy applies
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "64"))
+WS_OVERFLOW_POLICY = OverflowPolicy(os.getenv("WS_OVERFLOW_POLICY", OverflowPolicy.COALESCE.value))
+# A socket that cannot take a single message within this time is dropped
+WS_SEND_TIMEOUT_SECONDS = float(os.getenv("WS_SEND_TIMEOUT_SECONDS", "10"))
+# Ride updates kept per user so a reconnecting client can resume with ?since=<seq>
+WS_REPLAY_BUFFER_SIZE = int(os.getenv("WS_REPLAY_BUFFER_SIZE", "50"))
+# How long a user's channel and replay buffer outlive their last socket on this worker
+WS_REPLAY_TTL_SECONDS = float(os.getenv("WS_REPLAY_TTL_SECONDS", "60"))
+
+
+class Encoding(str, enum.Enum):
+    JSON = "json"
+    MSGPACK = "msgpack"
+
+
+# WebSocket subprotocol a client offers to get MessagePack binary frames instead of JSON text
+MSGPACK_SUBPROTOCOL = "rideasy.msgpack"
+
+
+def _coalesce_key(message: dict) -> Optional[str]:
+    """Messages with the same key supersede each other while still queued"""
+    if message.get("type") == "ride_update":
+        return message["data"]["id"]
+    return None
+
+
+def merge_ride_updates(older: dict, newer: dict) -> dict:
+    """A ride_update equivalent to applying older and then newer"""
+    if not newer.get("delta"):
+        return newer
+    return {
+        **newer,
+        "delta": bool(older.get("delta")),
+        "data": {**older["data"], **newer["data"]},
+    }
+
+
+class OutboundMessage:
+    """A message serialized at most once per wire format, however many sockets it goes to"""
+
+    __slots__ = ("message", "key", "_text", "_binary")
+
+    def __init__(self, message: dict):
+        self.message = message
+        self.key = _coalesce_key(message)
+        self._text: Optional[str] = None
+        self._binary: Optional[bytes] = None
+
+    def text(self) -> str:
+        if self._text is None:
+            self._text = orjson.dumps(self.message).decode()
+        return self._text
+
+    def binary(self) -> bytes:
+        if self._binary is None:
+            self._binary = msgpack.packb(self.message)
+        return self._binary
+
+
+class Connection:
+    """A WebSocket with a bounded outbound queue drained by its own writer task"""
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        user_id: str,
+        manager: "ConnectionManager",
+        encoding: Encoding = Encoding.JSON
+    ):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.manager = manager
+        self.encoding = encoding
+        self.queue: Deque[Tuple[Optional[str], OutboundMessage]] = deque()
+        self._ready = asyncio.Event()
+        self._writer = asyncio.create_task(self._drain())
+
+    def enqueue(self, message: OutboundMessage) -> bool:
+        """
+        Queue a message without blocking.
+        Returns False if the overflow policy requires dropping the connection.
+        """
+        policy = self.manager.overflow_policy
+        key = message.key if policy == OverflowPolicy.COALESCE else None
+        if key is not None:
+            for position, (queued_key, queued) in enumerate(self.queue):
+                if queued_key == key:
+                    # A newer delta only carries what changed, so fold it into the queued update
+                    merged = merge_ride_updates(queued.message, message.message)
+                    self.queue[position] = (key, message if merged is message.message else OutboundMessage(merged))
+                    self.manager.coalesced_messages += 1
+                    return True
+
+        if len(self.queue) >= self.manager.queue_size:
+            self.manager.dropped_messages += 1
+            if policy == OverflowPolicy.DISCONNECT:
+                return False
+            self.queue.popleft()
+
+        self.queue.append((key, message))
+        self._ready.set()
+        return True
+
+    async def _drain(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._ready.wait()
+            while self.queue:
+                _, message = self.queue.popleft()
+                if self.encoding == Encoding.MSGPACK:
+                    send = self.websocket.send_bytes(message.binary())
+                else:
+                    send = self.websocket.send_text(message.text())
+                # A timer instead of wait_for, which would create a task per message;
+                # on expiry the eviction cancels this writer mid-send
+                timer = loop.call_later(self.manager.send_timeout, self._send_timed_out)
+                try:
+                    await send
+                except Exception:
+                    self.manager.failed_messages += 1
+                    self.manager.evict(self)
+                    return
+                finally:
+                    timer.cancel()
+                self.manager.sent_messages += 1
+            self._ready.clear()
+
+    def _send_timed_out(self):
+        self.manager.failed_messages += 1
+        self.manager.evict(self)
+
+    def close(self):
+        self.queue.clear()
+        if self._writer is not asyncio.current_task():
+            self._writer.cancel()
+
+
+class ReplayBuffer:
+    """The latest sequenced ride updates for one user on this worker"""
+
+    def __init__(self, floor: int, size: int = WS_REPLAY_BUFFER_SIZE):
+        # Every message with a seq above the floor is still held
+        self.floor = floor
+        self.messages: Deque[dict] = deque()
+        self.size = size
+
+    def append(self, message: dict):
+        if len(self.messages) >= self.size:
+            self.floor = self.messages.popleft()["seq"]
+        self.messages.append(message)
+
+    def since(self, seq: int, latest: int) -> Optional[List[dict]]:
+        """
+        Updates after seq, one per ride with deltas folded together, or None
+        if some of them are gone or seq was not issued here
+        """
+        if not self.floor <= seq <= latest:
+            return None
+        merged: Dict[str, dict] = {}
+        for message in self.messages:
+            if message["seq"] > seq:
+                ride_id = message["data"]["id"]
+                merged[ride_id] = merge_ride_updates(merged[ride_id], message) if ride_id in merged else message
+        return sorted(merged.values(), key=lambda message: message["seq"])
+
+
+BROADCAST_CHANNEL = "broadcast"
+USER_CHANNEL_PREFIX = "user_"
+
+
+def user_channel(user_id: str) -> str:
+    return USER_CHANNEL_PREFIX + user_id
+
+
 class ConnectionManager:
-    def __init__(self):
+    """
+    Routes messages to sockets through a pub/sub backend. Senders publish on
+    the recipient's channel; each process subscribes only for users with a
+    socket on it and delivers to those local sockets.
+    
+    Ride updates delivered to a user are numbered and kept in a small replay
+    buffer that outlives the user's last socket for a while, so a client that
+    reconnects to the same worker gets what it missed instead of a refetch.
+    """
+
+    def __init__(
+        self,
+        queue_size: int = WS_SEND_QUEUE_SIZE,
+        overflow_policy: OverflowPolicy = WS_OVERFLOW_POLICY,
+        send_timeout: float = WS_SEND_TIMEOUT_SECONDS,
+        pubsub: Optional[PubSub] = None,
+        replay_size: int = WS_REPLAY_BUFFER_SIZE,
+        replay_ttl: float = WS_REPLAY_TTL_SECONDS
+    ):
         # Map user_id to set of WebSocket connections
         self.active_connections: Dict[str, Set[WebSocket]] = {}
+        # Map WebSocket to its outbound queue and writer
+        self.connections: Dict[WebSocket, Connection] = {}
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        self.send_timeout = send_timeout
+        self.replay_size = replay_size
+        self.replay_ttl = replay_ttl
+        # Map user_id to the ride updates recently delivered to them
+        self.replay_buffers: Dict[str, ReplayBuffer] = {}
+        # Users without a socket whose channel is kept until the timer fires
+        self._lingering: Dict[str, asyncio.TimerHandle] = {}
+        # Last sequence number issued. Each process starts in its own range, so a
+        # seq from another worker is recognized as foreign rather than replayed from
+        self.seq = random.randint(1, 2 ** 20) << 32
+        # Counters
+        self.sent_messages = 0
+        self.failed_messages = 0
+        self.dropped_messages = 0
+        self.coalesced_messages = 0
+        # Handlers for channels other than the broadcast and user channels
+        self.channel_handlers: Dict[str, Callable[[dict], None]] = {}
+        self.pubsub = pubsub if pubsub is not None else create_pubsub()
+        self.pubsub.set_handler(self._deliver)
+        self._subscription_lock: Optional[asyncio.Lock] = None
     
-    async def connect(self, websocket: WebSocket, user_id: str):
-        await websocket.accept()
+    async def start(self):
+        await self.pubsub.start()
+        await self.pubsub.subscribe(BROADCAST_CHANNEL)
+    
+    async def stop(self):
+        for timer in self._lingering.values():
+            timer.cancel()
+        self._lingering.clear()
+        await self.pubsub.stop()
+    
+    async def connect(
+        self,
+        websocket: WebSocket,
+        user_id: str,
+        encoding: Encoding = Encoding.JSON,
+        since: Optional[int] = None,
+        greeting: str = "Connected"
+    ):
+        """
+        Register a socket and greet it with the current seq. With since, first
+        replay the ride updates after it, or ask the client to resync if they
+        are no longer all held here.
+        """
+        await websocket.accept(subprotocol=MSGPACK_SUBPROTOCOL if encoding == Encoding.MSGPACK else None)
         if user_id not in self.active_connections:
             self.active_connections[user_id] = set()
         self.active_connections[user_id].add(websocket)
+        connection = self.connections[websocket] = Connection(websocket, user_id, self, encoding)
+        
+        lingering = self._lingering.pop(user_id, None)
+        if lingering is not None:
+            lingering.cancel()
+        buffer = self.replay_buffers.get(user_id)
+        if buffer is None:
+            buffer = self.replay_buffers[user_id] = ReplayBuffer(self.seq, self.replay_size)
+        
+        # Nothing is awaited until the replay is queued, so no update can slip in between
+        connection.enqueue(OutboundMessage({"type": "connected", "message": greeting, "seq": self.seq}))
+        if since is not None:
+            missed = buffer.since(since, self.seq)
+            if missed is None:
+                connection.enqueue(OutboundMessage({"type": "resync", "seq": self.seq}))
+            else:
+                for message in missed:
+                    connection.enqueue(OutboundMessage(message))
+        await self._sync_subscription(user_id)
     
     def disconnect(self, websocket: WebSocket, user_id: str):
         if user_id in self.active_connections:
             self.active_connections[user_id].discard(websocket)
             if not self.active_connections[user_id]:
                 del self.active_connections[user_id]
+                self._linger(user_id)
+        connection = self.connections.pop(websocket, None)
+        if connection is not None:
+            connection.close()
+    
+    def _linger(self, user_id: str):
+        """Keep the user's channel and replay buffer a while after their last socket"""
+        if self.replay_ttl <= 0:
+            background_task(self._sync_subscription(user_id))
+            return
+        self._lingering[user_id] = asyncio.get_running_loop().call_later(
+            self.replay_ttl, self._expire, user_id
+        )
+    
+    def _expire(self, user_id: str):
+        self._lingering.pop(user_id, None)
+        background_task(self._sync_subscription(user_id))
+    
+    async def _sync_subscription(self, user_id: str):
+        """Subscribe to a user's channel exactly while they have a local socket or are lingering"""
+        if self._subscription_lock is None:
+            self._subscription_lock = asyncio.Lock()
+        # Decide under the lock so a quick disconnect/reconnect cannot reorder
+        async with self._subscription_lock:
+            try:
+                if user_id in self.active_connections or user_id in self._lingering:
+                    await self.pubsub.subscribe(user_channel(user_id))
+                else:
+                    self.replay_buffers.pop(user_id, None)
+                    await self.pubsub.unsubscribe(user_channel(user_id))
+            except Exception:
+                logger.exception("Failed to update subscription for user %s", user_id)
+    
+    def _deliver(self, channel: str, message: dict):
+        """Handler for bus messages: queue on the matching local sockets"""
+        if channel == BROADCAST_CHANNEL:
+            targets = list(self.connections.values())
+        elif channel.startswith(USER_CHANNEL_PREFIX):
+            user_id = channel[len(USER_CHANNEL_PREFIX):]
+            if message.get("type") == "ride_update":
+                self.seq += 1
+                message = {**message, "seq": self.seq}
+                buffer = self.replay_buffers.get(user_id)
+                if buffer is not None:
+                    buffer.append(message)
+            targets = [self.connections[websocket] for websocket in self.active_connections.get(user_id, ())]
+        else:
+            handler = self.channel_handlers.get(channel)
+            if handler is not None:
+                handler(message)
+            return
+        # Encoded lazily by the first writer that needs each format, then shared
+        outbound = OutboundMessage(message)
+        for connection in targets:
+            self._enqueue(connection, outbound)
+    
+    async def subscribe_channel(self, channel: str, handler: Callable[[dict], None]):
+        """Hand every message published on channel, by any worker, to handler"""
+        self.channel_handlers[channel] = handler
+        await self.pubsub.subscribe(channel)
+    
+    async def publish(self, channel: str, message: dict):
+        await self._publish(channel, message)
+    
+    async def _publish(self, channel: str, message: dict):
+        try:
+            await self.pubsub.publish(channel, message)
+        except Exception:
+            logger.exception("Failed to publish to %s", channel)
+    
+    def evict(self, connection: Connection):
+        """Drop a slow or broken connection and close its socket in the background"""
+        self.disconnect(connection.websocket, connection.user_id)
+        background_task(self._close(connection.websocket))
+    
+    @staticmethod
+    async def _close(websocket: WebSocket):
+        try:
+            await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+        except Exception:
+            pass
+    
+    def _enqueue(self, connection: Connection, message: OutboundMessage):
+        if not connection.enqueue(message):
+            self.evict(connection)
     
     async def send_personal_message(self, message: dict, websocket: WebSocket):
-        await websocket.send_json(message)
+        """Reply on a local socket without going through the bus"""
+        connection = self.connections.get(websocket)
+        if connection is not None:
+            self._enqueue(connection, OutboundMessage(message))
     
-    async def send_ride_update(self, user_id: str, ride: RideResponse):
-        """Send ride update to all connections for a user"""
-        if user_id in self.active_connections:
-            message = {
-                "type": "ride_update",
-                "data": ride.model_dump()
-            }
-            disconnected = set()
-            for connection in self.active_connections[user_id]:
-                try:
-                    await connection.send_json(message)
-                except:
-                    disconnected.add(connection)
-            
-            # Remove disconnected connections
-            for connection in disconnected:
-                self.disconnect(connection, user_id)
+    async def send_ride_update(self, user_id: str, ride: RideResponse, fields: Optional[Set[str]] = None):
+        """
+        Send ride update to all connections for a user, on any worker: the
+        whole ride, or as a delta only the given fields plus id and version
+        """
+        if fields is None:
+            data = ride.model_dump(mode="json")
+        else:
+            data = ride.model_dump(mode="json", include=fields | {"id", "version"})
+        message = {
+            "type": "ride_update",
+            "delta": fields is not None,
+            "data": data
+        }
+        await self._publish(user_channel(user_id), message)
+    
+    async def send_user_message(self, user_id: str, message: dict):
+        """Send any message to all connections for a user, on any worker"""
+        await self._publish(user_channel(user_id), message)
     
     async def broadcast(self, message: dict):
-        """Broadcast message to all connected clients"""
-        disconnected_users = []
-        for user_id, connections in self.active_connections.items():
-            disconnected = set()
-            for connection in connections:
-                try:
-                    await connection.send_json(message)
-                except:
-                    disconnected.add(connection)
-            
-            # Remove disconnected connections
-            for connection in disconnected:
-                self.disconnect(connection, user_id)
-                if user_id in self.active_connections and not self.active_connections[user_id]:
-                    disconnected_users.append(user_id)
-        
-        # Clean up empty user entries
-        for user_id in disconnected_users:
-            if user_id in self.active_connections and not self.active_connections[user_id]:
-                del self.active_connections[user_id]
+        """Broadcast message to all connected clients on every worker"""
+        await self._publish(BROADCAST_CHANNEL, message)
+    
+    def stats(self) -> dict:
+        depths = [len(connection.queue) for connection in self.connections.values()]
+        return {
+            "connections": len(self.connections),
+            "users": len(self.active_connections),
+            "replay_buffers": len(self.replay_buffers),
+            "queued_messages": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "sent_messages": self.sent_messages,
+            "failed_messages": self.failed_messages,
+            "dropped_messages": self.dropped_messages,
+            "coalesced_messages": self.coalesced_messages,
+        }
 
 
 manager = ConnectionManager()
 
+registry.gauge_callback(
+    "rideasy_websocket_connections", "Open WebSocket connections on this worker",
+    lambda: len(manager.connections)
+)
+registry.gauge_callback(
+    "rideasy_websocket_users", "Users with at least one WebSocket connection on this worker",
+    lambda: len(manager.active_connections)
+)
+registry.gauge_callback(
+    "rideasy_websocket_queued_messages", "Messages waiting in WebSocket send queues",
+    lambda: sum(len(connection.queue) for connection in manager.connections.values())
+)
+registry.counter_callback(
+    "rideasy_websocket_messages_sent_total", "WebSocket messages sent",
+    lambda: manager.sent_messages
+)
+registry.counter_callback(
+    "rideasy_websocket_messages_failed_total", "WebSocket sends that failed and dropped the socket",
+    lambda: manager.failed_messages
+)
+registry.counter_callback(
+    "rideasy_websocket_messages_dropped_total", "WebSocket messages dropped by a full send queue",
+    lambda: manager.dropped_messages
+)
+registry.counter_callback(
+    "rideasy_websocket_messages_coalesced_total", "Queued ride updates replaced by a newer one",
+    lambda: manager.coalesced_messages
+)
+
 
 async def get_current_user_from_token(token: str, db: AsyncSession):
     """Extract user from token for WebSocket authentication"""
-    try:
-        from jose import jwt
-        import os
-        from dotenv import load_dotenv
-        
-        load_dotenv()
-        SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
-        
-        payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            return None
-        
-        user = await db.get(User, user_id)
-        return user
-    except Exception:
+    user_id = decode_token_subject(token)
+    if user_id is None:
         return None
+    return await get_user_by_id(user_id, db)
+
+
+def _is_coordinate(value, limit: float) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and -limit <= value <= limit
+
+
+async def handle_location_message(user: User, message: dict, websocket: WebSocket):
+    """Apply a streamed driver position in memory and queue it for the next DB flush"""
+    if user.user_mode.value != "driver":
+        await manager.send_personal_message({
+            "type": "error",
+            "message": "Only drivers can stream their location"
+        }, websocket)
+        return
+    
+    latitude = message.get("latitude")
+    longitude = message.get("longitude")
+    if not _is_coordinate(latitude, 90) or not _is_coordinate(longitude, 180):
+        await manager.send_personal_message({
+            "type": "error",
+            "message": "Invalid location"
+        }, websocket)
+        return
+    
+    location_writer.record(user.id, latitude, longitude)
+    # Offline drivers are persisted but not made matchable
+    if driver_index.is_online(user.id):
+        driver_index.update(user.id, latitude, longitude)
 
 
 @router.websocket("/ride-updates")
-async def websocket_endpoint(websocket: WebSocket, token: str = None):
+async def websocket_endpoint(websocket: WebSocket, token: str = None, since: Optional[int] = None):
     if not token:
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
         return
     
-    # Get database session
-    from app.database import AsyncSessionLocal
+    # Only hold a database session for authentication, not for the socket's lifetime
     async with AsyncSessionLocal() as db:
         user = await get_current_user_from_token(token, db)
-        if not user:
-            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
-            return
-        
-        await manager.connect(websocket, user.id)
-        
-        try:
-            # Send welcome message
-            await manager.send_personal_message({
-                "type": "connected",
-                "message": f"Connected as {user.username}"
-            }, websocket)
+    if not user:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    
+    # Clients opt in to MessagePack by offering its subprotocol; everyone else gets JSON
+    encoding = Encoding.MSGPACK if MSGPACK_SUBPROTOCOL in websocket.scope.get("subprotocols", []) else Encoding.JSON
+    await manager.connect(websocket, user.id, encoding, since, greeting=f"Connected as {user.username}")
+    
+    try:
+        # Keep connection alive and handle incoming messages
+        while True:
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", status.WS_1000_NORMAL_CLOSURE))
+            try:
+                # Text frames carry JSON, binary frames MessagePack, whatever was negotiated
+                if frame.get("text") is not None:
+                    message = orjson.loads(frame["text"])
+                else:
+                    message = msgpack.unpackb(frame["bytes"])
+                if not isinstance(message, dict):
+                    raise ValueError("Expected an object")
+            except (ValueError, msgpack.UnpackException):
+                await manager.send_personal_message({
+                    "type": "error",
+                    "message": "Invalid JSON format" if frame.get("text") is not None else "Invalid MessagePack format"
+                }, websocket)
+                continue
             
-            # Keep connection alive and handle incoming messages
-            while True:
-                data = await websocket.receive_text()
-                try:
-                    message = json.loads(data)
-                    # Handle different message types if needed
-                    if message.get("type") == "ping":
-                        await manager.send_personal_message({"type": "pong"}, websocket)
-                except json.JSONDecodeError:
-                    await manager.send_personal_message({
-                        "type": "error",
-                        "message": "Invalid JSON format"
-                    }, websocket)
-        
-        except WebSocketDisconnect:
-            manager.disconnect(websocket, user.id)
+            # Handle different message types if needed
+            if message.get("type") == "ping":
+                await manager.send_personal_message({"type": "pong"}, websocket)
+            elif message.get("type") == "location":
+                await handle_location_message(user, message, websocket)
+    
+    except WebSocketDisconnect:
+        pass
+    finally:
+        manager.disconnect(websocket, user.id)
 
@@ -1,8 +1,16 @@
 from pydantic import BaseModel, EmailStr, Field
-from typing import Optional
+from typing import Any, List, Optional
 from datetime import datetime
+import os
+from dotenv import load_dotenv
+
 from app.models import UserMode, RideStatus
 
+load_dotenv()
+
+# Pickup/destination pairs accepted by one quotes request
+QUOTES_MAX_PAIRS = int(os.getenv("QUOTES_MAX_PAIRS", "100"))
+
 
 # User Schemas
 class UserBase(BaseModel):
@@ -83,6 +91,7 @@ class RideResponse(BaseModel):
     completed_at: Optional[datetime] = None
     created_at: datetime
     updated_at: datetime
+    version: int = 1
     rider_name: Optional[str] = None
     driver_name: Optional[str] = None
     rider_rating: Optional[float] = None
@@ -92,6 +101,27 @@ class RideResponse(BaseModel):
         from_attributes = True
 
 
+class Coordinates(BaseModel):
+    latitude: float = Field(..., ge=-90, le=90)
+    longitude: float = Field(..., ge=-180, le=180)
+
+
+class QuotePair(BaseModel):
+    pickup_location: Coordinates
+    destination_location: Coordinates
+
+
+class QuoteRequest(BaseModel):
+    # Bounded here so an oversized list is rejected while parsing, not after it
+    pairs: List[QuotePair] = Field(..., min_length=1, max_length=QUOTES_MAX_PAIRS)
+
+
+class QuoteResponse(BaseModel):
+    distance_km: float
+    fare: float
+    estimated_duration_minutes: float
+
+
 class RideUpdate(BaseModel):
     status: Optional[RideStatus] = None
     driver_id: Optional[str] = None
@@ -117,3 +147,14 @@ class RideStatusUpdate(BaseModel):
     driver_id: Optional[str] = None
     estimated_arrival: Optional[datetime] = None
 
+
+# Admin Schemas
+class SlowQueryResponse(BaseModel):
+    id: int
+    recorded_at: datetime
+    duration_ms: float
+    route: str
+    statement: str
+    parameters: Any
+    rows: int
+    plan: Optional[str] = None
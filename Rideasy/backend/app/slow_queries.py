@@ -0,0 +1,150 @@
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from collections import deque
+from datetime import datetime
+from typing import Any, Deque, List, Optional, Set
+import asyncio
+import itertools
+import logging
+import os
+import random
+import time
+from dotenv import load_dotenv
+
+from app.metrics import BACKGROUND_ROUTE, background_task, current_request, route_template
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY_LOG_ENABLED = os.getenv("SLOW_QUERY_LOG_ENABLED", "false").lower() == "true"
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", "100"))
+# Fraction of slow statements recorded, so a flood of them stays cheap
+SLOW_QUERY_SAMPLE_RATE = float(os.getenv("SLOW_QUERY_SAMPLE_RATE", "1.0"))
+SLOW_QUERY_BUFFER_SIZE = int(os.getenv("SLOW_QUERY_BUFFER_SIZE", "200"))
+# Re-run recorded SELECTs under EXPLAIN (ANALYZE, BUFFERS) on a separate connection (Postgres only)
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "false").lower() == "true"
+SLOW_QUERY_EXPLAIN_TIMEOUT_MS = int(os.getenv("SLOW_QUERY_EXPLAIN_TIMEOUT_MS", "5000"))
+
+MAX_STATEMENT_CHARS = 10000
+
+
+def redact(value: Any) -> Any:
+    """Replace bound values with their type name, keeping the shape of the parameters"""
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    if isinstance(value, dict):
+        return {key: redact(item) for key, item in value.items()}
+    return f"<{type(value).__name__}>"
+
+
+def _explainable(statement: str) -> bool:
+    # EXPLAIN ANALYZE executes the statement, so only plain reads qualify
+    normalized = statement.lstrip().upper()
+    return normalized.startswith("SELECT") and "FOR UPDATE" not in normalized
+
+
+class SlowQueryLog:
+    """
+    Records statements slower than a threshold, with redacted parameters and
+    the route that ran them, in a bounded ring buffer. Optionally captures
+    their plan with EXPLAIN (ANALYZE, BUFFERS), one at a time, on a side
+    connection.
+    """
+
+    def __init__(
+        self,
+        threshold_ms: float = SLOW_QUERY_THRESHOLD_MS,
+        sample_rate: float = SLOW_QUERY_SAMPLE_RATE,
+        buffer_size: int = SLOW_QUERY_BUFFER_SIZE,
+        explain: bool = SLOW_QUERY_EXPLAIN
+    ):
+        self.threshold_seconds = threshold_ms / 1000
+        self.sample_rate = sample_rate
+        self.explain = explain
+        self.entries: Deque[dict] = deque(maxlen=buffer_size)
+        self.engine: Optional[AsyncEngine] = None
+        self._ids = itertools.count(1)
+        self._explaining = False
+        self._tasks: Set[asyncio.Task] = set()
+
+    def instrument(self, engine: AsyncEngine):
+        self.engine = engine
+        if engine.dialect.name != "postgresql":
+            self.explain = False
+
+        @event.listens_for(engine.sync_engine, "before_cursor_execute")
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault("slow_query_started", []).append(time.perf_counter())
+
+        @event.listens_for(engine.sync_engine, "after_cursor_execute")
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            elapsed = time.perf_counter() - conn.info["slow_query_started"].pop()
+            if elapsed >= self.threshold_seconds and random.random() < self.sample_rate:
+                self.record(statement, parameters, executemany, elapsed)
+
+        @event.listens_for(engine.sync_engine, "handle_error")
+        def handle_error(exception_context):
+            if exception_context.connection is not None:
+                started = exception_context.connection.info.get("slow_query_started")
+                if started:
+                    started.pop()
+
+    def record(self, statement: str, parameters, executemany: bool, elapsed: float):
+        request = current_request.get()
+        if request is None:
+            route = BACKGROUND_ROUTE
+        else:
+            route = f"{request.scope['method']} {route_template(request.scope)}"
+
+        entry = {
+            "id": next(self._ids),
+            "recorded_at": datetime.utcnow(),
+            "duration_ms": round(elapsed * 1000, 3),
+            "route": route,
+            "statement": statement[:MAX_STATEMENT_CHARS],
+            # For executemany only the first row's shape is kept
+            "parameters": redact(parameters[0] if executemany and parameters else parameters),
+            "rows": len(parameters) if executemany else 1,
+            "plan": None,
+        }
+        self.entries.append(entry)
+        logger.warning("Slow query (%.1f ms) on %s: %s", entry["duration_ms"], route, statement[:200])
+
+        if self.explain and not executemany and not self._explaining and _explainable(statement):
+            self._explaining = True
+            task = background_task(self._explain(entry, statement, parameters))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _explain(self, entry: dict, statement: str, parameters):
+        try:
+            async with self.engine.connect() as conn:
+                raw = await conn.get_raw_connection()
+                # The asyncpg connection, so the plan query itself is not timed or recorded
+                driver = raw.driver_connection
+                transaction = driver.transaction()
+                await transaction.start()
+                try:
+                    await driver.execute(f"SET LOCAL statement_timeout = {SLOW_QUERY_EXPLAIN_TIMEOUT_MS}")
+                    rows = await driver.fetch(f"EXPLAIN (ANALYZE, BUFFERS) {statement}", *(parameters or ()))
+                finally:
+                    await transaction.rollback()
+            entry["plan"] = "\n".join(row[0] for row in rows)
+        except Exception as e:
+            entry["plan"] = f"EXPLAIN failed: {e}"
+        finally:
+            self._explaining = False
+
+    def recent(self, limit: Optional[int] = None) -> List[dict]:
+        """Recorded statements, newest first"""
+        entries = list(reversed(self.entries))
+        return entries if limit is None else entries[:limit]
+
+    def clear(self):
+        self.entries.clear()
+
+
+slow_query_log = SlowQueryLog()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Race many drivers to accept the same ride
+
+Usage:
+    DATABASE_URL=postgresql+asyncpg://... python benchmarks/bench_accept_contention.py [--drivers 100] [--rounds 20]
+    python benchmarks/bench_accept_contention.py --sqlite /tmp/rideasy-accept.db
+
+Starts one uvicorn worker with the batch matching engine effectively idle,
+so rides stay searching until a driver accepts them. Each round a rider
+creates a ride and --drivers online drivers all POST /accept at once, each
+on its own HTTP connection. Checks that exactly one accept succeeds, that
+every other one gets 409 and that the ride ends up with the winner, then
+the winner completes the ride for the next round. Reports latency of
+winning and losing accepts and SQL statements per accept, read from
+/metrics. Needs httpx (benchmarks/requirements.txt).
+"""
+import argparse
+import asyncio
+import os
+import re
+import subprocess
+import sys
+import time
+import uuid
+from collections import Counter
+from typing import List, Tuple
+
+import httpx
+
+from common import migrate, percentile, start_server, stop_servers, wait_until_healthy
+
+PICKUP = {"name": "Marienplatz", "latitude": 48.137, "longitude": 11.575}
+DESTINATION = {"name": "Munich Airport", "latitude": 48.354, "longitude": 11.786}
+ACCEPT_ROUTE = "/api/rides/{ride_id}/accept"
+
+
+async def register(client: httpx.AsyncClient, mode: str) -> dict:
+    name = f"race-{mode}-{uuid.uuid4().hex[:10]}"
+    response = await client.post("/api/auth/register", json={
+        "email": f"{name}@example.com", "username": name, "password": "password123", "user_mode": mode,
+    })
+    response.raise_for_status()
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+async def accept_statements(client: httpx.AsyncClient) -> Tuple[float, float]:
+    """Sum and count of SQL statements per accept request so far"""
+    text = (await client.get("/metrics")).text
+    values = []
+    for series in ("sum", "count"):
+        match = re.search(
+            rf'^rideasy_db_statements_per_request_{series}{{method="POST",route="{re.escape(ACCEPT_ROUTE)}"}} (\S+)$',
+            text, re.MULTILINE
+        )
+        values.append(float(match.group(1)) if match else 0.0)
+    return values[0], values[1]
+
+
+async def race(base_url: str, ride_id: str, drivers: List[dict]) -> List[Tuple[int, float]]:
+    """Every driver accepts ride_id at once; returns (status, latency ms) per driver"""
+    start = asyncio.Event()
+
+    async def accept(client: httpx.AsyncClient, headers: dict) -> Tuple[int, float]:
+        await start.wait()
+        started = time.perf_counter()
+        response = await client.post(f"/api/rides/{ride_id}/accept", headers=headers)
+        return response.status_code, (time.perf_counter() - started) * 1000
+
+    # One client per driver, warmed up, so every accept has its own open connection
+    clients = [httpx.AsyncClient(base_url=base_url, timeout=60) for _ in drivers]
+    try:
+        await asyncio.gather(*[client.get("/health") for client in clients])
+        tasks = [asyncio.ensure_future(accept(client, headers)) for client, headers in zip(clients, drivers)]
+        await asyncio.sleep(0)
+        start.set()
+        return await asyncio.gather(*tasks)
+    finally:
+        await asyncio.gather(*[client.aclose() for client in clients])
+
+
+async def run(base_url: str, args) -> bool:
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as client:
+        rider = await register(client, "rider")
+        drivers = []
+        for _ in range(args.drivers):
+            headers = await register(client, "driver")
+            response = await client.put("/api/users/driver/availability", headers=headers, json={
+                "is_online": True, "latitude": PICKUP["latitude"] + 0.01, "longitude": PICKUP["longitude"],
+            })
+            response.raise_for_status()
+            drivers.append(headers)
+
+        statements_before = await accept_statements(client)
+        won_ms, lost_ms = [], []
+        statuses: Counter = Counter()
+        ok = True
+        for round_number in range(args.rounds):
+            response = await client.post("/api/rides", headers=rider, json={
+                "pickup_location": PICKUP, "destination_location": DESTINATION,
+            })
+            response.raise_for_status()
+            ride = response.json()
+            if ride["status"] != "searching":
+                print(f"Round {round_number}: ride was {ride['status']} before the race; is matching idle?")
+                return False
+
+            results = await race(base_url, ride["id"], drivers)
+            statuses.update(status for status, _ in results)
+            winners = [index for index, (status, _) in enumerate(results) if status == 200]
+            won_ms += [elapsed for status, elapsed in results if status == 200]
+            lost_ms += [elapsed for status, elapsed in results if status == 409]
+
+            final = (await client.get(f"/api/rides/{ride['id']}", headers=rider)).json()
+            if len(winners) != 1:
+                print(f"Round {round_number}: {len(winners)} winners")
+                ok = False
+            if any(status not in (200, 409) for status, _ in results):
+                print(f"Round {round_number}: unexpected statuses {sorted(set(s for s, _ in results))}")
+                ok = False
+            if not winners:
+                await client.post(f"/api/rides/{ride['id']}/cancel", headers=rider)
+                continue
+            winner = drivers[winners[0]]
+            me = (await client.get("/api/users/me", headers=winner)).json()
+            if final["driver_id"] != me["id"] or final["status"] != "matched":
+                print(f"Round {round_number}: ride ended up {final['status']} with driver {final['driver_id']}")
+                ok = False
+            response = await client.put(f"/api/rides/{ride['id']}", headers=winner, json={"status": "completed"})
+            response.raise_for_status()
+
+        statements_after = await accept_statements(client)
+
+    accepts = statements_after[1] - statements_before[1]
+    statements = (statements_after[0] - statements_before[0]) / accepts if accepts else float("nan")
+    print(f"{args.drivers} drivers x {args.rounds} rounds, statuses {dict(sorted(statuses.items()))}")
+    print(f"{'accept':<8} {'count':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for label, samples in (("won", won_ms), ("lost", lost_ms)):
+        print(
+            f"{label:<8} {len(samples):>6} {percentile(samples, 0.50):>8.1f} {percentile(samples, 0.95):>8.1f} "
+            f"{percentile(samples, 0.99):>8.1f} {max(samples, default=float('nan')):>8.1f}"
+        )
+    print(f"SQL statements per accept (incl. auth): {statements:.2f}")
+    print("exactly one winner per round" if ok else "FAILED")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--sqlite", metavar="PATH", help="serve from this SQLite file instead of DATABASE_URL")
+    parser.add_argument("--port", type=int, default=int(os.getenv("BENCH_PORT", "8132")))
+    parser.add_argument("--drivers", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    env = {
+        "BCRYPT_ROUNDS": "4",
+        # Matching runs once at startup and then never again during the benchmark
+        "BATCH_MATCHING_ENABLED": "true",
+        "MATCHING_TICK_SECONDS": "86400",
+        "RIDES_ARCHIVE_ENABLED": "false",
+        # 100 accepts in flight would shed the checks between rounds
+        "ADMISSION_CONTROL_ENABLED": "false",
+    }
+    if args.sqlite:
+        env["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.abspath(args.sqlite)}"
+    migrate(env)
+    server = start_server(args.port, env, stdout=subprocess.DEVNULL)
+    try:
+        wait_until_healthy(args.port)
+        ok = asyncio.run(run(f"http://127.0.0.1:{args.port}", args))
+    finally:
+        stop_servers([server])
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
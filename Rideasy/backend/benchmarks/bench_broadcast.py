@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Benchmark fanning one message out to many WebSockets
+
+Usage:
+    python benchmarks/bench_broadcast.py --sqlite /tmp/rideasy-bench.db [--sockets 10000] [--broadcasts 20]
+    DATABASE_URL=postgresql+asyncpg://... python benchmarks/bench_broadcast.py
+
+Starts one uvicorn worker of main:app plus a POST /bench/broadcast route
+that calls ConnectionManager.broadcast, then opens --sockets sockets from
+several client processes, spread over --users users. Each broadcast carries
+a ride update sized payload. For every combination of frame encoding (JSON
+text, MessagePack via the rideasy.msgpack subprotocol) and compression
+(none, client-offered permessage-deflate) it reports the server's CPU time
+per broadcast, read from /proc, and the time until the last socket had the
+message. Client and server share the machine, so delivery time includes
+client-side work; server CPU is the number to compare. Linux only.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import resource
+import subprocess
+import time
+import uuid
+from typing import List
+
+import websockets
+
+from common import migrate, percentile, request, start_server, stop_servers, wait_until_healthy
+
+MSGPACK_SUBPROTOCOL = "rideasy.msgpack"
+CONNECT_CONCURRENCY = 200
+DELIVERY_TIMEOUT_SECONDS = 120
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+RIDE = {
+    "id": "4f1c2b9e-8d3a-4c55-9a7e-2b6f1e0d9c31",
+    "rider_id": "0b6a7c1d-2e3f-4a5b-8c9d-0e1f2a3b4c5d",
+    "driver_id": "9e8d7c6b-5a4f-4e3d-8c2b-1a0f9e8d7c6b",
+    "pickup_location": {"id": "7d3e5f1a-2b4c-4d6e-8f0a-1b2c3d4e5f60", "name": "Marienplatz",
+                        "latitude": 48.13743, "longitude": 11.57549},
+    "destination_location": {"id": "1a2b3c4d-5e6f-4a7b-8c9d-0e1f2a3b4c5d", "name": "Munich Airport",
+                             "latitude": 48.35378, "longitude": 11.78609},
+    "status": "matched",
+    "fare": 47.85,
+    "estimated_arrival": "2026-10-18T08:21:14.512000",
+    "created_at": "2026-10-18T08:12:03.101000",
+    "started_at": None,
+    "completed_at": None,
+}
+
+
+def create_app():
+    """main:app with a route that broadcasts the posted message (uvicorn --factory)"""
+    from main import app
+    from app.routers.websocket import manager
+
+    @app.post("/bench/broadcast")
+    async def bench_broadcast(message: dict):
+        await manager.broadcast(message)
+        return {"connections": len(manager.connections)}
+
+    return app
+
+
+def cpu_seconds(pid: int) -> float:
+    """User plus system CPU time of a process"""
+    with open(f"/proc/{pid}/stat") as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+async def client_sockets(url: str, tokens: List[str], encoding: str, compression: str, broadcasts: int, pipe):
+    """Hold sockets open and report when all of them have each broadcast"""
+    subprotocols = [MSGPACK_SUBPROTOCOL] if encoding == "msgpack" else None
+    semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+    received = [0] * broadcasts
+
+    async def connect(token: str):
+        async with semaphore:
+            socket = await websockets.connect(
+                f"{url}?token={token}",
+                subprotocols=subprotocols,
+                compression="deflate" if compression == "deflate" else None,
+                ping_interval=None,
+                open_timeout=120,
+                max_queue=None,
+            )
+            await socket.recv()  # "connected"
+            return socket
+
+    async def read(socket):
+        # Broadcasts are sent one at a time, so the n-th frame is broadcast n
+        for seq in range(broadcasts):
+            await socket.recv()
+            received[seq] += 1
+            if received[seq] == len(sockets):
+                pipe.send(("delivered", seq, time.time()))
+
+    sockets = await asyncio.gather(*[connect(token) for token in tokens])
+    pipe.send(("ready", len(sockets), 0.0))
+    await asyncio.gather(*[read(socket) for socket in sockets])
+    for socket in sockets:
+        await socket.close()
+
+
+def run_client(url, tokens, encoding, compression, broadcasts, pipe):
+    asyncio.run(client_sockets(url, tokens, encoding, compression, broadcasts, pipe))
+
+
+def bench(port: int, server_pid: int, tokens: List[str], args, encoding: str, compression: str) -> dict:
+    url = f"ws://127.0.0.1:{port}/ws/ride-updates"
+    clients = []
+    for index in range(args.clients):
+        parent, child = multiprocessing.Pipe()
+        share = [tokens[i % len(tokens)] for i in range(index, args.sockets, args.clients)]
+        process = multiprocessing.Process(
+            target=run_client, args=(url, share, encoding, compression, args.broadcasts, child)
+        )
+        process.start()
+        clients.append((process, parent))
+
+    for _, pipe in clients:
+        pipe.recv()
+
+    delivery_ms = []
+    cpu_started = cpu_seconds(server_pid)
+    for seq in range(args.broadcasts):
+        sent = time.time()
+        request(port, "POST", "/bench/broadcast", {"type": "ride_update", "seq": seq, "data": RIDE})
+        finished = sent
+        for _, pipe in clients:
+            if not pipe.poll(DELIVERY_TIMEOUT_SECONDS):
+                raise RuntimeError(f"Broadcast {seq} was not delivered to every socket")
+            _, _, delivered_at = pipe.recv()
+            finished = max(finished, delivered_at)
+        delivery_ms.append((finished - sent) * 1000)
+    cpu_ms = (cpu_seconds(server_pid) - cpu_started) * 1000 / args.broadcasts
+
+    for process, _ in clients:
+        process.join()
+    return {"cpu_ms": cpu_ms, "p50": percentile(delivery_ms, 0.50), "max": max(delivery_ms)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--sqlite", metavar="PATH", help="serve from this SQLite file instead of DATABASE_URL")
+    parser.add_argument("--port", type=int, default=int(os.getenv("BENCH_PORT", "8131")))
+    parser.add_argument("--sockets", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=100, help="sockets are spread over this many users")
+    parser.add_argument("--clients", type=int, default=4, help="client processes holding the sockets")
+    parser.add_argument("--broadcasts", type=int, default=20)
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    env = {"BCRYPT_ROUNDS": "4", "BATCH_MATCHING_ENABLED": "false", "RIDES_ARCHIVE_ENABLED": "false"}
+    if args.sqlite:
+        env["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.abspath(args.sqlite)}"
+    migrate(env)
+    server = start_server(
+        args.port, env, stdout=subprocess.DEVNULL,
+        app="bench_broadcast:create_app", extra_args=["--factory", "--app-dir", "benchmarks"]
+    )
+    try:
+        wait_until_healthy(args.port)
+        tokens = []
+        for _ in range(args.users):
+            name = f"bcast-{uuid.uuid4().hex[:10]}"
+            tokens.append(request(args.port, "POST", "/api/auth/register", {
+                "email": f"{name}@example.com", "username": name, "password": "password123",
+            })["access_token"])
+
+        print(f"{args.sockets} sockets, {args.broadcasts} broadcasts each")
+        print(f"{'encoding':<10} {'compression':<12} {'server CPU/broadcast':>21} {'delivery p50':>13} {'max':>10}")
+        for encoding in ("json", "msgpack"):
+            for compression in ("none", "deflate"):
+                result = bench(args.port, server.pid, tokens, args, encoding, compression)
+                print(
+                    f"{encoding:<10} {compression:<12} {result['cpu_ms']:>18.1f} ms "
+                    f"{result['p50']:>10.1f} ms {result['max']:>7.1f} ms"
+                )
+    finally:
+        stop_servers([server])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Measure SQL statements, transactions and latency of POST /api/rides
+
+Usage:
+    DATABASE_URL=postgresql+asyncpg://... python benchmarks/bench_create_ride.py [iterations]
+
+Runs the app in-process, registers a rider and repeatedly creates and
+cancels a ride. Only the create request is measured. Statement and
+transaction counts come from SQLAlchemy engine events. Needs httpx
+(benchmarks/requirements.txt).
+"""
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BATCH_MATCHING_ENABLED", "true")
+# One rider creating rides back to back would trip the per-user rate limit
+os.environ.setdefault("ADMISSION_CONTROL_ENABLED", "false")
+
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+from app.database import engine
+from common import percentile
+from main import app
+
+RIDE = {
+    "pickup_location": {"name": "Marienplatz", "latitude": 48.137, "longitude": 11.575},
+    "destination_location": {"name": "Airport", "latitude": 48.353, "longitude": 11.786},
+}
+
+
+class Counter:
+    def __init__(self):
+        self.statements = 0
+        self.commits = 0
+
+    def on_statement(self, *args):
+        self.statements += 1
+
+    def on_commit(self, *args):
+        self.commits += 1
+
+
+def main(iterations: int):
+    counter = Counter()
+    statements, commits, latencies = [], [], []
+    with TestClient(app) as client:
+        name = f"bench-rider-{uuid.uuid4().hex[:8]}"
+        token = client.post("/api/auth/register", json={
+            "email": f"{name}@example.com",
+            "username": name,
+            "password": "password123",
+        }).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+
+        event.listen(engine.sync_engine, "before_cursor_execute", counter.on_statement)
+        event.listen(engine.sync_engine, "commit", counter.on_commit)
+        try:
+            for _ in range(iterations):
+                counter.statements = counter.commits = 0
+                started = time.perf_counter()
+                response = client.post("/api/rides", json=RIDE, headers=headers)
+                latencies.append((time.perf_counter() - started) * 1000)
+                statements.append(counter.statements)
+                commits.append(counter.commits)
+                assert response.status_code == 201, response.text
+                client.post(f"/api/rides/{response.json()['id']}/cancel", headers=headers)
+        finally:
+            event.remove(engine.sync_engine, "before_cursor_execute", counter.on_statement)
+            event.remove(engine.sync_engine, "commit", counter.on_commit)
+
+    # The first request warms the auth cache; report the steady state
+    steady = slice(1, None) if iterations > 1 else slice(None)
+    print(f"dialect:              {engine.dialect.name}")
+    print(f"statements / create:  {max(statements[steady])}")
+    print(f"commits / create:     {max(commits[steady])}")
+    print(f"latency p50:          {percentile(latencies[steady], 0.50):.2f} ms")
+    print(f"latency p99:          {percentile(latencies[steady], 0.99):.2f} ms")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
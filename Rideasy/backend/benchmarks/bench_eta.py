@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Benchmark learning and querying the ETA speed tables
+
+Usage:
+    python benchmarks/bench_eta.py [trips]
+
+Learns speed tables from synthetic completed trips spread over a ~40 km
+square (default 1,000,000), then times scalar lookups and one vectorized
+lookup for 10k candidate drivers, as the matching engine does per tick.
+"""
+import os
+import sys
+import time
+import timeit
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.eta import EtaEstimator
+from app.geo import haversine_km_array
+
+CENTER_LAT, CENTER_LON = 48.137, 11.575
+SPREAD_DEG = 0.2
+CANDIDATES = 10000
+
+
+def main(trips: int):
+    rng = np.random.default_rng(42)
+    pickup_lats = CENTER_LAT + rng.uniform(-SPREAD_DEG, SPREAD_DEG, trips)
+    pickup_lons = CENTER_LON + rng.uniform(-SPREAD_DEG, SPREAD_DEG, trips)
+    dest_lats = pickup_lats + rng.uniform(-0.05, 0.05, trips)
+    dest_lons = pickup_lons + rng.uniform(-0.05, 0.05, trips)
+    hours = rng.integers(0, 24, trips)
+    # Rush hours are slower
+    speeds = np.where((hours >= 7) & (hours <= 9) | (hours >= 16) & (hours <= 18), 15.0, 30.0)
+    durations = haversine_km_array(pickup_lats, pickup_lons, dest_lats, dest_lons) / speeds
+
+    estimator = EtaEstimator()
+    start = time.perf_counter()
+    estimator.learn(pickup_lats, pickup_lons, dest_lats, dest_lons, hours, durations)
+    learn_ms = (time.perf_counter() - start) * 1000
+
+    lats = CENTER_LAT + rng.uniform(-SPREAD_DEG, SPREAD_DEG, CANDIDATES)
+    lons = CENTER_LON + rng.uniform(-SPREAD_DEG, SPREAD_DEG, CANDIDATES)
+    points = list(zip(lats.tolist(), lons.tolist()))
+    scalar_s = min(timeit.repeat(lambda: [estimator.speed_kmh(lat, lon, 8) for lat, lon in points], number=1, repeat=5))
+    vector_s = min(timeit.repeat(lambda: estimator.speeds_kmh_array(lats, lons, 8), number=1, repeat=5))
+
+    print(f"learn {trips} trips:            {learn_ms:8.1f} ms  ({len(estimator.cell_keys)} cells, {estimator.cell_speeds.nbytes} bytes)")
+    print(f"scalar lookup:                 {scalar_s / CANDIDATES * 1e6:8.2f} us per driver")
+    print(f"vectorized lookup, {CANDIDATES} drivers: {vector_s * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Benchmark login throughput while ride requests are in flight
+
+Usage:
+    DATABASE_URL=postgresql+asyncpg://... python benchmarks/bench_login.py [duration_seconds]
+
+Runs a single-worker server twice: once hashing on the event loop
+(PASSWORD_HASH_WORKERS=0) and once with the hashing thread pool. In each
+run LOGIN_CONCURRENCY clients log in back to back while RIDE_CONCURRENCY
+riders create and cancel rides, and the script reports logins per second
+and ride request latency. Needs httpx (benchmarks/requirements.txt).
+"""
+import asyncio
+import os
+import sys
+import time
+import uuid
+from typing import Dict, List
+
+import httpx
+
+from common import percentile, request, start_server, stop_servers, wait_until_healthy
+
+PORT = int(os.getenv("BENCH_PORT", "8111"))
+LOGIN_CONCURRENCY = int(os.getenv("LOGIN_CONCURRENCY", "8"))
+RIDE_CONCURRENCY = int(os.getenv("RIDE_CONCURRENCY", "16"))
+PASSWORD = "password123"
+
+
+def register(mode: str = "rider") -> Dict[str, str]:
+    name = f"bench-{mode}-{uuid.uuid4().hex[:8]}"
+    email = f"{name}@example.com"
+    result = request(PORT, "POST", "/api/auth/register", {
+        "email": email,
+        "username": name,
+        "password": PASSWORD,
+        "user_mode": mode,
+    })
+    return {"email": email, "token": result["access_token"]}
+
+
+async def login_loop(client: httpx.AsyncClient, email: str, deadline: float, counts: List[int]):
+    while time.monotonic() < deadline:
+        response = await client.post("/api/auth/login", json={"email": email, "password": PASSWORD})
+        if response.status_code == 200:
+            counts[0] += 1
+        else:
+            counts[1] += 1
+
+
+async def ride_loop(client: httpx.AsyncClient, token: str, deadline: float, latencies: List[float]):
+    headers = {"Authorization": f"Bearer {token}"}
+    ride = {
+        "pickup_location": {"name": "Pickup", "latitude": 48.137, "longitude": 11.575},
+        "destination_location": {"name": "Destination", "latitude": 48.15, "longitude": 11.6},
+    }
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        response = await client.post("/api/rides", json=ride, headers=headers)
+        latencies.append((time.perf_counter() - started) * 1000)
+        if response.status_code == 201:
+            started = time.perf_counter()
+            await client.post(f"/api/rides/{response.json()['id']}/cancel", headers=headers)
+            latencies.append((time.perf_counter() - started) * 1000)
+
+
+async def measure(duration: float) -> Dict[str, float]:
+    login_user = register()
+    riders = [register() for _ in range(RIDE_CONCURRENCY)]
+    counts = [0, 0]
+    latencies: List[float] = []
+    limits = httpx.Limits(max_connections=LOGIN_CONCURRENCY + RIDE_CONCURRENCY)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{PORT}", limits=limits, timeout=60) as client:
+        deadline = time.monotonic() + duration
+        await asyncio.gather(
+            *[login_loop(client, login_user["email"], deadline, counts) for _ in range(LOGIN_CONCURRENCY)],
+            *[ride_loop(client, rider["token"], deadline, latencies) for rider in riders],
+        )
+    return {
+        "logins_per_second": counts[0] / duration,
+        "login_errors": counts[1],
+        "ride_requests": len(latencies),
+        "ride_p50_ms": percentile(latencies, 0.50),
+        "ride_p99_ms": percentile(latencies, 0.99),
+    }
+
+
+def run(label: str, env: Dict[str, str], duration: float):
+    # Shedding rides under load would hide the latency this compares
+    server = start_server(PORT, {"ADMISSION_CONTROL_ENABLED": "false", **env})
+    try:
+        wait_until_healthy(PORT)
+        result = asyncio.run(measure(duration))
+    finally:
+        stop_servers([server])
+    print(
+        f"{label:<22} {result['logins_per_second']:7.1f} logins/s  "
+        f"({result['login_errors']} errors)   rides p50 {result['ride_p50_ms']:7.1f} ms  "
+        f"p99 {result['ride_p99_ms']:7.1f} ms  ({result['ride_requests']} requests)"
+    )
+
+
+if __name__ == "__main__":
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 10.0
+    run("hashing on event loop", {"PASSWORD_HASH_WORKERS": "0"}, duration)
+    run("hashing thread pool", {}, duration)
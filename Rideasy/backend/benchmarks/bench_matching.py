@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Benchmark one batched matching tick (cost matrix + assignment)
+
+Usage:
+    python benchmarks/bench_matching.py [size ...]
+
+Each size N runs an N rides x N drivers assignment with points spread
+over a ~40 km square. Defaults to 1000 and 10000.
+"""
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.geo import haversine_km_matrix
+from app.matching import solve_assignment
+
+CENTER_LAT, CENTER_LON = 48.137, 11.575
+SPREAD_DEG = 0.2
+
+
+def random_points(rng: np.random.Generator, count: int) -> np.ndarray:
+    return np.column_stack([
+        CENTER_LAT + rng.uniform(-SPREAD_DEG, SPREAD_DEG, count),
+        CENTER_LON + rng.uniform(-SPREAD_DEG, SPREAD_DEG, count),
+    ])
+
+
+def run(size: int, rng: np.random.Generator):
+    rides = random_points(rng, size)
+    drivers = random_points(rng, size)
+
+    start = time.perf_counter()
+    haversine_km_matrix(rides[:, 0], rides[:, 1], drivers[:, 0], drivers[:, 1])
+    matrix_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    pairs = solve_assignment(rides, drivers)
+    tick_ms = (time.perf_counter() - start) * 1000
+
+    mean_km = sum(distance for _, _, distance in pairs) / max(len(pairs), 1)
+    print(
+        f"{size:>6} x {size:<6} cost matrix {matrix_ms:10.1f} ms   "
+        f"tick {tick_ms:10.1f} ms   matched {len(pairs):>6}   mean pickup {mean_km:.2f} km"
+    )
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000]
+    rng = np.random.default_rng(42)
+    for size in sizes:
+        run(size, rng)
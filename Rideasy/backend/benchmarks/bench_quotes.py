@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark batch fare quotes against the scalar fare function
+
+Usage:
+    python benchmarks/bench_quotes.py [size ...]
+
+Each size N prices N random pickup/destination pairs with a Python loop
+over calculate_fare and with one calculate_quotes call, checks that both
+give the same fares and prints the time per call. Defaults to 1, 100 and
+10000.
+"""
+import os
+import sys
+import timeit
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.pricing import calculate_fare, calculate_quotes
+
+CENTER_LAT, CENTER_LON = 48.137, 11.575
+SPREAD_DEG = 0.2
+
+
+def best_of(func, repeat: int = 5) -> float:
+    """Best time per call in microseconds"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e6
+
+
+def run(size: int, rng: np.random.Generator):
+    points = CENTER_LAT + rng.uniform(-SPREAD_DEG, SPREAD_DEG, (4, size))
+    points[[1, 3]] += CENTER_LON - CENTER_LAT
+    pickup_lats, pickup_lons, dest_lats, dest_lons = (column.tolist() for column in points)
+    pairs = list(zip(pickup_lats, pickup_lons, dest_lats, dest_lons))
+
+    scalar_fares = [calculate_fare(*pair) for pair in pairs]
+    _, batch_fares, _ = calculate_quotes(pickup_lats, pickup_lons, dest_lats, dest_lons)
+    mismatches = sum(a != b for a, b in zip(scalar_fares, batch_fares.tolist()))
+
+    scalar_us = best_of(lambda: [calculate_fare(*pair) for pair in pairs])
+    batch_us = best_of(lambda: calculate_quotes(pickup_lats, pickup_lons, dest_lats, dest_lons))
+    print(
+        f"{size:>6} pairs   scalar {scalar_us:10.1f} us   batch {batch_us:10.1f} us   "
+        f"speedup {scalar_us / batch_us:6.1f}x   fare mismatches {mismatches}"
+    )
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1, 100, 10000]
+    rng = np.random.default_rng(42)
+    for size in sizes:
+        run(size, rng)
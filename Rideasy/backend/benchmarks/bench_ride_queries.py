@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Count SQL statements needed to serialize a page of rides
+
+Usage:
+    python benchmarks/bench_ride_queries.py
+
+Seeds a throwaway rider with 50 rides in the configured DATABASE_URL
+(migrated with alembic upgrade head),
+serializes pages of 1, 10 and 50 rides through the bulk path
+(rides_to_responses) and the per-ride path (ride_to_response), prints the
+statement counts and exits non-zero if the bulk path does not use a
+constant number of queries. The seeded rows are deleted afterwards.
+"""
+import asyncio
+import os
+import sys
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import delete, event, select
+
+from app.database import engine, AsyncSessionLocal
+from app.models import User, Ride, Location, RideStatus, UserMode
+from app.routers.rides import ride_to_response, rides_to_responses
+
+PAGE_SIZES = [1, 10, 50]
+
+
+class StatementCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+async def seed(ride_count: int):
+    suffix = uuid.uuid4().hex[:8]
+    async with AsyncSessionLocal() as db:
+        rider = User(
+            email=f"bench-rider-{suffix}@example.com",
+            username=f"bench-rider-{suffix}",
+            hashed_password="x",
+        )
+        driver = User(
+            email=f"bench-driver-{suffix}@example.com",
+            username=f"bench-driver-{suffix}",
+            hashed_password="x",
+            user_mode=UserMode.DRIVER,
+        )
+        db.add_all([rider, driver])
+        await db.flush()
+        for i in range(ride_count):
+            pickup = Location(name=f"Pickup {i}", latitude=48.1, longitude=11.5)
+            destination = Location(name=f"Destination {i}", latitude=48.2, longitude=11.6)
+            db.add_all([pickup, destination])
+            await db.flush()
+            db.add(Ride(
+                rider_id=rider.id,
+                driver_id=driver.id,
+                pickup_location_id=pickup.id,
+                destination_location_id=destination.id,
+                status=RideStatus.COMPLETED,
+                fare=10.0,
+            ))
+        await db.commit()
+        return rider.id, driver.id
+
+
+async def cleanup(rider_id: str, driver_id: str):
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(Ride).where(Ride.rider_id == rider_id))
+        rides = result.scalars().all()
+        location_ids = [ride.pickup_location_id for ride in rides] + [ride.destination_location_id for ride in rides]
+        await db.execute(delete(Ride).where(Ride.rider_id == rider_id))
+        await db.execute(delete(Location).where(Location.id.in_(location_ids)))
+        await db.execute(delete(User).where(User.id.in_([rider_id, driver_id])))
+        await db.commit()
+
+
+async def main() -> int:
+    rider_id, driver_id = await seed(max(PAGE_SIZES))
+    counter = StatementCounter()
+    event.listen(engine.sync_engine, "before_cursor_execute", counter)
+    bulk_counts = []
+    try:
+        for page_size in PAGE_SIZES:
+            query = select(Ride).where(Ride.rider_id == rider_id).order_by(Ride.created_at.desc()).limit(page_size)
+
+            async with AsyncSessionLocal() as db:
+                counter.count = 0
+                responses = await rides_to_responses(query, db)
+                bulk = counter.count
+                assert len(responses) == page_size
+
+            async with AsyncSessionLocal() as db:
+                result = await db.execute(query)
+                counter.count = 0
+                for ride in result.scalars().all():
+                    await ride_to_response(ride, db)
+                per_ride = counter.count
+
+            bulk_counts.append(bulk)
+            print(f"{page_size:>3} rides   bulk path {bulk:>3} queries   per-ride path {per_ride:>4} queries")
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", counter)
+        await cleanup(rider_id, driver_id)
+        await engine.dispose()
+
+    if len(set(bulk_counts)) != 1:
+        print("FAIL: bulk path query count grows with page size")
+        return 1
+    print("OK: bulk path uses a constant number of queries")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Prove WebSocket delivery across worker processes
+
+Usage:
+    DATABASE_URL=postgresql+asyncpg://... python benchmarks/check_cross_worker_delivery.py
+
+Starts two independent uvicorn processes of main:app on separate ports with
+PUBSUB_BACKEND=postgres, like two workers behind a load balancer without
+sticky sessions. A rider and a driver keep their sockets on worker A while
+the driver goes online and accepts the ride through worker B; A must drop
+its cached snapshot of the driver, and both sockets on A must receive the
+resulting ride update. Then worker A's driver index
+must have followed B: a second rider's ride created on A stays searching
+while the driver is busy, and is matched to them once they finish their
+ride through B. Exits non-zero if any step fails.
+"""
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import uuid
+
+import websockets
+
+from common import migrate, request, start_server, stop_servers, wait_until_healthy
+
+PORT_A = int(os.getenv("WORKER_A_PORT", "8101"))
+PORT_B = int(os.getenv("WORKER_B_PORT", "8102"))
+DELIVERY_TIMEOUT_SECONDS = 10
+# Comfortably more than DRIVER_SYNC_INTERVAL_SECONDS and AUTH_CACHE_SYNC_INTERVAL_SECONDS
+INDEX_SYNC_WAIT_SECONDS = 2
+WORKER_ENV = {"PUBSUB_BACKEND": "postgres", "BATCH_MATCHING_ENABLED": "false"}
+
+
+def register(port: int, mode: str) -> str:
+    name = f"xworker-{mode}-{uuid.uuid4().hex[:8]}"
+    result = request(port, "POST", "/api/auth/register", {
+        "email": f"{name}@example.com",
+        "username": name,
+        "password": "password123",
+        "user_mode": mode,
+    })
+    return result["access_token"]
+
+
+async def wait_for_match(socket, ride_id: str) -> dict:
+    while True:
+        message = json.loads(await socket.recv())
+        if message.get("type") != "ride_update":
+            continue
+        if message["data"]["id"] == ride_id and message["data"].get("status") == "matched":
+            return message["data"]
+
+
+async def run() -> bool:
+    rider_token = register(PORT_A, "rider")
+    other_rider_token = register(PORT_A, "rider")
+    driver_token = register(PORT_B, "driver")
+    # A random remote spot so no driver left online in the database gets matched on A
+    latitude, longitude = random.uniform(-50, -40), random.uniform(-140, -120)
+    trip = {
+        "pickup_location": {"name": "Pickup", "latitude": latitude, "longitude": longitude},
+        "destination_location": {"name": "Destination", "latitude": latitude + 0.05, "longitude": longitude},
+    }
+
+    async with websockets.connect(f"ws://127.0.0.1:{PORT_A}/ws/ride-updates?token={rider_token}") as rider_socket, \
+            websockets.connect(f"ws://127.0.0.1:{PORT_A}/ws/ride-updates?token={driver_token}") as driver_socket:
+        await rider_socket.recv()
+        await driver_socket.recv()
+
+        # Created while the driver is still offline, so it waits for their accept
+        ride = request(PORT_A, "POST", "/api/rides", trip, rider_token)
+        if ride["status"] != "searching":
+            print(f"Ride was matched on worker A before the test could accept it: {ride['status']}")
+            return False
+        # Worker A caches the offline driver, then must drop that snapshot when B changes them
+        request(PORT_A, "GET", "/api/users/me", token=driver_token)
+        request(PORT_B, "PUT", "/api/users/driver/availability",
+                {"is_online": True, "latitude": latitude, "longitude": longitude}, driver_token)
+        await asyncio.sleep(INDEX_SYNC_WAIT_SECONDS)
+        if not request(PORT_A, "GET", "/api/users/me", token=driver_token)["is_online"]:
+            print("Worker A still serves its cached snapshot of the driver who went online on worker B")
+            return False
+        print("worker A dropped its cached driver when they went online on worker B")
+
+        started = time.perf_counter()
+        request(PORT_B, "POST", f"/api/rides/{ride['id']}/accept", token=driver_token)
+
+        try:
+            for name, socket in [("rider", rider_socket), ("driver", driver_socket)]:
+                await asyncio.wait_for(wait_for_match(socket, ride["id"]), DELIVERY_TIMEOUT_SECONDS)
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                print(f"{name} socket on worker A got the match after {elapsed_ms:.1f} ms")
+        except asyncio.TimeoutError:
+            print("Ride update accepted on worker B never reached worker A")
+            return False
+
+    await asyncio.sleep(INDEX_SYNC_WAIT_SECONDS)
+    other_ride = request(PORT_A, "POST", "/api/rides", trip, other_rider_token)
+    if other_ride["status"] != "searching":
+        print("Worker A matched a driver that is busy on worker B")
+        return False
+    request(PORT_A, "POST", f"/api/rides/{other_ride['id']}/cancel", token=other_rider_token)
+    print("worker A saw the driver go busy on worker B")
+
+    request(PORT_B, "PUT", f"/api/rides/{ride['id']}", {"status": "completed"}, driver_token)
+    await asyncio.sleep(INDEX_SYNC_WAIT_SECONDS)
+    other_ride = request(PORT_A, "POST", "/api/rides", trip, other_rider_token)
+    if other_ride["status"] != "matched":
+        print("Worker A did not match the driver who went online and free on worker B")
+        return False
+    print("worker A matched the driver who went online and free on worker B")
+
+    request(PORT_A, "POST", f"/api/rides/{other_ride['id']}/cancel", token=other_rider_token)
+    request(PORT_B, "PUT", "/api/users/driver/availability", {"is_online": False}, driver_token)
+    return True
+
+
+def main() -> int:
+    migrate()
+    workers = []
+    try:
+        workers.append(start_server(PORT_A, WORKER_ENV))
+        wait_until_healthy(PORT_A)
+        workers.append(start_server(PORT_B, WORKER_ENV))
+        wait_until_healthy(PORT_B)
+        ok = asyncio.run(run())
+    finally:
+        stop_servers(workers)
+    print("OK: cross-worker delivery, driver index and user cache sync work" if ok else "FAIL")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
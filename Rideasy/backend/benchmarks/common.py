@@ -0,0 +1,82 @@
+"""
+Helpers shared by the benchmark scripts for running main:app in a subprocess
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+from typing import Dict, List, Optional, Sequence
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def migrate(env: Optional[Dict[str, str]] = None):
+    """Bring the configured database to the latest schema (alembic upgrade head)"""
+    subprocess.run(
+        [sys.executable, "-m", "alembic", "upgrade", "head"],
+        cwd=BACKEND_DIR,
+        env=dict(os.environ, **(env or {})),
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def start_server(
+    port: int,
+    env: Optional[Dict[str, str]] = None,
+    workers: int = 1,
+    stdout=None,
+    app: str = "main:app",
+    extra_args: Sequence[str] = ()
+) -> subprocess.Popen:
+    """Start uvicorn serving main:app (or app) with extra environment variables"""
+    return subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", app,
+            "--port", str(port),
+            "--workers", str(workers),
+            "--log-level", "warning",
+            *extra_args,
+        ],
+        cwd=BACKEND_DIR,
+        env=dict(os.environ, **(env or {})),
+        stdout=stdout,
+    )
+
+
+def stop_servers(servers: List[subprocess.Popen]):
+    for server in servers:
+        server.terminate()
+    for server in servers:
+        server.wait()
+
+
+def request(port: int, method: str, path: str, body: dict = None, token: str = None) -> dict:
+    """Blocking JSON request, for setup steps outside the measured section"""
+    headers = {"Content-Type": "application/json"}
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    data = json.dumps(body).encode("utf-8") if body is not None else None
+    req = urllib.request.Request(f"http://127.0.0.1:{port}{path}", data=data, headers=headers, method=method)
+    with urllib.request.urlopen(req) as response:
+        return json.loads(response.read())
+
+
+def wait_until_healthy(port: int, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            request(port, "GET", "/health")
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server on port {port} did not start")
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    if not samples:
+        return float("nan")
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
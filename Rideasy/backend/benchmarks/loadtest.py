@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+"""
+Load test main:app with simulated riders, drivers and WebSocket clients
+
+Usage:
+    DATABASE_URL=postgresql+asyncpg://... python benchmarks/loadtest.py [options]
+    python benchmarks/loadtest.py --sqlite /tmp/rideasy-load.db --riders 200 --drivers 50 --sockets 2000
+    python benchmarks/loadtest.py --url http://127.0.0.1:8000
+
+Without --url the script migrates the database (DATABASE_URL, or a SQLite
+file with --sqlite) and starts one uvicorn worker itself, with
+BCRYPT_ROUNDS=4 so registering users is not the bottleneck.
+
+Every simulated user registers through /api/auth/register and keeps a
+/ws/ride-updates socket open. Drivers go online at a random position,
+stream their location over the socket, poll /api/rides/available, accept
+the closest ride or one offered over the socket (--offers) and drive it
+through driverArriving, inProgress and completed. Riders create rides,
+cancel some of them and wait for the rest to finish. --sockets extra
+sockets are spread over the same users.
+
+Reports throughput and p50/p95/p99 latency per endpoint, and the time from
+sending an accept to the rider's socket receiving the match. Needs httpx
+(benchmarks/requirements.txt) and websockets (installed with uvicorn[standard]).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import subprocess
+import time
+import uuid
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import httpx
+import websockets
+
+from common import migrate, percentile, start_server, stop_servers, wait_until_healthy
+
+CENTER_LAT, CENTER_LON = 48.137, 11.575
+# Rides and drivers are spread over roughly 10 x 10 km
+SPREAD_DEG = 0.045
+PASSWORD = "password123"
+SETUP_ATTEMPTS = 10
+
+
+class Stats:
+    """Latency samples and error counts per endpoint label"""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    def record(self, label: str, elapsed_ms: float, ok: bool):
+        self.latencies[label].append(elapsed_ms)
+        if not ok:
+            self.errors[label] += 1
+
+    def print_table(self, title: str, duration: float):
+        print(f"\n{title} ({duration:.1f} s)")
+        print(f"{'endpoint':<34} {'count':>7} {'errors':>7} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+        total = 0
+        for label in sorted(self.latencies):
+            samples = self.latencies[label]
+            total += len(samples)
+            print(
+                f"{label:<34} {len(samples):>7} {self.errors[label]:>7} {len(samples) / duration:>8.1f} "
+                f"{percentile(samples, 0.50):>9.1f} {percentile(samples, 0.95):>9.1f} {percentile(samples, 0.99):>9.1f}"
+            )
+        print(f"{'total':<34} {total:>7} {sum(self.errors.values()):>7} {total / duration:>8.1f}")
+
+
+@dataclass
+class SimUser:
+    mode: str
+    token: str = ""
+    user_id: str = ""
+    # Ride the user is currently part of and the events its socket sets
+    ride_id: Optional[str] = None
+    matched: asyncio.Event = field(default_factory=asyncio.Event)
+    finished: asyncio.Event = field(default_factory=asyncio.Event)
+    # Rides the matching engine assigned to this driver
+    assigned: "asyncio.Queue[str]" = field(default_factory=asyncio.Queue)
+    # Rides offered to this driver over the socket
+    offers: "asyncio.Queue[str]" = field(default_factory=asyncio.Queue)
+    # Set when the rider cancels the ride this driver is on
+    cancelled: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace, base_url: str):
+        self.args = args
+        self.base_url = base_url
+        self.ws_url = base_url.replace("http", "ws", 1) + "/ws/ride-updates"
+        self.stats = Stats()
+        self.client: Optional[httpx.AsyncClient] = None
+        self.stopping = False
+        # ride_id to perf_counter() just before its accept was sent
+        self.accept_sent: Dict[str, float] = {}
+        self.delivery_ms: List[float] = []
+        self.counters: Dict[str, int] = defaultdict(int)
+        self.sockets_open = 0
+        self.socket_failures = 0
+        self.messages_received = 0
+
+    async def call(self, method: str, path: str, label: str, user: Optional[SimUser] = None, **kwargs) -> Optional[httpx.Response]:
+        headers = {"Authorization": f"Bearer {user.token}"} if user else {}
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, path, headers=headers, **kwargs)
+        except httpx.HTTPError:
+            self.stats.record(label, (time.perf_counter() - started) * 1000, False)
+            return None
+        # 4xx from lost races (ride already taken) are expected, not errors
+        self.stats.record(label, (time.perf_counter() - started) * 1000, response.status_code < 500)
+        if response.status_code in (429, 503):
+            self.counters[f"requests rejected with {response.status_code}"] += 1
+        return response
+
+    def random_point(self) -> Dict[str, float]:
+        return {
+            "latitude": CENTER_LAT + random.uniform(-SPREAD_DEG, SPREAD_DEG),
+            "longitude": CENTER_LON + random.uniform(-SPREAD_DEG, SPREAD_DEG),
+        }
+
+    # Setup
+
+    async def register(self, user: SimUser, semaphore: asyncio.Semaphore):
+        name = f"load-{user.mode}-{uuid.uuid4().hex[:10]}"
+        async with semaphore:
+            # Setup bursts may be shed while the pool is saturated; retry like a client would
+            for _ in range(SETUP_ATTEMPTS):
+                response = await self.call("POST", "/api/auth/register", "POST /api/auth/register", json={
+                    "email": f"{name}@example.com",
+                    "username": name,
+                    "password": PASSWORD,
+                    "user_mode": user.mode,
+                })
+                if response is None or response.status_code not in (429, 503):
+                    break
+                await asyncio.sleep(float(response.headers.get("retry-after", "1")))
+        if response is None or response.status_code != 201:
+            raise RuntimeError(f"Registering {name} failed: {response and response.text}")
+        body = response.json()
+        user.token = body["access_token"]
+        user.user_id = body["user"]["id"]
+
+    # WebSockets
+
+    async def open_socket(self, user: SimUser, semaphore: asyncio.Semaphore, on_message=None) -> Optional[object]:
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                socket = await websockets.connect(
+                    f"{self.ws_url}?token={user.token}", open_timeout=60, ping_interval=None, max_queue=None
+                )
+                await socket.recv()  # "connected"
+            except Exception:
+                self.stats.record("WS connect", (time.perf_counter() - started) * 1000, False)
+                self.socket_failures += 1
+                return None
+            self.stats.record("WS connect", (time.perf_counter() - started) * 1000, True)
+        self.sockets_open += 1
+        asyncio.create_task(self.read_socket(socket, user, on_message))
+        return socket
+
+    async def read_socket(self, socket, user: SimUser, on_message):
+        try:
+            async for raw in socket:
+                self.messages_received += 1
+                if on_message is not None:
+                    on_message(user, json.loads(raw))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.sockets_open -= 1
+
+    def on_rider_message(self, rider: SimUser, message: dict):
+        if message.get("type") != "ride_update" or message["data"]["id"] != rider.ride_id:
+            return
+        # Deltas carry only what changed, so any field may be missing
+        ride = message["data"]
+        if ride.get("status") == "matched" and not rider.matched.is_set():
+            sent = self.accept_sent.pop(ride["id"], None)
+            if sent is not None:
+                self.delivery_ms.append((time.perf_counter() - sent) * 1000)
+            rider.matched.set()
+        elif ride.get("status") in ("completed", "cancelled"):
+            rider.finished.set()
+
+    def on_driver_message(self, driver: SimUser, message: dict):
+        if message.get("type") == "ride_offer":
+            self.counters["ride offers received"] += 1
+            driver.offers.put_nowait(message["data"]["id"])
+            return
+        if message.get("type") != "ride_update":
+            return
+        ride = message["data"]
+        if ride["id"] == driver.ride_id and ride.get("status") == "cancelled":
+            driver.cancelled.set()
+        # Assigned by the matching engine rather than accepted by this driver
+        elif ride.get("status") == "matched" and ride.get("driver_id") == driver.user_id and ride["id"] != driver.ride_id:
+            driver.assigned.put_nowait(ride["id"])
+
+    # Simulated users
+
+    async def rider_loop(self, rider: SimUser):
+        while not self.stopping:
+            pickup, destination = self.random_point(), self.random_point()
+            rider.matched.clear()
+            rider.finished.clear()
+            response = await self.call("POST", "/api/rides", "POST /api/rides", rider, json={
+                "pickup_location": {"name": "Pickup", **pickup},
+                "destination_location": {"name": "Destination", **destination},
+            })
+            if response is None or response.status_code != 201:
+                await asyncio.sleep(1)
+                continue
+            rider.ride_id = response.json()["id"]
+            self.counters["rides created"] += 1
+
+            cancel_early = random.random() < self.args.cancel_rate
+            try:
+                await asyncio.wait_for(
+                    rider.matched.wait(),
+                    random.uniform(0.5, 2.0) if cancel_early else self.args.match_timeout
+                )
+            except asyncio.TimeoutError:
+                await self.call("POST", f"/api/rides/{rider.ride_id}/cancel", "POST /api/rides/{id}/cancel", rider)
+                self.counters["rides cancelled by rider"] += 1
+            else:
+                self.counters["rides matched"] += 1
+                try:
+                    await asyncio.wait_for(rider.finished.wait(), self.args.trip_seconds * 4 + 30)
+                except asyncio.TimeoutError:
+                    self.counters["rides never finished"] += 1
+            rider.ride_id = None
+            await asyncio.sleep(random.uniform(0, self.args.think_seconds))
+
+    async def driver_loop(self, driver: SimUser):
+        while not self.stopping:
+            if not driver.assigned.empty():
+                await self.drive(driver, driver.assigned.get_nowait())
+                continue
+            if not driver.offers.empty():
+                await self.take(driver, driver.offers.get_nowait())
+                continue
+
+            response = await self.call("GET", "/api/rides/available", "GET /api/rides/available", driver,
+                                       params={"limit": 5})
+            rides = response.json() if response is not None and response.status_code == 200 else []
+            for ride in rides:
+                if await self.take(driver, ride["id"]):
+                    break
+            else:
+                # Until the next poll, an offer pushed over the socket wakes the driver up
+                try:
+                    ride_id = await asyncio.wait_for(
+                        driver.offers.get(), random.uniform(0.5, 1.5) * self.args.poll_seconds
+                    )
+                except asyncio.TimeoutError:
+                    continue
+                await self.take(driver, ride_id)
+
+    async def take(self, driver: SimUser, ride_id: str) -> bool:
+        """Accept a ride and drive it if this driver won it"""
+        self.accept_sent[ride_id] = time.perf_counter()
+        response = await self.call("POST", f"/api/rides/{ride_id}/accept", "POST /api/rides/{id}/accept", driver)
+        if response is None or response.status_code != 200:
+            self.accept_sent.pop(ride_id, None)
+            return False
+        self.counters["rides accepted"] += 1
+        await self.drive(driver, ride_id)
+        return True
+
+    async def drive(self, driver: SimUser, ride_id: str):
+        driver.ride_id = ride_id
+        driver.cancelled.clear()
+        for ride_status in ("driverArriving", "inProgress", "completed"):
+            try:
+                await asyncio.wait_for(driver.cancelled.wait(), self.args.trip_seconds / 3)
+                break
+            except asyncio.TimeoutError:
+                pass
+            response = await self.call("PUT", f"/api/rides/{ride_id}", "PUT /api/rides/{id}", driver,
+                                       json={"status": ride_status})
+            # The rider cancelled just before the update
+            if response is None or response.status_code != 200:
+                break
+        else:
+            self.counters["rides completed"] += 1
+        driver.ride_id = None
+
+    async def stream_location(self, driver: SimUser, socket):
+        position = self.random_point()
+        while not self.stopping:
+            await asyncio.sleep(self.args.location_seconds)
+            position["latitude"] += random.uniform(-0.001, 0.001)
+            position["longitude"] += random.uniform(-0.001, 0.001)
+            try:
+                await socket.send(json.dumps({"type": "location", **position}))
+            except websockets.ConnectionClosed:
+                return
+
+    # Phases
+
+    async def run(self):
+        args = self.args
+        limits = httpx.Limits(max_connections=args.riders + args.drivers + args.concurrency)
+        async with httpx.AsyncClient(base_url=self.base_url, limits=limits, timeout=60) as self.client:
+            riders = [SimUser("rider") for _ in range(args.riders)]
+            drivers = [SimUser("driver") for _ in range(args.drivers)]
+            users = riders + drivers
+
+            setup_started = time.perf_counter()
+            semaphore = asyncio.Semaphore(args.concurrency)
+            await asyncio.gather(*[self.register(user, semaphore) for user in users])
+            await asyncio.gather(*[
+                self.call("PUT", "/api/users/driver/availability", "PUT /api/users/driver/availability",
+                          driver, json={"is_online": True, **self.random_point()})
+                for driver in drivers
+            ])
+            rider_sockets = await asyncio.gather(*[
+                self.open_socket(rider, semaphore, self.on_rider_message) for rider in riders
+            ])
+            driver_sockets = await asyncio.gather(*[
+                self.open_socket(driver, semaphore, self.on_driver_message) for driver in drivers
+            ])
+            extra_sockets = await asyncio.gather(*[
+                self.open_socket(users[i % len(users)], semaphore) for i in range(args.sockets)
+            ])
+            setup_seconds = time.perf_counter() - setup_started
+            self.stats.print_table("Setup", setup_seconds)
+            print(f"sockets open {self.sockets_open}, failed {self.socket_failures}")
+
+            self.stats = Stats()
+            run_started = time.perf_counter()
+            tasks = [asyncio.create_task(self.rider_loop(rider)) for rider in riders]
+            tasks += [asyncio.create_task(self.driver_loop(driver)) for driver in drivers]
+            tasks += [
+                asyncio.create_task(self.stream_location(driver, socket))
+                for driver, socket in zip(drivers, driver_sockets) if socket is not None
+            ]
+            await asyncio.sleep(args.duration)
+            self.stopping = True
+            run_seconds = time.perf_counter() - run_started
+            run_stats = self.stats
+
+            # Let loops finish their current step, then leave nothing active behind
+            await asyncio.wait(tasks, timeout=args.trip_seconds + 10)
+            for task in tasks:
+                task.cancel()
+            self.stats = Stats()
+            await asyncio.gather(*[
+                self.call("POST", f"/api/rides/{rider.ride_id}/cancel", "cleanup", rider)
+                for rider in riders if rider.ride_id
+            ])
+            await asyncio.gather(*[
+                self.call("PUT", "/api/users/driver/availability", "cleanup", driver, json={"is_online": False})
+                for driver in drivers
+            ])
+            messages = self.messages_received
+            sockets_open = self.sockets_open
+            for socket in rider_sockets + driver_sockets + extra_sockets:
+                if socket is not None:
+                    await socket.close()
+
+        run_stats.print_table("Load", run_seconds)
+        print("\nRides")
+        for name, count in sorted(self.counters.items()):
+            print(f"  {name:<30} {count:>7}  ({count / run_seconds:.2f}/s)")
+        print("\nWebSockets")
+        print(f"  open at end of run             {sockets_open:>7}")
+        print(f"  failed to connect              {self.socket_failures:>7}")
+        print(f"  messages received              {messages:>7}")
+        print(
+            f"  accept -> rider socket         {len(self.delivery_ms):>7} samples   "
+            f"p50 {percentile(self.delivery_ms, 0.50):.1f} ms   p95 {percentile(self.delivery_ms, 0.95):.1f} ms   "
+            f"p99 {percentile(self.delivery_ms, 0.99):.1f} ms"
+        )
+
+
+def raise_open_file_limit():
+    """Thousands of sockets need more descriptors than the usual soft limit of 1024"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--url", help="test a running server instead of starting one")
+    parser.add_argument("--sqlite", metavar="PATH", help="start the server on this SQLite file instead of DATABASE_URL")
+    parser.add_argument("--port", type=int, default=int(os.getenv("BENCH_PORT", "8121")))
+    parser.add_argument("--riders", type=int, default=100)
+    parser.add_argument("--drivers", type=int, default=30)
+    parser.add_argument("--sockets", type=int, default=1000, help="extra idle sockets on top of one per user")
+    parser.add_argument("--duration", type=float, default=60, help="seconds of load after setup")
+    parser.add_argument("--concurrency", type=int, default=50, help="parallel registrations and socket connects")
+    parser.add_argument("--cancel-rate", type=float, default=0.2, help="share of rides cancelled before a match")
+    parser.add_argument("--match-timeout", type=float, default=15, help="riders cancel if unmatched after this")
+    parser.add_argument("--trip-seconds", type=float, default=6)
+    parser.add_argument("--think-seconds", type=float, default=2, help="max pause between a rider's rides")
+    parser.add_argument("--poll-seconds", type=float, default=1, help="driver /available polling interval")
+    parser.add_argument("--location-seconds", type=float, default=2, help="driver location update interval")
+    parser.add_argument("--offers", action="store_true", help="start the server with RIDE_OFFERS_ENABLED=true")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    raise_open_file_limit()
+    if args.url:
+        asyncio.run(LoadTest(args, args.url.rstrip("/")).run())
+        return
+
+    # The engine is what the driver simulation expects unless rides are offered
+    env = {"BCRYPT_ROUNDS": "4", "BATCH_MATCHING_ENABLED": "true"}
+    if args.offers:
+        env["RIDE_OFFERS_ENABLED"] = "true"
+    if args.sqlite:
+        env["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.abspath(args.sqlite)}"
+    migrate(env)
+    server = start_server(args.port, env, stdout=subprocess.DEVNULL)
+    try:
+        wait_until_healthy(args.port)
+        asyncio.run(LoadTest(args, f"http://127.0.0.1:{args.port}").run())
+    finally:
+        stop_servers([server])
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,52 @@
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from contextlib import asynccontextmanager
 
-from app.database import engine, Base
-from app.routers import auth, rides, users, websocket
+from app.admission import AdmissionMiddleware
+from app.auth_cache import user_cache_sync
+from app.database import AsyncSessionLocal
+from app.dependencies import require_metrics_token
+from app.dispatch import ride_dispatcher, RIDE_OFFERS_ENABLED
+from app.driver_index import driver_index
+from app.driver_sync import driver_index_sync
+from app.eta import eta_estimator
+from app.location_writer import location_writer
+from app.matching import matching_engine, BATCH_MATCHING_ENABLED
+from app.metrics import MetricsMiddleware, registry
+from app.ride_archiver import ride_archiver, RIDES_ARCHIVE_ENABLED
+from app.routers import admin, auth, rides, users, websocket
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Startup: Create tables
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    # Startup: the schema is managed by Alembic (alembic upgrade head)
+    # Rebuild the in-memory driver index from the database
+    async with AsyncSessionLocal() as db:
+        await driver_index.rebuild(db)
+    # Learn ETA speed tables from completed rides, then refresh them periodically
+    await eta_estimator.reload()
+    eta_estimator.start()
+    # Ride offers replace assignment by the engine
+    if BATCH_MATCHING_ENABLED and not RIDE_OFFERS_ENABLED:
+        matching_engine.start()
+    location_writer.start()
+    if RIDES_ARCHIVE_ENABLED:
+        ride_archiver.start()
+    await websocket.manager.start()
+    # Share driver index changes and user cache invalidations with the other workers over the bus
+    await driver_index_sync.start()
+    await user_cache_sync.start()
     yield
-    # Shutdown: cleanup if needed
-    pass
+    # Shutdown: stop background tasks and flush buffered driver positions
+    await matching_engine.stop()
+    await ride_dispatcher.stop()
+    await eta_estimator.stop()
+    await ride_archiver.stop()
+    await location_writer.stop()
+    await user_cache_sync.stop()
+    await driver_index_sync.stop()
+    await websocket.manager.stop()
 
 
 app = FastAPI(
@@ -23,6 +56,8 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+# Innermost, so CORS headers are added to its 429 and 503 responses too
+app.add_middleware(AdmissionMiddleware)
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -30,13 +65,17 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
+# Added last so it is outermost and times everything below it
+app.add_middleware(MetricsMiddleware)
 
 # Include routers
 app.include_router(auth.router, prefix="/api/auth", tags=["authentication"])
 app.include_router(users.router, prefix="/api/users", tags=["users"])
 app.include_router(rides.router, prefix="/api/rides", tags=["rides"])
 app.include_router(websocket.router, prefix="/ws", tags=["websocket"])
+app.include_router(admin.router, prefix="/api/admin", tags=["admin"])
 
 
 @app.get("/")
@@ -48,3 +87,11 @@ async def root():
 async def health_check():
     return {"status": "healthy"}
 
+
+@app.get(
+    "/metrics", response_class=PlainTextResponse, include_in_schema=False,
+    dependencies=[Depends(require_metrics_token)]
+)
+async def metrics():
+    """Prometheus metrics of this worker process"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
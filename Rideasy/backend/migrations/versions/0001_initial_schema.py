@@ -0,0 +1,90 @@
+"""Initial schema, as previously created by Base.metadata.create_all
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18 09:00:00
+
+Databases created by the old startup create_all already have these tables;
+mark them with `alembic stamp 0001` instead of running this revision.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0001"
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "users",
+        sa.Column("id", sa.String(), nullable=False),
+        sa.Column("email", sa.String(), nullable=False),
+        sa.Column("username", sa.String(), nullable=False),
+        sa.Column("hashed_password", sa.String(), nullable=False),
+        sa.Column("full_name", sa.String(), nullable=True),
+        sa.Column("phone_number", sa.String(), nullable=True),
+        sa.Column("user_mode", sa.Enum("RIDER", "DRIVER", name="usermode"), nullable=True),
+        sa.Column("rating", sa.Float(), nullable=True),
+        sa.Column("is_online", sa.Boolean(), nullable=True),
+        sa.Column("current_latitude", sa.Float(), nullable=True),
+        sa.Column("current_longitude", sa.Float(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.Column("updated_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_users_email", "users", ["email"], unique=True)
+    op.create_index("ix_users_username", "users", ["username"], unique=True)
+
+    op.create_table(
+        "locations",
+        sa.Column("id", sa.String(), nullable=False),
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("latitude", sa.Float(), nullable=False),
+        sa.Column("longitude", sa.Float(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+
+    op.create_table(
+        "rides",
+        sa.Column("id", sa.String(), nullable=False),
+        sa.Column("rider_id", sa.String(), nullable=False),
+        sa.Column("driver_id", sa.String(), nullable=True),
+        sa.Column("pickup_location_id", sa.String(), nullable=False),
+        sa.Column("destination_location_id", sa.String(), nullable=False),
+        sa.Column(
+            "status",
+            sa.Enum(
+                "SEARCHING", "MATCHED", "DRIVER_ARRIVING", "IN_PROGRESS", "COMPLETED", "CANCELLED",
+                name="ridestatus"
+            ),
+            nullable=True,
+        ),
+        sa.Column("fare", sa.Float(), nullable=True),
+        sa.Column("estimated_arrival", sa.DateTime(), nullable=True),
+        sa.Column("started_at", sa.DateTime(), nullable=True),
+        sa.Column("completed_at", sa.DateTime(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.Column("updated_at", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(["rider_id"], ["users.id"]),
+        sa.ForeignKeyConstraint(["driver_id"], ["users.id"]),
+        sa.ForeignKeyConstraint(["pickup_location_id"], ["locations.id"]),
+        sa.ForeignKeyConstraint(["destination_location_id"], ["locations.id"]),
+        sa.PrimaryKeyConstraint("id"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("rides")
+    op.drop_table("locations")
+    op.drop_index("ix_users_username", table_name="users")
+    op.drop_index("ix_users_email", table_name="users")
+    op.drop_table("users")
+    sa.Enum(name="ridestatus").drop(op.get_bind(), checkfirst=True)
+    sa.Enum(name="usermode").drop(op.get_bind(), checkfirst=True)
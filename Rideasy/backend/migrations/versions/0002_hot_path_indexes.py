@@ -0,0 +1,81 @@
+"""Indexes for the ride and driver access paths, one active ride per user
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 09:30:00
+
+The unique indexes replace the "already has an active ride" SELECTs in
+create_ride and accept_ride. Those checks were racy, so before building the
+indexes every rider and driver is left with only their newest active ride;
+older duplicates are cancelled.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0002"
+down_revision: Union[str, None] = "0001"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+ACTIVE_RIDE = "status IN ('SEARCHING', 'MATCHED', 'DRIVER_ARRIVING', 'IN_PROGRESS')"
+ONLINE_DRIVER = "is_online = true AND user_mode = 'DRIVER'"
+
+
+def cancel_duplicate_active_rides(column: str):
+    op.execute(sa.text(f"""
+        UPDATE rides SET status = 'CANCELLED'
+        WHERE id IN (
+            SELECT id FROM (
+                SELECT id, ROW_NUMBER() OVER (
+                    PARTITION BY {column} ORDER BY created_at DESC, id DESC
+                ) AS position
+                FROM rides
+                WHERE {column} IS NOT NULL AND {ACTIVE_RIDE}
+            ) AS ranked
+            WHERE position > 1
+        )
+    """))
+
+
+def upgrade() -> None:
+    # Also declared on the model since the bounding-box query was added, so
+    # databases built by create_all may have it already
+    op.create_index(
+        "ix_locations_latitude_longitude", "locations", ["latitude", "longitude"], if_not_exists=True
+    )
+
+    op.create_index("ix_rides_rider_id_status", "rides", ["rider_id", "status"])
+    op.create_index("ix_rides_driver_id_status", "rides", ["driver_id", "status"])
+    op.create_index("ix_rides_status_created_at", "rides", ["status", "created_at"])
+    op.create_index(
+        "ix_users_online_drivers", "users", ["id"],
+        postgresql_where=sa.text(ONLINE_DRIVER),
+        sqlite_where=sa.text(ONLINE_DRIVER),
+    )
+
+    cancel_duplicate_active_rides("rider_id")
+    cancel_duplicate_active_rides("driver_id")
+    op.create_index(
+        "uq_rides_active_rider", "rides", ["rider_id"], unique=True,
+        postgresql_where=sa.text(ACTIVE_RIDE),
+        sqlite_where=sa.text(ACTIVE_RIDE),
+    )
+    op.create_index(
+        "uq_rides_active_driver", "rides", ["driver_id"], unique=True,
+        postgresql_where=sa.text(ACTIVE_RIDE),
+        sqlite_where=sa.text(ACTIVE_RIDE),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("uq_rides_active_driver", table_name="rides")
+    op.drop_index("uq_rides_active_rider", table_name="rides")
+    op.drop_index("ix_users_online_drivers", table_name="users")
+    op.drop_index("ix_rides_status_created_at", table_name="rides")
+    op.drop_index("ix_rides_driver_id_status", table_name="rides")
+    op.drop_index("ix_rides_rider_id_status", table_name="rides")
+    op.drop_index("ix_locations_latitude_longitude", table_name="locations")
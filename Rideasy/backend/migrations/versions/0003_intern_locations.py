@@ -0,0 +1,146 @@
+"""Intern locations: merge duplicates and make (name, latitude, longitude) unique
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 11:00:00
+
+Merges locations rows that intern to the same key into the oldest one, points
+rides at the survivor and stores every key rounded the way the interner
+rounds it, then builds the unique index. A frozen copy of the compaction in
+app/locations.py as it stood at this revision (only rides, no versions yet).
+On a large table run `python -m app.locations` ahead of the deploy so this
+revision only has little left to merge.
+"""
+from datetime import datetime
+from typing import Sequence, Union
+import os
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0003"
+down_revision: Union[str, None] = "0002"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# The setting the interner rounds with, so both agree on every key
+COORDINATE_DECIMALS = int(os.getenv("LOCATION_COORDINATE_DECIMALS", "5"))
+BATCH_SIZE = 1000
+
+locations = sa.table(
+    "locations",
+    sa.column("id", sa.String),
+    sa.column("name", sa.String),
+    sa.column("latitude", sa.Float),
+    sa.column("longitude", sa.Float),
+    sa.column("created_at", sa.DateTime),
+)
+
+
+def location_key(name: str, latitude: float, longitude: float) -> tuple:
+    return (name.strip(), round(latitude, COORDINATE_DECIMALS), round(longitude, COORDINATE_DECIMALS))
+
+
+def plan_compaction(connection) -> None:
+    """
+    Fill location_merges (duplicate to canonical id) and location_fixes (the
+    key a canonical row should be stored under), reading locations in
+    latitude order a page at a time; rounding is monotonic, so every key lies
+    within one run of equal rounded latitudes
+    """
+    merges = []
+    fixes = []
+
+    def plan(group: list):
+        by_key = {}
+        for row in group:
+            by_key.setdefault(location_key(row.name, row.latitude, row.longitude), []).append(row)
+        for key, rows in by_key.items():
+            canonical = min(rows, key=lambda row: (row.created_at or datetime.min, row.id))
+            merges.extend({"id": row.id, "canonical_id": canonical.id} for row in rows if row is not canonical)
+            if (canonical.name, canonical.latitude, canonical.longitude) != key:
+                fixes.append({"id": canonical.id, "name": key[0], "latitude": key[1], "longitude": key[2]})
+
+    def flush():
+        if merges:
+            connection.execute(
+                sa.text("INSERT INTO location_merges (id, canonical_id) VALUES (:id, :canonical_id)"), merges
+            )
+            merges.clear()
+        if fixes:
+            connection.execute(
+                sa.text("INSERT INTO location_fixes (id, name, latitude, longitude) VALUES (:id, :name, :latitude, :longitude)"),
+                fixes
+            )
+            fixes.clear()
+
+    group: list = []
+    group_latitude = None
+    after = None
+    while True:
+        # Keyset pages rather than a server-side cursor, which would stay open
+        # until commit and block the index built below
+        query = (
+            sa.select(locations.c.id, locations.c.name, locations.c.latitude, locations.c.longitude, locations.c.created_at)
+            .order_by(locations.c.latitude, locations.c.id)
+            .limit(BATCH_SIZE)
+        )
+        if after is not None:
+            query = query.where(sa.tuple_(locations.c.latitude, locations.c.id) > after)
+        page = connection.execute(query).all()
+        if not page:
+            break
+        for row in page:
+            latitude = round(row.latitude, COORDINATE_DECIMALS)
+            if group and latitude != group_latitude:
+                plan(group)
+                group = []
+            group.append(row)
+            group_latitude = latitude
+        after = sa.tuple_(page[-1].latitude, page[-1].id)
+        if len(merges) + len(fixes) >= BATCH_SIZE:
+            flush()
+    if group:
+        plan(group)
+    flush()
+
+
+def upgrade() -> None:
+    connection = op.get_bind()
+    op.execute(sa.text(
+        "CREATE TEMPORARY TABLE location_merges (id VARCHAR PRIMARY KEY, canonical_id VARCHAR NOT NULL)"
+    ))
+    op.execute(sa.text(
+        "CREATE TEMPORARY TABLE location_fixes "
+        "(id VARCHAR PRIMARY KEY, name VARCHAR NOT NULL, latitude FLOAT NOT NULL, longitude FLOAT NOT NULL)"
+    ))
+    plan_compaction(connection)
+
+    for column in ("pickup_location_id", "destination_location_id"):
+        op.execute(sa.text(f"""
+            UPDATE rides SET {column} = (
+                SELECT canonical_id FROM location_merges WHERE location_merges.id = rides.{column}
+            )
+            WHERE {column} IN (SELECT id FROM location_merges)
+        """))
+    op.execute(sa.text("DELETE FROM locations WHERE id IN (SELECT id FROM location_merges)"))
+    op.execute(sa.text("""
+        UPDATE locations SET
+            name = (SELECT name FROM location_fixes WHERE location_fixes.id = locations.id),
+            latitude = (SELECT latitude FROM location_fixes WHERE location_fixes.id = locations.id),
+            longitude = (SELECT longitude FROM location_fixes WHERE location_fixes.id = locations.id)
+        WHERE id IN (SELECT id FROM location_fixes)
+    """))
+    op.execute(sa.text("DROP TABLE location_merges"))
+    op.execute(sa.text("DROP TABLE location_fixes"))
+
+    op.create_index(
+        "uq_locations_name_latitude_longitude", "locations", ["name", "latitude", "longitude"], unique=True
+    )
+
+
+def downgrade() -> None:
+    # Merged rows are not split again
+    op.drop_index("uq_locations_name_latitude_longitude", table_name="locations")
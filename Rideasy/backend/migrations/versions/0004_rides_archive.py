@@ -0,0 +1,62 @@
+"""Add rides_archive for completed and cancelled rides
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 12:00:00
+
+Rows are moved here by the background archiver (app/ride_archiver.py), not
+by this migration, so it stays fast on a large rides table.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0004"
+down_revision: Union[str, None] = "0003"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "rides_archive",
+        sa.Column("id", sa.String(), nullable=False),
+        sa.Column("rider_id", sa.String(), nullable=False),
+        sa.Column("driver_id", sa.String(), nullable=True),
+        sa.Column("pickup_location_id", sa.String(), nullable=False),
+        sa.Column("destination_location_id", sa.String(), nullable=False),
+        sa.Column(
+            "status",
+            # The ridestatus type already exists from 0001
+            postgresql.ENUM(
+                "SEARCHING", "MATCHED", "DRIVER_ARRIVING", "IN_PROGRESS", "COMPLETED", "CANCELLED",
+                name="ridestatus", create_type=False
+            ),
+            nullable=True,
+        ),
+        sa.Column("fare", sa.Float(), nullable=True),
+        sa.Column("estimated_arrival", sa.DateTime(), nullable=True),
+        sa.Column("started_at", sa.DateTime(), nullable=True),
+        sa.Column("completed_at", sa.DateTime(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.Column("updated_at", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(["rider_id"], ["users.id"]),
+        sa.ForeignKeyConstraint(["driver_id"], ["users.id"]),
+        sa.ForeignKeyConstraint(["pickup_location_id"], ["locations.id"]),
+        sa.ForeignKeyConstraint(["destination_location_id"], ["locations.id"]),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_rides_archive_rider_id_created_at", "rides_archive", ["rider_id", "created_at"])
+    op.create_index("ix_rides_archive_driver_id_created_at", "rides_archive", ["driver_id", "created_at"])
+
+
+def downgrade() -> None:
+    # Put archived rides back so no history is lost
+    op.execute("INSERT INTO rides SELECT * FROM rides_archive")
+    op.drop_index("ix_rides_archive_driver_id_created_at", table_name="rides_archive")
+    op.drop_index("ix_rides_archive_rider_id_created_at", table_name="rides_archive")
+    op.drop_table("rides_archive")
@@ -0,0 +1,32 @@
+"""Add a version counter to rides and rides_archive
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 14:00:00
+
+Existing rows start at version 1. The server default makes this a
+metadata-only change on Postgres 11+, so no table rewrite.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0005"
+down_revision: Union[str, None] = "0004"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("rides", sa.Column("version", sa.Integer(), server_default="1", nullable=False))
+    op.add_column("rides_archive", sa.Column("version", sa.Integer(), server_default="1", nullable=False))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("rides_archive") as batch_op:
+        batch_op.drop_column("version")
+    with op.batch_alter_table("rides") as batch_op:
+        batch_op.drop_column("version")
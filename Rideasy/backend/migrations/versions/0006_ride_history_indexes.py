@@ -0,0 +1,46 @@
+"""Indexes for keyset pagination of ride history
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 16:00:00
+
+GET /api/rides pages through a rider's or driver's rides ordered by
+(created_at, id). With that whole key indexed after the user column, a deep
+page is a seek plus a short range scan in both tables instead of a filter
+and sort. The archive's (user, created_at) indexes are a prefix of the new
+ones and are replaced.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0006"
+down_revision: Union[str, None] = "0005"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index("ix_rides_rider_id_created_at_id", "rides", ["rider_id", "created_at", "id"])
+    op.create_index("ix_rides_driver_id_created_at_id", "rides", ["driver_id", "created_at", "id"])
+
+    op.create_index(
+        "ix_rides_archive_rider_id_created_at_id", "rides_archive", ["rider_id", "created_at", "id"]
+    )
+    op.create_index(
+        "ix_rides_archive_driver_id_created_at_id", "rides_archive", ["driver_id", "created_at", "id"]
+    )
+    op.drop_index("ix_rides_archive_rider_id_created_at", table_name="rides_archive")
+    op.drop_index("ix_rides_archive_driver_id_created_at", table_name="rides_archive")
+
+
+def downgrade() -> None:
+    op.create_index("ix_rides_archive_driver_id_created_at", "rides_archive", ["driver_id", "created_at"])
+    op.create_index("ix_rides_archive_rider_id_created_at", "rides_archive", ["rider_id", "created_at"])
+    op.drop_index("ix_rides_archive_driver_id_created_at_id", table_name="rides_archive")
+    op.drop_index("ix_rides_archive_rider_id_created_at_id", table_name="rides_archive")
+
+    op.drop_index("ix_rides_driver_id_created_at_id", table_name="rides")
+    op.drop_index("ix_rides_rider_id_created_at_id", table_name="rides")